@@ -1,4 +1,5 @@
 import os
+import re
 # import sys
 from setuptools import setup, find_packages
 try:  # for pip >=12
@@ -8,7 +9,18 @@ except ImportError:  # for pip <= 9.0.3
     from pip.req import parse_requirements
     from pip import download
 
-VERSION = '0.5.4'
+
+def get_version():
+    # Version lives in vimbox/__init__.py so that importing vimbox does not
+    # need pkg_resources
+    init_file = os.path.join(
+        os.path.dirname(__file__), 'vimbox', '__init__.py'
+    )
+    with open(init_file) as fid:
+        return re.search("__version__ = '([^']+)'", fid.read()).group(1)
+
+
+VERSION = get_version()
 
 # parse_requirements() returns generator of pip.req.InstallRequirement
 # objects
@@ -36,7 +48,8 @@ setup(
     py_modules=['vimbox'],
     entry_points={
         'console_scripts': [
-            'vimbox = vimbox.__main__:main'
+            'vimbox = vimbox.cli:main',
+            'vimboxd = vimbox.daemon:main'
         ]
     },
     packages=find_packages(),
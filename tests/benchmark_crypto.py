@@ -0,0 +1,94 @@
+"""
+Encryption throughput in MB/s per cipher engine installed and content size
+
+    python tests/benchmark_crypto.py [size_in_bytes ...]
+
+By default 1 KB, 1 MB and 100 MB. For encrypt and decrypt it measures the
+AES-CTR cipher alone, the HMAC-SHA256 tag alone and the whole v2 format
+(key derivation, cipher and tag), to show where encrypted sync time goes.
+Not part of test_all.sh, it takes a while.
+"""
+import io
+import os
+import sys
+import time
+import hmac
+import hashlib
+from vimbox import crypto
+from vimbox.cipher import get_available_engines
+
+SIZES = [1024, 1024 ** 2, 100 * 1024 ** 2]
+
+
+def throughput(function, size, min_time=0.5):
+    """MB/s of calling function on size bytes, repeated for min_time"""
+    runs = 0
+    start = time.time()
+    while True:
+        function()
+        runs += 1
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            return size * runs / elapsed / 1024 ** 2
+
+
+def size_name(size):
+    for unit, factor in [('MB', 1024 ** 2), ('KB', 1024)]:
+        if size >= factor:
+            return "%d %s" % (size // factor, unit)
+    return "%d B" % size
+
+
+def benchmark(sizes):
+
+    password = crypto.validate_password('benchmark')
+    key = b'k' * 32
+    print("%-14s %-8s %-10s %8s %10s" % (
+        'engine', 'stage', 'operation', 'size', 'MB/s'
+    ))
+    for size in sizes:
+        text = os.urandom(size)
+        for engine in get_available_engines():
+
+            cipher_text = engine.ctr(key).encrypt(text)
+            encrypted = b''.join(
+                crypto.iter_encrypt(io.BytesIO(text), password, engine=engine)
+            )
+            stages = [
+                ('aes-ctr', 'encrypt', lambda: engine.ctr(key).encrypt(text)),
+                (
+                    'aes-ctr', 'decrypt',
+                    lambda: engine.ctr(key).decrypt(cipher_text)
+                ),
+                (
+                    'v2', 'encrypt',
+                    lambda: b''.join(crypto.iter_encrypt(
+                        io.BytesIO(text), password, engine=engine
+                    ))
+                ),
+                (
+                    'v2', 'decrypt',
+                    lambda: b''.join(crypto.iter_decrypt(
+                        [encrypted], password, engine=engine
+                    ))
+                )
+            ]
+            for stage, operation, function in stages:
+                print("%-14s %-8s %-10s %8s %10.1f" % (
+                    engine.name, stage, operation, size_name(size),
+                    throughput(function, size)
+                ))
+
+        # Same for all engines
+        print("%-14s %-8s %-10s %8s %10.1f" % (
+            '', 'hmac', 'both', size_name(size),
+            throughput(lambda: hmac.new(key, text, hashlib.sha256), size)
+        ))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sizes = [int(size) for size in sys.argv[1:]]
+    else:
+        sizes = SIZES
+    benchmark(sizes)
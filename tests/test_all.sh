@@ -18,3 +18,7 @@ python tests/test_encryption.py fake
 python tests/test_encryption.py dropbox
 python tests/test_extra.py fake
 python tests/test_offline.py
+python tests/test_startup.py
+python tests/test_state.py
+python tests/test_daemon.py
+python tests/test_metadata.py
@@ -7,9 +7,14 @@ import os
 import copy
 import sys
 from vimbox.__main__ import main
-from vimbox.crypto import get_path_hash
+from vimbox import local
+from vimbox.remote.primitives import VimboxClient
+from vimbox.crypto import get_path_hash, encrypt_content, validate_password
 from vimbox.local import load_config, get_local_file
 from vimbox.remote.fake_backend import get_fake_remote_local_path
+from vimbox.remote import dropbox_backend
+from dropbox.exceptions import ApiError
+from dropbox.files import UploadSessionStartResult, UploadSessionAppendError
 from tools import (
     green,
     run_in_environment,
@@ -47,6 +52,34 @@ def test_main(backend_name):
     assert is_fake_remote_dir(folder_at_root), "Remote folder not created"
     print("Folder creation %s" % green("OK"))
 
+    # LIST
+    # Listing / drops cached folders no longer in the remote, keeps the rest
+    # and does not remove / itself from the cache
+    client = VimboxClient(config_path=local.CONFIG_FILE, verbose=0)
+    stale_folder = '/vimbox_stale_folder/'
+    local.update_state(
+        client.config_path,
+        client.config,
+        [['add-cache', '/'], ['add-cache', stale_folder]]
+    )
+    state_changes = []
+    update_state = local.update_state
+    local.update_state = lambda file_path, config, changes: (
+        state_changes.extend(changes) or
+        update_state(file_path, config, changes)
+    )
+    try:
+        client.list_folders('/')
+    finally:
+        local.update_state = update_state
+    assert stale_folder not in client.config['cache'], \
+        "Folder not in remote kept in cache"
+    assert REMOTE_UNIT_TEST_FOLDER in client.config['cache'], \
+        "Folder in remote removed from cache"
+    assert ['remove-cache', '/'] not in state_changes, \
+        "Listed folder removed from cache"
+    print("List root %s" % green("OK"))
+
     # MOVE
     # Move files
     plain_file2 = '%splain2' % folder_at_root
@@ -55,6 +88,9 @@ def test_main(backend_name):
     assert not is_local_file(plain_file), "Removal of local file failed"
     assert is_fake_remote_file(plain_file2), "Creation of remote dir failed"
     assert is_local_file(plain_file2), "Creation of local file failed"
+    client = VimboxClient(config_path=local.CONFIG_FILE, verbose=0)
+    assert client.content_hashes.is_unedited(get_local_file(plain_file2)), \
+        "Sync state did not follow the moved file"
     print("Move file %s" % green("OK"))
     # Rename folder
     folder2 = '%sfolder2/' % REMOTE_UNIT_TEST_FOLDER
@@ -79,6 +115,198 @@ def test_main(backend_name):
         "Removal from cache failed"
     print("Remove folder %s" % green("OK"))
 
+    # BATCH
+    # Several files copied, moved and removed in one batch each
+    batch_files = [
+        '%sbatch%d' % (REMOTE_UNIT_TEST_FOLDER, i) for i in range(3)
+    ]
+    batch_folder = '%sbatch_folder/' % REMOTE_UNIT_TEST_FOLDER
+    batch_folder2 = '%sbatch_folder2/' % REMOTE_UNIT_TEST_FOLDER
+    for batch_file in batch_files:
+        assert main(['-f', batch_file, 'Batch text'])
+    assert main(['mkdir', batch_folder]), "Could not create folder"
+    assert main(['mkdir', batch_folder2]), "Could not create folder"
+    assert main(['cp'] + batch_files + [batch_folder]), "Batch copy failed"
+    copied_files = [
+        "%s%s" % (batch_folder, os.path.basename(x)) for x in batch_files
+    ]
+    assert all(is_fake_remote_file(x) for x in batch_files + copied_files), \
+        "Batch copy in remote failed"
+    assert main(['mv'] + copied_files + [batch_folder2]), "Batch move failed"
+    moved_files = [
+        "%s%s" % (batch_folder2, os.path.basename(x)) for x in batch_files
+    ]
+    assert not any(is_fake_remote_file(x) for x in copied_files), \
+        "Batch move did not remove sources"
+    assert all(is_fake_remote_file(x) for x in moved_files), \
+        "Batch move in remote failed"
+    assert main(['rm'] + batch_files), "Batch remove failed"
+    assert not any(is_fake_remote_file(x) for x in batch_files), \
+        "Batch remove in remote failed"
+    assert not any(is_local_file(x) for x in batch_files), \
+        "Batch remove in local failed"
+    assert main(['rm', '-R', batch_folder, batch_folder2])
+    assert not is_fake_remote_dir(batch_folder2), \
+        "Batch folder removal failed"
+    print("Batch copy, move and remove %s" % green("OK"))
+
+    # CONFLICT
+    # Remote changed while we edit, upload is refused and we merge
+    conflict_file = '%sconflict' % REMOTE_UNIT_TEST_FOLDER
+    assert main(['-f', conflict_file, 'First line'])
+    client = VimboxClient(config_path=local.CONFIG_FILE, verbose=0)
+
+    def concurrent_edit(remote_content):
+        def edit(local_file, content):
+            client.client.files_upload(remote_content, conflict_file)
+            local.write_file(local_file, 'First line\nLocal line')
+            return 'First line\nLocal line'
+        return edit
+
+    # Merge keeping the remote version
+    mergetool = local.MERGETOOL
+    local.MERGETOOL = 'true'
+    try:
+        client.sync(conflict_file, edits=concurrent_edit(b'Remote line'))
+    finally:
+        local.MERGETOOL = mergetool
+    assert read_remote_content(conflict_file) == 'Remote line', \
+        "Remote edit was overwritten"
+    # Merge keeping the local version
+    local.MERGETOOL = 'cp'
+    try:
+        client.sync(conflict_file, edits=concurrent_edit(b'Remote line 2'))
+    finally:
+        local.MERGETOOL = mergetool
+    assert read_remote_content(conflict_file) == 'First line\nLocal line', \
+        "Merged content not pushed after conflict"
+    print("Conflicting remote edit %s" % green("OK"))
+
+    # SYNC
+    # Pull all files of a folder
+    sync_folder = '%ssync/' % REMOTE_UNIT_TEST_FOLDER
+    for index in range(3):
+        assert main(['-f', '%sfile%d' % (sync_folder, index), 'Text'])
+    client.client.files_upload(b'Remote text', '%sfile0' % sync_folder)
+    os.remove(get_local_file('%sfile1' % sync_folder))
+    # Encrypted on another machine
+    encrypted_file = get_path_hash('%ssecret' % sync_folder)
+    client.client.files_upload(
+        encrypt_content('Secret text', validate_password('dummy')),
+        encrypted_file
+    )
+    assert main(['sync', sync_folder]), "Folder sync failed"
+    assert not os.path.exists(get_local_file(encrypted_file)), \
+        "Encrypted file mirrored"
+    for index, text in enumerate(['Remote text', 'Text', 'Text']):
+        local_file = get_local_file('%sfile%d' % (sync_folder, index))
+        assert local.read_file(local_file) == text, \
+            "Folder sync did not update %s" % local_file
+    assert not [
+        name for name in os.listdir(get_local_file(sync_folder))
+        if name.endswith('.download')
+    ], "Temporary download files left behind"
+    print("Folder sync %s" % green("OK"))
+
+    # CHANGES
+    # Only what changed since the last call is pulled
+    assert main(['changes', sync_folder]), "Could not start change feed"
+    client = VimboxClient(config_path=local.CONFIG_FILE, verbose=0)
+    client.client.files_upload(b'New text', '%sfile2' % sync_folder)
+    client.client.files_upload(b'Added text', '%sfile3' % sync_folder)
+    client.client.files_delete('%sfile1' % sync_folder)
+    local.write_file(get_local_file('%sfile0' % sync_folder), 'Local edit')
+    client.client.files_upload(b'Other text', '%sfile0' % sync_folder)
+    encrypted_file2 = get_path_hash('%ssecret2' % sync_folder)
+    client.client.files_upload(
+        encrypt_content('Secret text', validate_password('dummy')),
+        encrypted_file2
+    )
+    with client.batch():
+        changes = client.changes(sync_folder)
+    changes['added'].sort()
+    assert changes == {
+        'added': sorted(['%sfile3' % sync_folder, encrypted_file2]),
+        'modified': ['%sfile0' % sync_folder, '%sfile2' % sync_folder],
+        'deleted': ['%sfile1' % sync_folder]
+    }, "Wrong changes %s" % changes
+    expected = ['Local edit', None, 'New text', 'Added text']
+    for index, text in enumerate(expected):
+        local_file = get_local_file('%sfile%d' % (sync_folder, index))
+        if text is None:
+            assert not os.path.isfile(local_file), \
+                "Deleted file not removed from local"
+        else:
+            assert local.read_file(local_file) == text, \
+                "Changes not applied to %s" % local_file
+    assert not os.path.exists(get_local_file(encrypted_file2)), \
+        "Encrypted file mirrored"
+    with client.batch():
+        assert client.changes(sync_folder) == {
+            'added': [], 'modified': [], 'deleted': []
+        }, "Changes reported twice"
+    print("Change feed %s" % green("OK"))
+
+    # WATCH
+    # Changes are pulled when the remote notifies them. The remote is edited
+    # while watch waits on its first long poll
+    longpoll = client.client.list_folder_longpoll
+
+    def edit_and_longpoll(cursor, timeout=30):
+        client.client.files_upload(b'Watched text', '%sfile2' % sync_folder)
+        return longpoll(cursor, timeout=timeout)
+
+    client.client.list_folder_longpoll = edit_and_longpoll
+    try:
+        client.watch(sync_folder, timeout=10, rounds=1)
+    finally:
+        client.client.list_folder_longpoll = longpoll
+    assert local.read_file(get_local_file('%sfile2' % sync_folder)) == \
+        'Watched text', "Watch did not pull remote change"
+    print("Watch %s" % green("OK"))
+
+    # CHUNKED UPLOAD
+    # Large files are streamed from the local copy in chunks
+    big_file = '%sbig' % REMOTE_UNIT_TEST_FOLDER
+    big_content = 'Line of text\n' * 10
+    client.client.upload_chunk_size = 16
+    sent_bytes = []
+    client._upload_progress = lambda remote_file: (
+        lambda sent, size: sent_bytes.append(sent)
+    )
+    client.sync(
+        big_file,
+        force_creation=True,
+        edits=lambda local_file, content: local.local_edit(
+            local_file, big_content, no_edit=True
+        )
+    )
+    assert read_remote_content(big_file) == big_content, \
+        "Chunked upload content differs"
+    assert sent_bytes == list(range(16, 130, 16)) + [130], \
+        "Unexpected upload progress %s" % sent_bytes
+    print("Chunked upload %s" % green("OK"))
+
+    # Failed chunks of a Dropbox upload session are api errors
+    class FailingSession(object):
+
+        def files_upload_session_start(self, chunk):
+            return UploadSessionStartResult(session_id='session')
+
+        def files_upload_session_append_v2(self, chunk, cursor):
+            raise ApiError(None, UploadSessionAppendError.not_found, '', '')
+
+    dropbox_client = dropbox_backend.StorageBackEnd('token')
+    dropbox_client.dropbox_client = FailingSession()
+    dropbox_client.upload_chunk_size = 16
+    response = dropbox_client.files_upload(
+        big_content.encode('utf-8'),
+        big_file
+    )
+    assert response['status'] == 'api-error', \
+        "Failed session chunk gave %s" % response['status']
+    print("Failed upload session %s" % green("OK"))
+
 
 if __name__ == '__main__':
     run_in_environment(test_main, backend_name='fake', debug=True)
@@ -0,0 +1,122 @@
+"""
+- commands forwarded to vimboxd over its socket
+- fall back when there is no daemon
+"""
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import threading
+from vimbox.__main__ import main
+from vimbox import local, daemon
+from vimbox.remote.primitives import VimboxClient
+from tools import (
+    green,
+    run_in_environment,
+    REMOTE_UNIT_TEST_FOLDER,
+    is_local_dir,
+    is_fake_remote_dir
+)
+
+
+def test_main(backend_name):
+
+    # NOTE: start_environment() has overloaded local.CONFIG_FILE
+    socket_folder = tempfile.mkdtemp()
+    socket_file = '%s/vimboxd.sock' % socket_folder
+    daemon.RECEIVE_TIMEOUT = 0.5
+
+    try:
+
+        # No daemon
+        assert daemon.forward(['ls', '/'], socket_file=socket_file) is None, \
+            "Expected None when there is no daemon"
+        print("No daemon fallback %s" % green("OK"))
+
+        # Start daemon
+        server = threading.Thread(
+            target=daemon.serve,
+            args=(local.CONFIG_FILE, socket_file)
+        )
+        server.daemon = True
+        server.start()
+        while not os.path.exists(socket_file):
+            time.sleep(0.01)
+
+        # Remote command through daemon
+        folder = '%sfolder1/' % REMOTE_UNIT_TEST_FOLDER
+        assert daemon.forward(['mkdir', folder], socket_file=socket_file), \
+            "mkdir through daemon failed"
+        assert is_local_dir(folder), "Local folder not created"
+        assert is_fake_remote_dir(folder), "Remote folder not created"
+        assert folder in local.load_config()['cache'], \
+            "Daemon did not register folder in cache"
+        print("Command through daemon %s" % green("OK"))
+
+        # Daemon sees changes from commands run in process
+        plain_file = '%splain' % folder
+        assert main(['-f', plain_file, 'This is some text'])
+        assert daemon.forward(['rm', plain_file], socket_file=socket_file), \
+            "rm through daemon failed"
+        print("Daemon reloads config %s" % green("OK"))
+
+        # Commands needing a terminal are refused
+        assert not daemon.forward(['config'], socket_file=socket_file), \
+            "Daemon should refuse interactive commands"
+        print("Daemon refuses interactive commands %s" % green("OK"))
+
+        # Commands that turn out to need a password are sent back to run in
+        # process, the daemon does not prompt
+        encrypted_file = '%sencrypted' % folder
+        assert main(['-e', encrypted_file, 'Secret text'], password='dummy')
+        assert daemon.forward(
+            ['cat', encrypted_file], socket_file=socket_file
+        ) is None, "Encrypted cat should be run in process"
+        assert daemon.forward(['ls', folder], socket_file=socket_file), \
+            "Daemon stopped serving"
+        print("Daemon hands back password prompts %s" % green("OK"))
+
+        # Bad requests and commands calling exit() fail alone
+        for message in [b'not json', b'{"args": []}']:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.connect(socket_file)
+            connection.sendall(message)
+            connection.shutdown(socket.SHUT_WR)
+            response = daemon._receive(connection)
+            connection.close()
+            assert response['return'] is False, \
+                "Bad request %s did not fail" % message
+        list_folders = VimboxClient.list_folders
+        VimboxClient.list_folders = lambda *args: sys.exit()
+        try:
+            assert daemon.forward(['ls', folder], socket_file=socket_file) \
+                is False, "exit() in a command did not fail"
+        finally:
+            VimboxClient.list_folders = list_folders
+        assert daemon.forward(['ls', folder], socket_file=socket_file), \
+            "Daemon stopped serving"
+        print("Daemon survives bad requests %s" % green("OK"))
+
+        # A client that never finishes its request does not block the rest
+        stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stalled.connect(socket_file)
+        stalled.sendall(b'{"args": ')
+        results = []
+        waiting = threading.Thread(target=lambda: results.append(
+            daemon.forward(['ls', folder], socket_file=socket_file)
+        ))
+        waiting.daemon = True
+        waiting.start()
+        waiting.join(10 * daemon.RECEIVE_TIMEOUT)
+        stalled.close()
+        assert results == [True], "Daemon blocked by stalled client"
+        print("Daemon times out stalled clients %s" % green("OK"))
+
+    finally:
+        shutil.rmtree(socket_folder)
+
+
+if __name__ == '__main__':
+    run_in_environment(test_main, backend_name='fake', debug=True)
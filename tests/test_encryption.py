@@ -2,10 +2,28 @@
 - client side stuff regarding encryption
 """
 import os
+import io
 import copy
 import sys
 from vimbox.__main__ import main
-from vimbox.crypto import get_path_hash
+from vimbox import local, VimboxClientError
+from vimbox.remote import primitives
+from vimbox.remote.primitives import VimboxClient, MANIFEST_NAME
+from vimbox.crypto import (
+    get_path_hash,
+    get_path_hashes,
+    is_encrypted_path,
+    is_hashed_name,
+    validate_password,
+    encrypt_file,
+    decrypt_file,
+    decript_content,
+    encrypt_content,
+    CHUNK_SIZE,
+    HEADER,
+    HEADER_SIZE
+)
+from Crypto.Cipher import AES
 from vimbox.local import load_config, get_local_file
 from vimbox.remote.fake_backend import get_fake_remote_local_path
 from tools import (
@@ -47,6 +65,106 @@ def test_main(backend_name):
         assert is_fake_remote_file(encrypted_file, password='dummy'), \
             "Remote file not created"
 
+    # KEY AGENT
+    # Password given once is used for other encrypted files in the folder
+    encrypted_file3 = '%sencrypted3' % REMOTE_UNIT_TEST_FOLDER
+    assert main(['-e', encrypted_file3, 'Some more text'], password='dummy')
+    client = VimboxClient(config_path=local.CONFIG_FILE, verbose=0)
+    response, _ = client.fetch(encrypted_file, password='dummy')
+    assert response['content'] == encrypted_content, "Decryption failed"
+    response, password = client.fetch(encrypted_file3)
+    assert response['content'] == 'Some more text', \
+        "Kept password not used"
+    assert password == 'dummy', "Kept password not returned"
+    try:
+        client.fetch(encrypted_file3, password='wrong')
+        assert False, "Wrong password accepted"
+    except VimboxClientError:
+        pass
+    # Wrong password typed fails on the first bytes, nothing else is
+    # downloaded
+    client.keys.forget()
+    downloads = []
+    full_download = client.client.file_download
+    client.client.file_download = \
+        lambda *args: downloads.append(args) or full_download(*args)
+    getpass = primitives.getpass.getpass
+    primitives.getpass.getpass = lambda *args: 'wrong'
+    try:
+        client.fetch(encrypted_file3)
+        assert False, "Wrong password accepted"
+    except VimboxClientError:
+        pass
+    finally:
+        primitives.getpass.getpass = getpass
+    assert not downloads, "Downloaded file with wrong password"
+    client.client.file_download = full_download
+    client.keys.timeout = 0
+    client.keys.forget()
+    client.keys.add(REMOTE_UNIT_TEST_FOLDER, 'dummy')
+    assert client.keys.get(encrypted_file3) is None, \
+        "Password kept with agent disabled"
+    assert main(['rm', encrypted_file3])
+    print("Key agent %s" % green("OK"))
+
+    # MANIFEST
+    # Names of encrypted files are restored from the folder manifest with a
+    # single download, e.g. on a new machine
+    if backend_name == 'fake':
+        assert is_fake_remote_file(
+            '%s%s' % (REMOTE_UNIT_TEST_FOLDER, MANIFEST_NAME),
+            password='dummy'
+        ), "Manifest not created in remote"
+    client = VimboxClient(config_path=local.CONFIG_FILE, verbose=0)
+    client.unregister_file(encrypted_file, update_manifest=False)
+    assert not hash_is_registered(encrypted_file), "Unregister failed"
+    client.keys.add(REMOTE_UNIT_TEST_FOLDER, 'dummy')
+    downloads = []
+    full_download = client.client.file_download
+    client.client.file_download = \
+        lambda *args: downloads.append(args) or full_download(*args)
+    client.list_folders(REMOTE_UNIT_TEST_FOLDER)
+    assert hash_is_registered(encrypted_file), "Name not restored"
+    assert len(downloads) == 1, "Expected one download, got %d" % \
+        len(downloads)
+    client.list_folders(REMOTE_UNIT_TEST_FOLDER)
+    assert len(downloads) == 1, "Registered names downloaded again"
+    client.client.file_download = full_download
+    assert client.is_removable(encrypted_file)[0], \
+        "Restored encrypted file not removable"
+    print("Encrypted manifest %s" % green("OK"))
+
+    # SYNC
+    # Encrypted files of a folder are pulled asking the password once
+    sync_folder = '%ssync/' % REMOTE_UNIT_TEST_FOLDER
+    sync_files = ['%ssecret%d' % (sync_folder, i) for i in range(3)]
+    for sync_file in sync_files:
+        assert main(['-e', sync_file, 'Secret text'], password='dummy')
+        os.remove(get_local_file(sync_file))
+    client = VimboxClient(config_path=local.CONFIG_FILE, verbose=0)
+    prompts = []
+    getpass = primitives.getpass.getpass
+    primitives.getpass.getpass = lambda *args: prompts.append(args) or 'dummy'
+    try:
+        assert client.sync_folder(sync_folder), "Folder sync failed"
+        assert all(
+            local.read_file(get_local_file(x)) == 'Secret text'
+            for x in sync_files
+        ), "Encrypted files not pulled"
+        with client.batch():
+            client.changes(sync_folder)
+        client._push('New secret text', sync_files[0], password='dummy')
+        with client.batch():
+            changes = client.changes(sync_folder)
+    finally:
+        primitives.getpass.getpass = getpass
+    assert changes['modified'] == [sync_files[0]], \
+        "Wrong changes %s" % changes
+    assert local.read_file(get_local_file(sync_files[0])) == \
+        'New secret text', "Encrypted change not pulled"
+    assert len(prompts) == 1, "Password asked %d times" % len(prompts)
+    print("Sync encrypted folder %s" % green("OK"))
+
     # MOVE
     # Move files
     folder_at_root = '%sfolder1/' % REMOTE_UNIT_TEST_FOLDER
@@ -81,6 +199,72 @@ def test_main(backend_name):
         assert is_fake_remote_file(moved_encrypted_file2, password='dummy'), \
             "File inside folder was not moved in remote"
 
+    # STREAMING
+    # Content spanning several chunks round-trips, wrong password writes
+    # nothing
+    password = validate_password('dummy')
+    text = b'x' * (2 * CHUNK_SIZE + 5)
+    cipher = io.BytesIO()
+    encrypt_file(io.BytesIO(text), cipher, password)
+    cipher.seek(0)
+    decrypted = io.BytesIO()
+    assert decrypt_file(cipher, decrypted, password), "Decryption failed"
+    assert decrypted.getvalue() == text, "Streamed round-trip failed"
+    cipher.seek(0)
+    decrypted = io.BytesIO()
+    assert not decrypt_file(cipher, decrypted, validate_password('wrong')), \
+        "Decryption with wrong password should fail"
+    assert not decrypted.getvalue(), "Wrong password wrote content"
+    print("Streaming encryption %s" % green("OK"))
+
+    # FORMAT
+    # Tampered content is rejected, files from before v2 are still read
+    tampered = bytearray(cipher.getvalue())
+    tampered[HEADER_SIZE] ^= 1
+    assert not decrypt_file(
+        io.BytesIO(bytes(tampered)), io.BytesIO(), password
+    ), "Tampered content accepted"
+    iv = os.urandom(16)
+    legacy_text = 'Text encrypted before v2'
+    legacy_body = HEADER + ' ' * (-(len(HEADER) + 1 + len(legacy_text)) % 16)
+    legacy_body = ('%s\n%s' % (legacy_body, legacy_text)).encode('utf-8')
+    legacy = iv + AES.new(
+        password.encode('utf-8'), AES.MODE_CBC, iv
+    ).encrypt(legacy_body)
+    assert decript_content(legacy, password) == (legacy_text, True), \
+        "Legacy format not read"
+    print("Authenticated format %s" % green("OK"))
+
+    # COMPRESSION
+    # Compressed before encrypting, flag read when decrypting
+    notes = 'Note line repeated many times\n' * 1000
+    compressed = encrypt_content(notes, password, compression='zlib')
+    assert len(compressed) < len(notes) / 5, "Content was not compressed"
+    assert decript_content(compressed, password) == (notes, True), \
+        "Compressed round-trip failed"
+    print("Compressed encryption %s" % green("OK"))
+
+    # PATH HASHES
+    # Memoized hashes match, hashed names are recognized
+    paths = ['%snote%d' % (REMOTE_UNIT_TEST_FOLDER, i) for i in range(3)]
+    assert get_path_hashes(paths) == [get_path_hash(x) for x in paths], \
+        "Batch path hashes differ"
+    assert all(is_hashed_name(x) for x in get_path_hashes(paths)), \
+        "Hashed name not recognized"
+    assert is_encrypted_path(get_path_hash(paths[0], md5_hash=True)), \
+        "Old hashed name not recognized"
+    assert not any(is_encrypted_path(x) for x in paths), \
+        "Plain name taken as hashed"
+    # Files with a name like a SHA-256 or MD5 hash can be removed
+    for hash_like_file in [
+        get_path_hash(paths[0]),
+        get_path_hash(paths[0], md5_hash=True)
+    ]:
+        assert main(['-f', hash_like_file, 'Plain text'])
+        assert main(['rm', hash_like_file]), \
+            "Could not remove file with hash-like name %s" % hash_like_file
+    print("Path hashes %s" % green("OK"))
+
     # REMOVE
     # remove folder (cache, local, remote)
     assert main(['rm', '-R', folder2])
@@ -0,0 +1,197 @@
+"""
+- file_type answered from the metadata cache
+- cache invalidated by own changes
+- stale folder listings revalidated with their cursor
+- encryption resolved without extra round trips
+- no download when the local copy matches the remote
+"""
+import time
+import datetime
+from dropbox import files
+from dropbox.exceptions import ApiError
+from vimbox.__main__ import main
+from vimbox.remote import dropbox_backend
+from vimbox import local
+from vimbox.remote import primitives
+from vimbox.remote.primitives import VimboxClient
+from tools import green, run_in_environment, REMOTE_UNIT_TEST_FOLDER
+
+
+class CountingBackend(object):
+    """Count calls made to the back-end"""
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+
+        def counted(*args, **kwargs):
+            self.calls.append(name)
+            return method(*args, **kwargs)
+
+        return counted
+
+
+def test_main(backend_name):
+
+    # NOTE: start_environment() has overloaded local.CONFIG_FILE
+    client = VimboxClient(config_path=local.CONFIG_FILE, verbose=0)
+    backend = CountingBackend(client.client)
+    client.client = backend
+
+    folder = '%sfolder1/' % REMOTE_UNIT_TEST_FOLDER
+    plain_file = '%splain' % folder
+    assert main(['-f', plain_file, 'This is some text'])
+
+    # Listing the folder answers later lookups without round trips
+    client.list_folders(folder)
+    backend.calls = []
+    assert client.file_type(plain_file)[0] == 'file', "Wrong file type"
+    assert client.file_type('%smissing' % folder)[0] is None, \
+        "Wrong file type for missing file"
+    assert backend.calls == [], "Expected no back-end calls, got %s" % \
+        backend.calls
+    print("Metadata from cache %s" % green("OK"))
+
+    # Own changes invalidate the cache
+    client.remove(plain_file)
+    assert client.file_type(plain_file)[0] is None, \
+        "Removed file still in metadata cache"
+    print("Metadata invalidation %s" % green("OK"))
+
+    # Stale listings are revalidated with a single call
+    client.metadata.ttl = 0
+    time.sleep(0.01)
+    backend.calls = []
+    assert client.file_type('%snew' % folder)[0] is None
+    assert backend.calls[0] == 'list_folder_continue', \
+        "Expected cursor revalidation, got %s" % backend.calls
+    print("Cursor revalidation %s" % green("OK"))
+
+    # Persisted between clients
+    client.metadata.ttl = 60
+    client.list_folders(folder)
+    client.metadata.save()
+    client2 = VimboxClient(config_path=local.CONFIG_FILE, verbose=0)
+    assert client2.metadata.get(plain_file) == (True, None), \
+        "Metadata cache not persisted"
+    # Reloaded in long lived clients when other client saved it
+    reloaded_file = '%sreloaded' % folder
+    client.metadata.put(reloaded_file, {'type': 'file'})
+    client.metadata.save()
+    client2.reload_config()
+    assert client2.metadata.get_last(reloaded_file) == {'type': 'file'}, \
+        "Metadata cache not reloaded"
+    print("Persistent metadata cache %s" % green("OK"))
+
+    # Registered encrypted files cost one download when the password is
+    # given or kept
+    encrypted_file = '%sencrypted' % folder
+    assert main(['-e', encrypted_file, 'This is secret'], password='dummy')
+    client3 = VimboxClient(config_path=local.CONFIG_FILE, verbose=0)
+    backend = CountingBackend(client3.client)
+    client3.client = backend
+    response, _ = client3.fetch(encrypted_file, password='dummy')
+    assert response['content'] == 'This is secret', "Wrong content"
+    assert backend.calls == ['file_download'], \
+        "Expected a single download, got %s" % backend.calls
+    backend.calls = []
+    client3.fetch(encrypted_file)
+    assert backend.calls == ['file_download'], \
+        "Expected a single download, got %s" % backend.calls
+    # A password asked for is checked on their first bytes before
+    client3.keys.forget()
+    backend.calls = []
+    getpass = primitives.getpass.getpass
+    primitives.getpass.getpass = lambda *args: 'dummy'
+    try:
+        client3.fetch(encrypted_file)
+    finally:
+        primitives.getpass.getpass = getpass
+    assert backend.calls == ['file_download_head', 'file_download'], \
+        "Expected password check and download, got %s" % backend.calls
+    print("Single download for encrypted file %s" % green("OK"))
+
+    # Unknown files resolve plain and hashed names in one request
+    client3.metadata.entries.clear()
+    client3.metadata.cursors.clear()
+    backend.calls = []
+    assert client3.file_type(encrypted_file)[:2] == ('file', True), \
+        "Wrong file type for encrypted file"
+    assert client3.file_type('%sother' % folder)[0] is None
+    assert backend.calls == ['files_metadata_batch'] * 2, \
+        "Expected one request per file, got %s" % backend.calls
+    print("Batched encryption resolution %s" % green("OK"))
+
+    # Local copy matching the remote content hash is not downloaded, the
+    # hash is asked to the back-end only if the cached one is stale
+    synced_file = '%ssynced' % folder
+    assert main(['-f', synced_file, 'This is some text'])
+    backend.calls = []
+    response, _ = client3.fetch(synced_file)
+    assert response['content'] == 'This is some text', "Wrong content"
+    assert backend.calls == ['file_metadata'], \
+        "Expected no download, got %s" % backend.calls
+    backend.calls = []
+    response, _ = client3.fetch(synced_file)
+    assert response['content'] == 'This is some text', "Wrong content"
+    assert backend.calls == [], \
+        "Expected no back-end calls, got %s" % backend.calls
+    # Changed remote is downloaded once the cache is stale
+    client3.client.files_upload(b'Other text', synced_file)
+    client3.metadata.ttl = 0
+    time.sleep(0.01)
+    response, _ = client3.fetch(synced_file)
+    assert response['content'] == 'Other text', "Remote change not fetched"
+    assert backend.calls[-1] == 'file_download', \
+        "Expected a download, got %s" % backend.calls
+    print("Skip download of local copy in sync %s" % green("OK"))
+
+    # Dropbox: paths absent from a large folder are looked up one by one
+    # instead of paging through the whole folder
+    class LargeFolder(object):
+
+        def files_list_folder(self, folder):
+            entry = files.FileMetadata(
+                name='plain',
+                path_lower='%s/plain' % folder,
+                id='id:plain',
+                client_modified=datetime.datetime(2020, 1, 1),
+                server_modified=datetime.datetime(2020, 1, 1),
+                rev='0123456789',
+                size=17
+            )
+            return files.ListFolderResult(
+                entries=[entry],
+                cursor='cursor',
+                has_more=True
+            )
+
+        def files_alpha_get_metadata(self, remote_path):
+            raise ApiError(
+                None,
+                files.GetMetadataError.path(files.LookupError.not_found),
+                '',
+                ''
+            )
+
+    dropbox_client = dropbox_backend.StorageBackEnd('token')
+    backend = CountingBackend(LargeFolder())
+    dropbox_client.dropbox_client = backend
+    response = dropbox_client.files_metadata_batch(
+        ['%splain' % folder, '%sabsent' % folder]
+    )
+    assert response['status'] == 'online', "Metadata batch failed"
+    assert response['content'][0]['rev'] == '0123456789', \
+        "Metadata of listed file not found"
+    assert response['content'][1] is None, "Absent file found"
+    assert backend.calls == [
+        'files_list_folder', 'files_alpha_get_metadata'
+    ], "Expected one page and one lookup, got %s" % backend.calls
+    print("Metadata batch in large folder %s" % green("OK"))
+
+
+if __name__ == '__main__':
+    run_in_environment(test_main, backend_name='fake', debug=True)
@@ -2,8 +2,16 @@ import os
 import copy
 import sys
 from vimbox.__main__ import main
+from vimbox import local
+from vimbox.remote.primitives import VimboxClient
 from vimbox.local import load_config, get_local_file
-from tools import run_in_environment, REMOTE_UNIT_TEST_FOLDER
+from tools import (
+    green,
+    run_in_environment,
+    REMOTE_UNIT_TEST_FOLDER,
+    read_remote_content,
+    is_fake_remote_file
+)
 
 
 def test_main(backend_name):
@@ -14,6 +22,7 @@ def test_main(backend_name):
     # Check a local copy was created (if intended)
     assert os.path.isfile(get_local_file(tmp_file)), \
         "Creation of local file %s failed" % tmp_file
+    plain_file = tmp_file
 
     tmp_file = '%sfolder1/encrypted' % REMOTE_UNIT_TEST_FOLDER
     worked = main(
@@ -28,6 +37,64 @@ def test_main(backend_name):
     assert not main(['mkdir', tmp_folder]), \
         "Should not be able to make folder offline"
 
+    # OUTBOX
+    # Changes to local copies are queued while offline
+    removed_file = '%sfolder1/removed' % REMOTE_UNIT_TEST_FOLDER
+    copied_file = '%sfolder1/copied' % REMOTE_UNIT_TEST_FOLDER
+    assert main(['-f', removed_file, 'Removed text'])
+    assert main(['cp', plain_file, copied_file]), "Offline copy not queued"
+    assert main(['rm', removed_file]), "Offline removal not queued"
+    assert not os.path.isfile(get_local_file(removed_file)), \
+        "Local copy not removed offline"
+    client = VimboxClient(config_path=local.CONFIG_FILE, verbose=0)
+    operations = [record[1] for record in client.outbox.pending()]
+    assert operations == ['push', 'push', 'copy', 'remove'], \
+        "Unexpected outbox %s" % operations
+    # Still offline, retry is delayed
+    assert not client.flush_outbox(), "Flush should fail offline"
+    assert not client.outbox.is_due(), "Retry not delayed"
+    print("Offline changes queued %s" % green("OK"))
+
+    # Back online, changes are sent in order
+    client.client.online = True
+    assert client.flush_outbox(force=True), "Outbox flush failed"
+    assert read_remote_content(plain_file) == 'This is some text', \
+        "Queued push not sent"
+    assert read_remote_content(copied_file) == 'This is some text', \
+        "Queued copy not sent"
+    assert not is_fake_remote_file(removed_file), "Queued removal not sent"
+    assert not client.outbox.pending(), "Outbox not emptied"
+    print("Outbox flush %s" % green("OK"))
+
+    # Remote changed meanwhile, queued push is not sent
+    local.write_file(get_local_file(plain_file), 'Offline edit')
+    client.defer_push(plain_file)
+    client.client.files_upload(b'Remote edit', plain_file)
+    assert client.flush_outbox(force=True), "Outbox flush failed"
+    assert read_remote_content(plain_file) == 'Remote edit', \
+        "Queued push overwrote remote edit"
+    assert local.read_file(get_local_file(plain_file)) == 'Offline edit', \
+        "Local copy with conflict was not kept"
+    print("Outbox conflict %s" % green("OK"))
+
+    # Offline edits of encrypted files are not queued, sending them needs a
+    # password. A queued change that fails does not block other commands
+    encrypted_file = '%sfolder1/secret' % REMOTE_UNIT_TEST_FOLDER
+    assert client._push('Secret text', encrypted_file, password='dummy') \
+        is None, "Could not create encrypted file"
+    client.register_file(encrypted_file, True)
+    local.write_file(get_local_file(encrypted_file), 'Offline secret')
+    client.defer_push(encrypted_file)
+    assert not client.outbox.pending(), "Encrypted file queued in plain"
+    client.outbox.add('push', encrypted_file, '')
+    client.keys.forget()
+    assert not client.flush_outbox(force=True), \
+        "Push of encrypted file without password sent"
+    assert client.outbox.pending(), "Failed change not kept for retry"
+    assert main(['ls', '%sfolder1/' % REMOTE_UNIT_TEST_FOLDER]) is not False, \
+        "Failed change blocked ls"
+    print("Offline encrypted edit %s" % green("OK"))
+
 
 if __name__ == '__main__':
     run_in_environment(test_main, debug=True, backend_name='fake-offline')
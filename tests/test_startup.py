@@ -0,0 +1,88 @@
+"""
+- start-up time of vimbox complete and vimbox cache (run at every new shell)
+- these must not import back-ends, yaml or crypto
+"""
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+from tools import green
+
+# Time budget in seconds of vimbox imports and command, measured inside the
+# interpreter so that its start-up (site imports vary by host) does not count
+STARTUP_BUDGET = 0.05
+# Best of this many runs is compared against the budget
+NUM_RUNS = 10
+# Number of cached folders in the fake completion file
+NUM_FOLDERS = 5000
+# Modules that must not be imported by the fast path
+HEAVY_MODULES = [
+    'yaml', 'dropbox', 'requests', 'Crypto', 'vimbox.local', 'vimbox.crypto',
+    'vimbox.remote.primitives', 'vimbox.__main__', 'pkg_resources'
+]
+# Runs the entry point and then lists which heavy modules got imported
+CALL_TEMPLATE = """
+import sys
+import time
+start = time.time()
+from vimbox.cli import main
+main(['%s'])
+elapsed = time.time() - start
+print('HEAVY ' + ' '.join(
+    name for name in %s if name in sys.modules
+))
+print('TIME %%f' %% elapsed)
+"""
+
+
+def run_command(command, home):
+    env = dict(os.environ)
+    env['HOME'] = home
+    code = CALL_TEMPLATE % (command, HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, '-c', code], env=env)
+    lines = output.decode('utf-8').split('\n')
+    time_line = [line for line in lines if line.startswith('TIME')][0]
+    return lines, float(time_line[5:])
+
+
+def test_main(home):
+
+    # Installed vimbox with a big cache
+    root_folder = '%s/.vimbox/' % home
+    os.mkdir(root_folder)
+    with open('%s/config.yml' % root_folder, 'w') as fid:
+        fid.write('backend_name: fake\n')
+    folders = ['/folder%d/' % index for index in range(NUM_FOLDERS)]
+    with open('%s/config.complete' % root_folder, 'w') as fid:
+        fid.write("".join(["%s\n" % folder for folder in folders]))
+
+    for command in ['complete', 'cache']:
+
+        # Output is correct and no heavy module was imported
+        lines, _ = run_command(command, home)
+        heavy_line = [line for line in lines if line.startswith('HEAVY')][0]
+        assert heavy_line == 'HEAVY ', \
+            "vimbox %s imported %s" % (command, heavy_line[6:])
+        assert '/folder%d/' % (NUM_FOLDERS - 1) in lines, \
+            "vimbox %s did not list cached folders" % command
+        if command == 'complete':
+            assert 'ls' in lines, "vimbox complete did not list commands"
+
+        # Start-up time within budget
+        elapsed = min(
+            run_command(command, home)[1] for _ in range(NUM_RUNS)
+        )
+        assert elapsed < STARTUP_BUDGET, \
+            "vimbox %s took %2.3f sec, budget is %2.3f sec" % (
+                command, elapsed, STARTUP_BUDGET
+            )
+        print("vimbox %s %2.3f sec %s" % (command, elapsed, green("OK")))
+
+
+if __name__ == '__main__':
+    home = tempfile.mkdtemp()
+    try:
+        test_main(home)
+    finally:
+        shutil.rmtree(home)
@@ -0,0 +1,132 @@
+"""
+- cache and path hashes live in the state journal, not in config.yml
+- each change appends only its delta
+- journal compaction
+- path hash registry
+- batched state changes
+"""
+import os
+import sys
+from vimbox.__main__ import main
+from vimbox import local, state
+from vimbox.remote.primitives import VimboxClient
+from tools import green, run_in_environment, REMOTE_UNIT_TEST_FOLDER
+
+
+def count_lines(file_path):
+    with open(file_path) as fid:
+        return len(fid.readlines())
+
+
+def test_main(backend_name):
+
+    # NOTE: start_environment() has overloaded local.CONFIG_FILE
+    state_file = state.get_state_file(local.CONFIG_FILE)
+
+    # YAML holds only user editable settings
+    plain_file = '%sfolder1/plain' % REMOTE_UNIT_TEST_FOLDER
+    assert main(['-f', plain_file, 'This is some text'])
+    with open(local.CONFIG_FILE) as fid:
+        yaml_keys = [line.split(':')[0] for line in fid.readlines()]
+    assert 'cache' not in yaml_keys, "Cache written to config.yml"
+    assert 'path_hashes' not in yaml_keys, \
+        "Path hashes written to config.yml"
+    assert '%sfolder1/' % REMOTE_UNIT_TEST_FOLDER in \
+        local.load_config()['cache'], "Register in cache failed"
+    print("Cache and path hashes out of config.yml %s" % green("OK"))
+
+    # Each change appends one transaction
+    num_lines = count_lines(state_file)
+    folder = '%sfolder2/' % REMOTE_UNIT_TEST_FOLDER
+    assert main(['mkdir', folder])
+    assert count_lines(state_file) == num_lines + 1, \
+        "Expected a single journal transaction"
+    # Nothing to change, nothing written
+    assert main(['-f', '%sfolder1/plain2' % REMOTE_UNIT_TEST_FOLDER, 'Text'])
+    assert count_lines(state_file) == num_lines + 1, \
+        "Journal written without changes"
+    print("Incremental journal %s" % green("OK"))
+
+    # Interrupted write of last transaction is ignored
+    with open(state_file, 'a') as fid:
+        fid.write('[["add-cache", "/half/wri')
+    assert '/half/wri' not in local.load_config()['cache'], \
+        "Half written transaction replayed"
+    assert main(['mkdir', '%sfolder3/' % REMOTE_UNIT_TEST_FOLDER])
+    assert '%sfolder3/' % REMOTE_UNIT_TEST_FOLDER in \
+        local.load_config()['cache'], \
+        "Transaction after a half written one was lost"
+    print("Interrupted transaction %s" % green("OK"))
+
+    # Compaction
+    config = local.load_config()
+    for index in range(state.COMPACT_SLACK // 2 + 1):
+        path_hash = '/tmp/.%d' % index
+        path = '/tmp/file%d' % index
+        local.update_state(
+            local.CONFIG_FILE, config, [['add-hash', path_hash, path]]
+        )
+        local.update_state(
+            local.CONFIG_FILE, config, [['remove-hash', path_hash]]
+        )
+    assert local.load_config()['cache'] == sorted(config['cache']), \
+        "Replay does not match state in memory"
+    assert count_lines(state_file) == 1, "Journal was not compacted"
+    new_config = local.load_config()
+    assert new_config['cache'] == sorted(config['cache']) and \
+        new_config['path_hashes'] == config['path_hashes'], \
+        "Compaction changed the state"
+    print("Journal compaction %s" % green("OK"))
+
+    # Path hash registry
+    path_hashes = state.PathHashes({
+        '/a/.hash1': '/a/file1',
+        '/a/b/.hash2': '/a/b/file2',
+        '/ab/.hash3': '/ab/file3'
+    })
+    assert path_hashes.has_path('/a/b/file2'), "Lookup by path failed"
+    assert path_hashes.get_hash('/a/b/file2') == '/a/b/.hash2', \
+        "Lookup of hash by path failed"
+    assert sorted(path_hashes.under('/a/')) == [
+        ('/a/.hash1', '/a/file1'), ('/a/b/.hash2', '/a/b/file2')
+    ], "Folder lookup failed"
+    assert path_hashes.under('/a/file1') == [('/a/.hash1', '/a/file1')], \
+        "File lookup failed"
+    assert len(path_hashes.under('/')) == 3, "Root lookup failed"
+    del path_hashes['/a/b/.hash2']
+    assert not path_hashes.has_path('/a/b/file2'), "Removal by hash failed"
+    assert path_hashes.under('/a/b/') == [], "Removal from trie failed"
+    assert path_hashes == {
+        '/a/.hash1': '/a/file1', '/ab/.hash3': '/ab/file3'
+    }, "Registry does not match dict"
+    print("Path hash registry %s" % green("OK"))
+
+    # A command writes its state changes once
+    num_lines = count_lines(state_file)
+    source_folder = '%sfolder1/' % REMOTE_UNIT_TEST_FOLDER
+    target_folder = '%sfolder4/' % REMOTE_UNIT_TEST_FOLDER
+    assert main(['mv', source_folder, target_folder])
+    assert count_lines(state_file) == num_lines + 1, \
+        "Expected a single journal transaction for mv"
+    assert target_folder in local.load_config()['cache'], \
+        "Register in cache failed"
+    assert source_folder not in local.load_config()['cache'], \
+        "Unregister from cache failed"
+    print("Batch state changes %s" % green("OK"))
+
+    # Changes are written if the batch is interrupted
+    client = VimboxClient(config_path=local.CONFIG_FILE, verbose=0)
+    folder = '%sfolder5/' % REMOTE_UNIT_TEST_FOLDER
+    try:
+        with client.batch():
+            client.make_directory(folder)
+            raise KeyboardInterrupt()
+    except KeyboardInterrupt:
+        pass
+    assert folder in local.load_config()['cache'], \
+        "Interrupted batch was not written"
+    print("Interrupted batch %s" % green("OK"))
+
+
+if __name__ == '__main__':
+    run_in_environment(test_main, backend_name='fake', debug=True)
@@ -4,6 +4,10 @@ import shutil
 from vimbox.diogenes import style
 from vimbox import crypto
 from vimbox import local
+from vimbox.complete import get_complete_file
+from vimbox.state import get_state_file
+from vimbox.outbox import get_outbox_file
+from vimbox.remote.metadata import get_metadata_file
 from vimbox.remote.primitives import VimboxClient
 from vimbox.remote.fake_backend import get_fake_remote_local_path
 
@@ -158,6 +162,19 @@ def reset_environment(sucess=False):
         "unit test configurstion has unexpected name, not deleting it"
     os.remove(local.CONFIG_FILE)
     print("Removing config %s" % local.CONFIG_FILE)
+    state_file = get_state_file(local.CONFIG_FILE)
+    for extra_file in [
+        get_complete_file(local.CONFIG_FILE),
+        state_file,
+        '%s.lock' % state_file,
+        get_metadata_file(local.CONFIG_FILE),
+        local.get_content_hash_file(local.CONFIG_FILE),
+        get_outbox_file(local.CONFIG_FILE),
+        '%s.lock' % get_outbox_file(local.CONFIG_FILE),
+        '%s.flush' % get_outbox_file(local.CONFIG_FILE)
+    ]:
+        if os.path.isfile(extra_file):
+            os.remove(extra_file)
 
     # Inform user
     if sucess:
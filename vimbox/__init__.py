@@ -1,5 +1,17 @@
-import pkg_resources
-__version__ = pkg_resources.require("vimbox")[0].version
+import os
+import sys
+
+# NOTE: Keep this module light, it is imported at every shell start-up by
+# vimbox complete (see vimbox.cli). setup.py reads the version from here.
+__version__ = '0.5.4'
+
+# Locate the vimbox config. If we are inside a virtual environment look for it
+# inside
+if hasattr(sys, 'real_prefix'):
+    ROOT_FOLDER = "%s/.vimbox/" % sys.prefix
+else:
+    ROOT_FOLDER = "%s/.vimbox/" % os.environ['HOME']
+CONFIG_FILE = '%s/config.yml' % ROOT_FOLDER
 
 
 class VimboxClientError(Exception):
@@ -8,3 +20,8 @@ class VimboxClientError(Exception):
 
 class VimboxOfflineError(Exception):
     pass
+
+
+class VimboxTerminalNeeded(Exception):
+    # A client without terminal (see vimbox.daemon) needed to prompt
+    pass
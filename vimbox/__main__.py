@@ -15,16 +15,20 @@ COMMAND_HELP = {
     'cache': ('cache', 'show cached folders'),
     'config': ('config', 'open vimbox config in editor'),
     'ls': ('ls /path/to/folder/', 'list files in remote folder, update cache'),
-    'rm': ('rm /path/to/folder', 'remove file'),
+    'rm': ('rm /path/to/file [/path/file2 ...]', 'remove files'),
     'rm -R': ('rm -R /path/to/folder/', 'remove folder'),
-    'cp': ('cp /path/to/file /path2/to/[file2]', 'copy file'),
-    'mv': ('mv /path/to/file /path2/to/[file2]', 'move file'),
+    'cp': ('cp /path/to/file /path2/to/[file2]', 'copy file, many to /path2/'),
+    'mv': ('mv /path/to/file /path2/to/[file2]', 'move file, many to /path2/'),
     'cat': ('cat /path/to/file /path2/file', 'concatenate file outputs'),
-    'mkdir': ('mkdir /path/to/folder/', 'create folder')
+    'mkdir': ('mkdir /path/to/folder/', 'create folder'),
+    'sync': ('sync /path/to/folder/', 'pull all files in remote folder'),
+    'changes': ('changes /path/to/folder/', 'pull changes since last call'),
+    'watch': ('watch [/path/to/folder/]', 'pull changes as they happen'),
+    'flush': ('flush', 'send changes made offline now')
 }
 COMMAND_ORDER = [
     'setup', '-f', '-e', '', 'cache', 'config', 'ls', 'rm', 'rm -R', 'cp',
-    'mv', 'cat', 'mkdir'
+    'mv', 'cat', 'mkdir', 'sync', 'changes', 'watch', 'flush'
 ]
 
 
@@ -70,7 +74,7 @@ def install():
 def password_prompt(remote_file, config):
 
     # Check if file in cache already
-    if remote_file in config['path_hashes'].values():
+    if config['path_hashes'].has_path(remote_file):
         VimboxClientError(
             '\nCan not re-encrypt a registered file.\n'
         )
@@ -149,9 +153,24 @@ def offline_edit(local_file, initial_text):
         local.edittool(local_file)
 
 
-def main(args=None, config_path=None, password=None, verbose=1):
+def get_client(client, config_path, verbose):
     """
-    This is refered as vimbox in setup.py
+    Use the client given to main (e.g. by vimboxd) or create one. Changes
+    made while offline are sent first if possible
+    """
+    if client is None:
+        client = VimboxClient(config_path=config_path, verbose=verbose)
+    try:
+        client.flush_outbox()
+    except (VimboxClientError, VimboxOfflineError) as exception:
+        # Never block the command asked for
+        print("Could not send changes made offline: %s" % exception)
+    return client
+
+
+def main(args=None, config_path=None, password=None, verbose=1, client=None):
+    """
+    Called by vimbox.cli.main, which is refered as vimbox in setup.py
     """
 
     # Argument handling
@@ -258,9 +277,10 @@ def main(args=None, config_path=None, password=None, verbose=1):
             return False
 
         # Client
-        client = VimboxClient(config_path=config_path, verbose=verbose)
+        client = get_client(client, config_path, verbose)
         try:
-            client.list_folders(argument)
+            with client.batch():
+                client.list_folders(argument)
             return True
 
         except KeyboardInterrupt:
@@ -275,7 +295,7 @@ def main(args=None, config_path=None, password=None, verbose=1):
     elif args[0] == 'mkdir':
 
         # Copy file to file or folder
-        client = VimboxClient(config_path=config_path, verbose=verbose)
+        client = get_client(client, config_path, verbose)
         if len(args) != 2:
             vimbox_help()
             return False
@@ -284,7 +304,8 @@ def main(args=None, config_path=None, password=None, verbose=1):
             if alert:
                 print("%s" % alert)
                 return False
-            client.make_directory(args[1])
+            with client.batch():
+                client.make_directory(args[1])
             return True
         except KeyboardInterrupt:
             print("\nOperation canceled by user")
@@ -299,28 +320,34 @@ def main(args=None, config_path=None, password=None, verbose=1):
     elif args[0] == 'cp':
 
         # Argument handling
-        if len(args) != 3:
+        if len(args) < 3:
             vimbox_help()
             return False
 
-        # Copy file to file or folder
-        client = VimboxClient(config_path=config_path, verbose=verbose)
+        # Copy file to file or folder, several files to folder
+        client = get_client(client, config_path, verbose)
         try:
-            alert = assert_valid_path(args[1])
-            if alert:
-                print("%s" % alert)
-                return False
-            alert = assert_valid_path(args[2])
-            if alert:
-                print("%s" % alert)
-                return False
-            client.copy(args[1], args[2])
+            for arg in args[1:]:
+                alert = assert_valid_path(arg)
+                if alert:
+                    print("%s" % alert)
+                    return False
+            with client.batch():
+                try:
+                    if len(args) == 3:
+                        client.copy(args[1], args[2])
+                    else:
+                        client.copy_batch(args[1:-1], args[-1])
+                except VimboxOfflineError:
+                    # Copy in remote when back online
+                    for source in args[1:-1]:
+                        client.defer_copy(source, args[-1])
             return True
         except KeyboardInterrupt:
             print("\nOperation canceled by user")
             return False
         except VimboxOfflineError:
-            print("\nCan not copy files offline")
+            print("\nCan not copy files offline without local copy")
             return False
         except VimboxClientError as exception:
             print("\n%s" % str(exception))
@@ -328,52 +355,70 @@ def main(args=None, config_path=None, password=None, verbose=1):
 
     elif args[0] == 'cat':
 
-        # Copy file to file or folder
-        client = VimboxClient(config_path=config_path, verbose=verbose)
-        for arg in args[1:]:
-            try:
+        # Print each file, one password prompt per encrypted folder
+        client = get_client(client, config_path, verbose)
+        try:
+            for arg in args[1:]:
                 alert = assert_valid_path(arg, path_type='file')
                 if alert:
                     print("%s" % alert)
                     return False
-                client.cat(arg)
-                return True
-            except KeyboardInterrupt:
-                print("\nOperation canceled by user")
-                return False
-            except VimboxClientError as exception:
-                print("\n%s" % str(exception))
-                return False
+            with client.batch():
+                for arg in args[1:]:
+                    client.cat(arg)
+            return True
+        except KeyboardInterrupt:
+            print("\nOperation canceled by user")
+            return False
+        except VimboxClientError as exception:
+            print("\n%s" % str(exception))
+            return False
 
     elif args[0] == 'rm':
 
         # Remove file or folder
 
         # argument processing
-        if len(args) == 2:
-            arguments = args[1]
-            recursive_flag = False
-        elif len(args) == 3 and args[1] == '-R':
-            arguments = args[2]
+        if len(args) >= 3 and args[1] == '-R':
+            arguments = args[2:]
             recursive_flag = True
+        elif len(args) >= 2 and args[1] != '-R':
+            arguments = args[1:]
+            recursive_flag = False
         else:
             vimbox_help()
             return False
 
         # Call client
-        client = VimboxClient(config_path=config_path, verbose=verbose)
+        client = get_client(client, config_path, verbose)
         try:
-            alert = assert_valid_path(arguments)
-            if alert:
-                print("%s" % alert)
-                return False
-            client.remove(arguments, recursive=recursive_flag)
+            for argument in arguments:
+                alert = assert_valid_path(argument)
+                if alert:
+                    print("%s" % alert)
+                    return False
+            with client.batch():
+                try:
+                    if len(arguments) == 1:
+                        client.remove(arguments[0], recursive=recursive_flag)
+                    else:
+                        client.remove_batch(
+                            arguments,
+                            recursive=recursive_flag
+                        )
+                except VimboxOfflineError:
+                    # Remove in remote when back online
+                    for argument in arguments:
+                        client.defer_remove(
+                            argument,
+                            recursive=recursive_flag
+                        )
             return True
         except KeyboardInterrupt:
             print("\nOperation canceled by user")
             return False
         except VimboxOfflineError:
-            print("\nCan not remove files offline")
+            print("\nCan not remove files offline without local copy")
             return False
         except VimboxClientError as exception:
             print("%s" % str(exception))
@@ -384,28 +429,140 @@ def main(args=None, config_path=None, password=None, verbose=1):
         # Move file to file or folder
 
         # Argument handling
-        if len(args) != 3:
+        if len(args) < 3:
             vimbox_help()
             return False
 
         # Call client
-        client = VimboxClient(config_path=config_path, verbose=verbose)
+        client = get_client(client, config_path, verbose)
         try:
-            alert = assert_valid_path(args[1])
+            for arg in args[1:]:
+                alert = assert_valid_path(arg)
+                if alert:
+                    print("%s" % alert)
+                    return False
+            with client.batch():
+                try:
+                    if len(args) == 3:
+                        client.move(args[1], args[2])
+                    else:
+                        client.move_batch(args[1:-1], args[-1])
+                except VimboxOfflineError:
+                    # Move in remote when back online
+                    for source in args[1:-1]:
+                        client.defer_move(source, args[-1])
+            return True
+        except KeyboardInterrupt:
+            print("\nOperation canceled by user")
+            return False
+        except VimboxOfflineError:
+            print("\nCan not move files offline without local copy")
+            return False
+        except VimboxClientError as exception:
+            print("%s" % str(exception))
+            return False
+
+    elif args[0] == 'sync':
+
+        # Pull all files of a folder
+
+        # Argument handling
+        if len(args) != 2:
+            vimbox_help()
+            return False
+
+        # Call client
+        client = get_client(client, config_path, verbose)
+        try:
+            alert = assert_valid_path(args[1], path_type='dir')
             if alert:
                 print("%s" % alert)
                 return False
-            alert = assert_valid_path(args[2])
+            with client.batch():
+                return client.sync_folder(args[1])
+        except KeyboardInterrupt:
+            print("\nOperation canceled by user")
+            return False
+        except VimboxOfflineError:
+            print("\nCan not sync folders offline")
+            return False
+        except VimboxClientError as exception:
+            print("%s" % str(exception))
+            return False
+
+    elif args[0] == 'changes':
+
+        # Pull what changed in a folder since the last call
+
+        # Argument handling
+        if len(args) != 2:
+            vimbox_help()
+            return False
+
+        # Call client
+        client = get_client(client, config_path, verbose)
+        try:
+            alert = assert_valid_path(args[1], path_type='dir')
             if alert:
                 print("%s" % alert)
                 return False
-            client.move(args[1], args[2])
+            with client.batch():
+                changes = client.changes(args[1])
+            print("%d added, %d modified, %d deleted" % (
+                len(changes['added']),
+                len(changes['modified']),
+                len(changes['deleted'])
+            ))
             return True
         except KeyboardInterrupt:
             print("\nOperation canceled by user")
             return False
         except VimboxOfflineError:
-            print("\nCan not move files offline")
+            print("\nCan not get changes offline")
+            return False
+        except VimboxClientError as exception:
+            print("%s" % str(exception))
+            return False
+
+    elif args[0] == 'flush':
+
+        # Send changes made offline without waiting for the retry backoff
+        if len(args) != 1:
+            vimbox_help()
+            return False
+        if client is None:
+            client = VimboxClient(config_path=config_path, verbose=verbose)
+        try:
+            return client.flush_outbox(force=True)
+        except KeyboardInterrupt:
+            print("\nOperation canceled by user")
+            return False
+
+    elif args[0] == 'watch':
+
+        # Pull changes in cached folders as they happen
+
+        # Argument handling
+        if len(args) > 2:
+            vimbox_help()
+            return False
+
+        # Call client
+        client = get_client(client, config_path, verbose)
+        try:
+            if len(args) == 2:
+                alert = assert_valid_path(args[1], path_type='dir')
+                if alert:
+                    print("%s" % alert)
+                    return False
+                client.watch(args[1])
+            else:
+                client.watch()
+        except KeyboardInterrupt:
+            print("\nStopped watching")
+            return True
+        except VimboxOfflineError:
+            print("\nCan not start watching offline")
             return False
         except VimboxClientError as exception:
             print("%s" % str(exception))
@@ -434,17 +591,20 @@ def main(args=None, config_path=None, password=None, verbose=1):
         elif remote_file[-1] == '/':
 
             # Alias for ls
-            client = VimboxClient(config_path=config_path, verbose=verbose)
-            client.list_folders(remote_file)
+            client = get_client(client, config_path, verbose)
+            with client.batch():
+                client.list_folders(remote_file)
             return True
 
         else:
 
             # Edit file
-            client = VimboxClient(config_path=config_path, verbose=verbose)
+            client = get_client(client, config_path, verbose)
 
             # Create new encrypted file or register existing one
             # TODO: This should happend inside of the client
+            if encrypt and password is None:
+                password = client.keys.get(remote_file)
             if encrypt and password is None:
                 try:
                     password = password_prompt(remote_file, client.config)
@@ -457,12 +617,13 @@ def main(args=None, config_path=None, password=None, verbose=1):
 
             # Call function
             try:
-                client.edit(
-                    remote_file,
-                    force_creation=force_creation,
-                    password=password,
-                    initial_text=initial_text
-                )
+                with client.batch():
+                    client.edit(
+                        remote_file,
+                        force_creation=force_creation,
+                        password=password,
+                        initial_text=initial_text
+                    )
                 return True
 
             except KeyboardInterrupt:
@@ -478,8 +639,12 @@ def main(args=None, config_path=None, password=None, verbose=1):
                     print("\nCan not create encrypted files offline")
                     return False
                 else:
-                    # Extra edit mode offline
+                    # Extra edit mode offline, push when back online
+                    local_hash = client.content_hashes.get(local_file)
                     offline_edit(local_file, initial_text)
+                    if client.content_hashes.get(local_file) != local_hash:
+                        with client.batch():
+                            client.defer_push(remote_file)
                     return True
 
             except VimboxClientError as exception:
@@ -0,0 +1,108 @@
+"""
+AES engines used by vimbox.crypto
+
+An engine makes AES-CTR ciphers (v2 format) and AES-CBC ciphers (files from
+before v2) with encrypt(data) and decrypt(data) methods. get_engine() picks
+the fastest one installed:
+
+    cryptography    OpenSSL, uses AES-NI where the CPU has it
+    pycrypto        Crypto.Cipher.AES of pycrypto or pycryptodome (the
+                    latter also uses AES-NI)
+
+See tests/benchmark_crypto.py to compare them on a host.
+"""
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+
+
+class PyCryptoEngine(object):
+
+    name = 'pycrypto'
+
+    def ctr(self, key):
+        counter = Counter.new(128, initial_value=0)
+        return AES.new(key, AES.MODE_CTR, counter=counter)
+
+    def cbc(self, key, iv):
+        return AES.new(key, AES.MODE_CBC, iv)
+
+
+class CryptographyCipher(object):
+    """encrypt/decrypt methods on top of cryptography contexts"""
+
+    def __init__(self, cipher):
+        self.cipher = cipher
+        self.encryptor = None
+        self.decryptor = None
+
+    def encrypt(self, data):
+        if self.encryptor is None:
+            self.encryptor = self.cipher.encryptor()
+        return self.encryptor.update(data)
+
+    def decrypt(self, data):
+        if self.decryptor is None:
+            self.decryptor = self.cipher.decryptor()
+        return self.decryptor.update(data)
+
+
+class CryptographyEngine(object):
+
+    name = 'cryptography'
+
+    def __init__(self):
+        # Raises ImportError if not installed
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.ciphers import (
+            Cipher,
+            algorithms,
+            modes
+        )
+        self.backend = default_backend()
+        self.Cipher = Cipher
+        self.algorithms = algorithms
+        self.modes = modes
+
+    def ctr(self, key):
+        return CryptographyCipher(self.Cipher(
+            self.algorithms.AES(key),
+            self.modes.CTR(b'\x00' * 16),
+            backend=self.backend
+        ))
+
+    def cbc(self, key, iv):
+        return CryptographyCipher(self.Cipher(
+            self.algorithms.AES(key),
+            self.modes.CBC(iv),
+            backend=self.backend
+        ))
+
+
+# Fastest first
+ENGINES = [CryptographyEngine, PyCryptoEngine]
+# Engine in use, see get_engine
+_ENGINE = None
+
+
+def get_available_engines():
+    """Instances of the engines installed, fastest first"""
+    engines = []
+    for engine_class in ENGINES:
+        try:
+            engines.append(engine_class())
+        except ImportError:
+            pass
+    return engines
+
+
+def get_engine(name=None):
+    """Fastest engine installed, or the one of a given name"""
+    global _ENGINE
+    if name is not None:
+        for engine in get_available_engines():
+            if engine.name == name:
+                return engine
+        raise ValueError("Cipher engine %s is not installed" % name)
+    if _ENGINE is None:
+        _ENGINE = get_available_engines()[0]
+    return _ENGINE
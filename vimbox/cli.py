@@ -0,0 +1,61 @@
+"""
+This is refered as vimbox in setup.py
+
+Commands run at every shell start-up are answered here without importing the
+rest of vimbox. Commands that need no terminal go to vimboxd if it is running
+(see vimbox.daemon). Anything else is handed over to vimbox.__main__
+"""
+import os
+import sys
+from vimbox import CONFIG_FILE, complete
+
+
+def fast_complete(command):
+    """
+    Print completion options or cached folders from the completion file.
+
+    Returns None if there is no completion file and the slow path is needed
+    """
+
+    cache = complete.read_complete_file()
+    if cache is None:
+        if os.path.isfile(CONFIG_FILE):
+            # Config from an older version, vimbox.__main__ will read it and
+            # create the completion file
+            return None
+        # Not installed
+        cache = []
+
+    if command == 'complete':
+        options = complete.COMMANDS + cache
+    else:
+        options = cache
+    for option in options:
+        print(option)
+    return True
+
+
+def main(args=None):
+
+    if args is None:
+        # From command line
+        args = sys.argv[1:]
+
+    if len(args) == 1 and args[0] in ['complete', 'cache']:
+        sucess = fast_complete(args[0])
+        if sucess is not None:
+            return sucess
+
+    # Not imported above to keep completion fast
+    from vimbox import daemon
+    if args and args[0] in daemon.DAEMON_COMMANDS:
+        try:
+            sucess = daemon.forward(args)
+        except KeyboardInterrupt:
+            print("\nOperation canceled by user")
+            return False
+        if sucess is not None:
+            return sucess
+
+    from vimbox.__main__ import main as vimbox_main
+    return vimbox_main(args)
@@ -0,0 +1,40 @@
+"""
+Bash argument completion
+
+This is called through complete -W "$(vimbox complete)" at every shell
+start-up so it must stay light: no back-ends, no yaml and no crypto. Cached
+folders are read from a plain text file that vimbox.local refreshes every time
+the cache changes.
+"""
+import os
+from vimbox import CONFIG_FILE
+
+# Commands offered before the cached folders
+COMMANDS = ['setup', 'cache', 'config', 'ls', 'cp', 'mv', 'rm', 'sync',
+            'changes', 'watch', 'flush']
+
+
+def get_complete_file(config_file=None):
+    """Completion file of a given config e.g. config.yml -> config.complete"""
+    if config_file is None:
+        config_file = CONFIG_FILE
+    return '%s.complete' % os.path.splitext(config_file)[0]
+
+
+def write_complete_file(cache, config_file=None):
+    complete_file = get_complete_file(config_file)
+    tmp_file = '%s.tmp' % complete_file
+    with open(tmp_file, 'w') as fid:
+        for folder in sorted(set(map(str, cache))):
+            fid.write('%s\n' % folder)
+    # Rename is atomic, a shell starting meanwhile never reads half a file
+    os.rename(tmp_file, complete_file)
+
+
+def read_complete_file(config_file=None):
+    """Return cached folders, None if there is no completion file"""
+    complete_file = get_complete_file(config_file)
+    if not os.path.isfile(complete_file):
+        return None
+    with open(complete_file, 'r') as fid:
+        return [line.rstrip('\n') for line in fid if line.strip()]
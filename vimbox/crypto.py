@@ -1,14 +1,53 @@
+import io
 import os
 import sys
 import re
-from math import ceil
 #
+import hmac
+import zlib
+import struct
 import hashlib
-from Crypto.Cipher import AES
+import threading
+from itertools import chain
+from collections import OrderedDict
 from Crypto.Hash import MD5
+from vimbox.cipher import get_engine
 
 # ACHTUNG: Changing this will yield incorrect dencryption errors!
 HEADER = '# this was encrypted'
+# Header of files encrypted before v0.0.6, still accepted
+OLD_HEADER = '# this was encripted'
+# Bytes read at a time by the streaming functions
+CHUNK_SIZE = 64 * 1024
+# Start of files in the v2 format (see iter_encrypt), files without it use
+# the AES-CBC format with HEADER from before
+MAGIC = b'VIMBOX\x00\x02'
+SALT_SIZE = 16
+CHECK_SIZE = 16
+# MAGIC, flags, salt and key check value
+HEADER_SIZE = len(MAGIC) + 1 + SALT_SIZE + CHECK_SIZE
+TAG_SIZE = 32
+# PBKDF2 iterations deriving the keys of each file
+KDF_ITERATIONS = 10000
+# Compression of the text before encrypting it, flagged in the v2 header.
+# zstd needs the zstandard module
+COMPRESSION_FLAGS = {'zlib': 1, 'zstd': 2}
+# Bytes check_password needs, the v2 header or IV and two AES-CBC blocks
+QUICK_CHECK_SIZE = 48
+# Basename digests kept by get_path_hash, least recently used are dropped
+PATH_HASH_CACHE_SIZE = 4096
+# Start of encrypted names, see is_encrypted_path
+ENCRYPTED_NAME_REGEX = re.compile(r'\.[a-z0-9]')
+# Names given by get_path_hash, MD5 before v0.5.0 and SHA-256 after
+HASHED_NAME_REGEX = re.compile(r'\.([a-f0-9]{32}|[a-f0-9]{64})$')
+
+# (basename, md5_hash): hex digest, in least recently used order
+_DIGESTS = OrderedDict()
+_DIGESTS_LOCK = threading.Lock()
+
+
+class DecryptionError(ValueError):
+    pass
 
 
 def validate_password(password):
@@ -39,83 +78,363 @@ def validate_password(password):
     return password
 
 
-def encrypt_content(text, password):
+def _to_bytes(text):
+    if not isinstance(text, bytes):
+        return text.encode('utf-8')
+    return text
 
-    # Generate IV
-    if sys.version_info[0] > 2:
-        # Python3
-        iv = os.urandom(16)
+
+def derive_keys(password, salt):
+    """Cipher key, MAC key and key check value of a password and salt"""
+    material = hashlib.pbkdf2_hmac(
+        'sha256',
+        _to_bytes(password),
+        salt,
+        KDF_ITERATIONS,
+        64 + CHECK_SIZE
+    )
+    return material[:32], material[32:64], material[64:]
+
+
+def get_compressor(compression, level=None):
+    """Object with compress and flush methods, level None for default"""
+    if compression == 'zlib':
+        return zlib.compressobj(-1 if level is None else level)
+    elif compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(
+            level=3 if level is None else level
+        ).compressobj()
+    raise ValueError("Unknown compression %s" % compression)
+
+
+class Decompressor(object):
+    """Decompress text of v2 files, errors raise DecryptionError"""
+
+    def __init__(self, flags):
+        if flags == COMPRESSION_FLAGS['zlib']:
+            self.obj = zlib.decompressobj()
+            self.errors = (zlib.error,)
+        elif flags == COMPRESSION_FLAGS['zstd']:
+            try:
+                import zstandard
+            except ImportError:
+                raise DecryptionError("Install zstandard to read this file")
+            self.obj = zstandard.ZstdDecompressor().decompressobj()
+            self.errors = (zstandard.ZstdError,)
+        else:
+            raise DecryptionError("Unknown flags %d" % flags)
+
+    def decompress(self, data):
+        try:
+            return self.obj.decompress(data)
+        except self.errors:
+            raise DecryptionError("Corrupted encrypted content")
+
+    def flush(self):
+        # Older zstandard decompressors have no flush
+        if not hasattr(self.obj, 'flush'):
+            return b''
+        try:
+            return self.obj.flush()
+        except self.errors:
+            raise DecryptionError("Corrupted encrypted content")
+
+
+def iter_encrypt(source, password, compression=None, level=None,
+                 engine=None):
+    """
+    Encrypt a binary file object in the v2 format, yields the encrypted
+    bytes in chunks
+
+    Format is MAGIC, a flags byte, a random salt, a key check value, the text
+    encrypted with AES-CTR and an HMAC-SHA256 tag of all the previous
+    (encrypt-then-MAC). Cipher key, MAC key and key check value are derived
+    from password and salt (see derive_keys). Keys are unique per file, so
+    the counter starts at 0.
+
+    compression ('zlib' or 'zstd', see COMPRESSION_FLAGS) compresses the
+    text before encrypting it with the given level. engine is a
+    vimbox.cipher engine, the fastest installed by default
+    """
+    engine = engine or get_engine()
+    if compression is None:
+        flags = 0
+        compressor = None
     else:
-        # Python2
-        iv = str(os.urandom(16))
-    obj = AES.new(password, AES.MODE_CBC, iv)
-
-    # Create header to be a multiple of 16
-    old_length = len("%s\n%s" % (HEADER, text))
-    new_length = int(16*ceil(old_length*1./16))
-    if old_length != new_length:
-        padded_header = HEADER + (' ' * (new_length - old_length))
+        flags = COMPRESSION_FLAGS[compression]
+        compressor = get_compressor(compression, level)
+    salt = os.urandom(SALT_SIZE)
+    cipher_key, mac_key, key_check = derive_keys(password, salt)
+    obj = engine.ctr(cipher_key)
+    mac = hmac.new(mac_key, digestmod=hashlib.sha256)
+
+    header = MAGIC + struct.pack('B', flags) + salt + key_check
+    mac.update(header)
+    yield header
+    while True:
+        chunk = source.read(CHUNK_SIZE)
+        if not chunk:
+            if compressor is None:
+                break
+            # Last compressed bytes
+            chunk = compressor.flush()
+            compressor = None
+        elif compressor is not None:
+            chunk = compressor.compress(chunk)
+            if not chunk:
+                continue
+        chunk = obj.encrypt(chunk)
+        mac.update(chunk)
+        yield chunk
+    yield mac.digest()
+
+
+def read_header(head, password):
+    """
+    Flags and keys of a v2 header, given its first HEADER_SIZE bytes. Raises
+    DecryptionError if the password is wrong, it needs no more than that
+    """
+    if head[:len(MAGIC)] != MAGIC:
+        raise DecryptionError("Not in v2 format")
+    elif len(head) < HEADER_SIZE:
+        raise DecryptionError("Truncated encrypted content")
+    flags = struct.unpack('B', head[len(MAGIC):len(MAGIC) + 1])[0]
+    salt = head[len(MAGIC) + 1:len(MAGIC) + 1 + SALT_SIZE]
+    cipher_key, mac_key, key_check = derive_keys(password, salt)
+    if not hmac.compare_digest(key_check, head[HEADER_SIZE - CHECK_SIZE:]):
+        raise DecryptionError("Wrong password")
+    return flags, cipher_key, mac_key
+
+
+def check_password(head, password):
+    """
+    True if password opens an encrypted file given its first QUICK_CHECK_SIZE
+    bytes (or more). Only the header is decrypted
+    """
+    head = _to_bytes(head)
+    if head[:len(MAGIC)] == MAGIC:
+        try:
+            read_header(head[:HEADER_SIZE], password)
+        except DecryptionError:
+            return False
+        return True
+    # Before v2 HEADER fills the first blocks after the IV
+    if len(head) < QUICK_CHECK_SIZE:
+        return False
+    obj = get_engine().cbc(_to_bytes(password), head[:16])
+    text = obj.decrypt(head[16:QUICK_CHECK_SIZE])
+    return any(
+        text.startswith(header.encode('utf-8'))
+        for header in [HEADER, OLD_HEADER]
+    )
+
+
+def _iter_decrypt_v2(pending, chunks, password, engine):
+    """Decrypt v2 format (see iter_encrypt), pending are the first bytes"""
+
+    while len(pending) < HEADER_SIZE:
+        chunk = next(chunks, None)
+        if chunk is None:
+            break
+        pending += chunk
+    if len(pending) < HEADER_SIZE:
+        raise DecryptionError("Truncated encrypted content")
+    head = pending[:HEADER_SIZE]
+    flags, cipher_key, mac_key = read_header(head, password)
+    if flags:
+        decompressor = Decompressor(flags)
     else:
-        padded_header = HEADER
-    # Add header and encrypt
-    headed_text = "%s\n%s" % (padded_header, text)
-    return iv + obj.encrypt(headed_text)
+        decompressor = None
+    obj = engine.ctr(cipher_key)
+    mac = hmac.new(mac_key, digestmod=hashlib.sha256)
+    mac.update(head)
 
+    # The last TAG_SIZE bytes are the tag, keep them until the end
+    pending = pending[HEADER_SIZE:]
+    for chunk in chunks:
+        pending += chunk
+        if len(pending) > TAG_SIZE:
+            body = pending[:-TAG_SIZE]
+            pending = pending[-TAG_SIZE:]
+            mac.update(body)
+            text = obj.decrypt(body)
+            if decompressor is not None:
+                text = decompressor.decompress(text)
+            if text:
+                yield text
+    if len(pending) < TAG_SIZE:
+        raise DecryptionError("Truncated encrypted content")
+    body = pending[:-TAG_SIZE]
+    mac.update(body)
+    text = obj.decrypt(body) if body else b''
+    if decompressor is not None:
+        text = decompressor.decompress(text) + decompressor.flush()
+    if text:
+        yield text
+    if not hmac.compare_digest(mac.digest(), pending[-TAG_SIZE:]):
+        raise DecryptionError("Corrupted encrypted content")
 
-def decript_content(text_cipher, password):
 
-    # Recover IV
-    iv = text_cipher[:16]
-    text_cipher_body = text_cipher[16:]
-    # Decrypt
-    obj = AES.new(password, AES.MODE_CBC, iv)
-    headed_text = obj.decrypt(text_cipher_body)
-    # Separate header from body, return also check that decription worked
+def _iter_decrypt_cbc(pending, chunks, password, engine):
+    """Decrypt the format before v2, pending are the first bytes"""
+    obj = None
+    # Decrypted bytes until the end of the header is found
+    head = b''
+    for chunk in chain([b''], chunks):
+        pending += chunk
+        if obj is None:
+            if len(pending) < 16:
+                continue
+            # Recover IV
+            obj = engine.cbc(_to_bytes(password), pending[:16])
+            pending = pending[16:]
+        cut = len(pending) - len(pending) % 16
+        if not cut:
+            continue
+        text = obj.decrypt(pending[:cut])
+        pending = pending[cut:]
+        if head is None:
+            yield text
+            continue
+        head += text
+        if b'\n' not in head:
+            if len(head) > len(HEADER) + 16:
+                raise DecryptionError("Header not found")
+            continue
+        header, text = head.split(b'\n', 1)
+        if header.rstrip() not in [
+            HEADER.encode('utf-8'),
+            OLD_HEADER.encode('utf-8')
+        ]:
+            raise DecryptionError("Wrong header")
+        head = None
+        if text:
+            yield text
+    if pending or head is not None:
+        raise DecryptionError("Truncated encrypted content")
+
+
+def iter_decrypt(chunks, password, engine=None):
+    """
+    Decrypt encrypted bytes given in chunks of any size, yields the text in
+    chunks. Files before the v2 format are read too.
+
+    Raises DecryptionError before yielding anything if the password is
+    wrong. Content that fails authentication raises it at the end, what
+    was yielded must then be discarded.
+    """
+    engine = engine or get_engine()
+    chunks = iter(chunks)
+    pending = b''
+    for chunk in chunks:
+        pending += chunk
+        if len(pending) >= len(MAGIC):
+            break
+    if pending[:len(MAGIC)] == MAGIC:
+        return _iter_decrypt_v2(pending, chunks, password, engine)
+    return _iter_decrypt_cbc(pending, chunks, password, engine)
+
+
+def encrypt_file(source, target, password, compression=None, level=None):
+    """Encrypt binary file object source into target (see iter_encrypt)"""
+    for chunk in iter_encrypt(source, password, compression, level):
+        target.write(chunk)
+
+
+def decrypt_file(source, target, password):
+    """
+    Decrypt binary file object source into target. Returns False if
+    decryption failed, nothing is written if the password was wrong, what
+    was written must be discarded otherwise
+    """
+    chunks = iter(lambda: source.read(CHUNK_SIZE), b'')
+    try:
+        for chunk in iter_decrypt(chunks, password):
+            target.write(chunk)
+    except DecryptionError:
+        return False
+    return True
+
+
+def encrypt_content(text, password, compression=None, level=None):
+    if sys.version_info[0] > 2:
+        # Python3
+        text = text.encode("utf-8")
+    return b''.join(
+        iter_encrypt(io.BytesIO(text), password, compression, level)
+    )
+
+
+def decript_content(text_cipher, password):
+    """Return text and True if decryption worked"""
+    if not isinstance(text_cipher, bytes):
+        # Back-end decoded it
+        text_cipher = text_cipher.encode("utf-8")
+    try:
+        text = b''.join(iter_decrypt([text_cipher], password))
+    except DecryptionError:
+        return text_cipher, False
     if sys.version_info[0] > 2:
         # Python3
         try:
-            items = headed_text.decode("utf-8").split('\n')
-            header = items[0].rstrip()
-            text = "\n".join(items[1:])
+            text = text.decode("utf-8")
         except UnicodeDecodeError:
-            items = None
-            header = None
-            text = headed_text
-    else:
-        # Python2
-        items = headed_text.split('\n')
-        header = items[0].rstrip()
-        text = "\n".join(items[1:])
+            return text, False
+    return text, True
 
-    return text, (
-        header == HEADER or
-        header == "# this was encripted"  # Hack pre v0.0.6, autofix
-    )
 
+def _get_digest(basename, md5_hash):
+    """Hex digest of a basename, memoized"""
 
-def get_path_hash(path_str, md5_hash=False):
+    key = (basename, md5_hash)
+    with _DIGESTS_LOCK:
+        digest = _DIGESTS.pop(key, None)
+        if digest is not None:
+            _DIGESTS[key] = digest
+            return digest
 
-    dirname = os.path.dirname(path_str)
-    basename = os.path.basename(path_str)
-    #
     if md5_hash:
         h = MD5.new()
     else:
         h = hashlib.sha256()
-
     if sys.version_info[0] > 2:
         # Python3
         h.update(basename.encode("utf-8"))
     else:
         # Python2
         h.update(basename)
+    digest = h.hexdigest()
+
+    with _DIGESTS_LOCK:
+        _DIGESTS[key] = digest
+        while len(_DIGESTS) > PATH_HASH_CACHE_SIZE:
+            _DIGESTS.popitem(last=False)
+    return digest
+
+
+def get_path_hash(path_str, md5_hash=False):
+
+    dirname = os.path.dirname(path_str)
+    basename = os.path.basename(path_str)
+    digest = _get_digest(basename, md5_hash)
     if dirname != '/':
-        return "%s/.%s" % (dirname, h.hexdigest())
+        return "%s/.%s" % (dirname, digest)
     else:
-        return "/.%s" % h.hexdigest()
+        return "/.%s" % digest
+
+
+def get_path_hashes(paths, md5_hash=False):
+    """Hashed names of several paths e.g. all entries of a folder listing"""
+    return [get_path_hash(path, md5_hash=md5_hash) for path in paths]
+
+
+def is_hashed_name(path_str):
+    """Check if path has a name given by get_path_hash, old or new"""
+    return bool(HASHED_NAME_REGEX.match(os.path.basename(path_str)))
 
 
 def is_encrypted_path(path_str):
     """Check if path is that of an encrypted file"""
     basename = os.path.basename(path_str)
-    return re.match('\.[a-z0-9]', basename) and len(basename) == 33
+    return bool(ENCRYPTED_NAME_REGEX.match(basename)) and len(basename) == 33
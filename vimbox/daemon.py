@@ -0,0 +1,201 @@
+"""
+Optional vimbox daemon, refered as vimboxd in setup.py
+
+Keeps a VimboxClient, and with it the back-end HTTP session, alive and serves
+commands that need no terminal (no editor, no password prompt) over a UNIX
+socket. vimbox.cli forwards those commands here when the daemon is running
+and runs them in process otherwise.
+
+Protocol is one JSON line per connection in each direction
+
+    {"args": ["ls", "/notes/"]}
+    {"output": "...", "return": true}
+
+A null return means the command needs a terminal after all (e.g. cat of an
+encrypted file without a kept password) and has to be run in process.
+
+While idle, it also sends changes made offline every FLUSH_INTERVAL seconds
+(see VimboxClient.flush_outbox).
+"""
+import os
+import sys
+import json
+import errno
+import socket
+import traceback
+from vimbox import ROOT_FOLDER, CONFIG_FILE
+
+SOCKET_FILE = '%s/vimboxd.sock' % ROOT_FOLDER
+# Commands that can be served by the daemon
+DAEMON_COMMANDS = ['ls', 'cat', 'cp', 'mv', 'rm', 'mkdir']
+# Seconds between attempts to send changes made offline
+FLUSH_INTERVAL = 60
+# Seconds a client can take to send its request, the daemon serves one at
+# a time
+RECEIVE_TIMEOUT = 5
+
+
+def _receive(connection):
+    chunks = []
+    while True:
+        chunk = connection.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+def _send(connection, message):
+    connection.sendall(json.dumps(message).encode('utf-8'))
+    connection.shutdown(socket.SHUT_WR)
+
+
+def forward(args, socket_file=None):
+    """
+    Run command in the daemon and print its output. Returns None if there
+    is no daemon running or the command has to be run in process.
+    """
+
+    if socket_file is None:
+        socket_file = SOCKET_FILE
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_file)
+    except socket.error as exception:
+        connection.close()
+        if exception.errno in [errno.ENOENT, errno.ECONNREFUSED]:
+            # No daemon (or a stale socket file)
+            return None
+        raise
+
+    try:
+        _send(connection, {'args': args})
+        response = _receive(connection)
+    finally:
+        connection.close()
+
+    if response['output']:
+        sys.stdout.write(response['output'])
+    return response['return']
+
+
+def run_command(client, args):
+    """
+    Run one command with the warm client, return output and result. Result
+    is None if the command needs a terminal
+    """
+
+    from vimbox import VimboxTerminalNeeded
+    from vimbox.__main__ import main as vimbox_main
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        # Python3
+        from io import StringIO
+
+    # Commands run in other processes may have changed cache and path hashes
+    client.reload_config()
+
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    needs_terminal = False
+    try:
+        result = vimbox_main(
+            args,
+            config_path=client.config_path,
+            verbose=client.verbose,
+            client=client
+        )
+    except VimboxTerminalNeeded:
+        needs_terminal = True
+    except (Exception, SystemExit):
+        # Keep serving, but tell the user
+        print(traceback.format_exc())
+        result = False
+    finally:
+        output = sys.stdout.getvalue()
+        sys.stdout = stdout
+
+    if needs_terminal:
+        # Partial output would be repeated when run in process
+        return '', None
+    return output, bool(result)
+
+
+def serve(config_path=None, socket_file=None):
+
+    from vimbox.remote.primitives import VimboxClient
+
+    if config_path is None:
+        config_path = CONFIG_FILE
+    if socket_file is None:
+        socket_file = SOCKET_FILE
+
+    client = VimboxClient(config_path=config_path)
+    # Prompts would be written to the daemon log and wait for ever
+    client.interactive = False
+
+    # Remove stale socket of a previous daemon
+    if os.path.exists(socket_file):
+        os.remove(socket_file)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the user can talk to the daemon
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(socket_file)
+    finally:
+        os.umask(old_umask)
+    server.listen(5)
+    server.settimeout(FLUSH_INTERVAL)
+
+    try:
+        while True:
+            try:
+                connection, _ = server.accept()
+            except socket.timeout:
+                # Idle, the outbox keeps its own retry backoff
+                try:
+                    client.reload_config()
+                    client.flush_outbox()
+                except Exception:
+                    print(traceback.format_exc())
+                continue
+            connection.settimeout(RECEIVE_TIMEOUT)
+            try:
+                try:
+                    request = _receive(connection)
+                    command = request['args'][0]
+                    if command in DAEMON_COMMANDS:
+                        output, result = run_command(client, request['args'])
+                    else:
+                        output = "vimboxd can not run %s\n" % command
+                        result = False
+                except socket.error:
+                    raise
+                except (Exception, SystemExit):
+                    # Malformed request or bug, keep serving
+                    output = "vimboxd error:\n%s" % traceback.format_exc()
+                    result = False
+                _send(connection, {'output': output, 'return': result})
+            except socket.error:
+                # Client went away
+                pass
+            finally:
+                connection.close()
+    finally:
+        server.close()
+        if os.path.exists(socket_file):
+            os.remove(socket_file)
+
+
+def main():
+    print("vimboxd listening on %s (Ctrl-C to stop)" % SOCKET_FILE)
+    try:
+        serve()
+    except KeyboardInterrupt:
+        print("\nvimboxd stopped")
+
+
+if __name__ == "__main__":
+    main()
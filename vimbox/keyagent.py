@@ -0,0 +1,61 @@
+"""
+Key agent: passwords of encrypted files kept in memory for a while, so that
+a session opening many encrypted files asks for them once
+
+A password is stored for a folder, and then tried on every encrypted file
+inside it, or for a single file whose password differs from the one of its
+folder. Passwords expire after a timeout and are never written to disk.
+"""
+import os
+import time
+from vimbox import crypto
+
+
+def get_scopes(remote_file):
+    """File and its parent folders, nearest first"""
+    scopes = [remote_file]
+    path = remote_file.rstrip('/')
+    while path:
+        path = os.path.dirname(path)
+        if path == '/':
+            scopes.append('/')
+            break
+        scopes.append('%s/' % path)
+    return scopes
+
+
+class KeyAgent(object):
+
+    def __init__(self, timeout=900):
+        # Seconds a password is kept, 0 keeps none
+        self.timeout = timeout
+        # file or folder: [password, time it expires]
+        self.passwords = {}
+
+    def add(self, remote_path, password):
+        """Remember the password of a file, or of the files in a folder/"""
+        if self.timeout <= 0:
+            return
+        # Reject invalid passwords before keeping them
+        crypto.validate_password(password)
+        self.passwords[remote_path] = [password, time.time() + self.timeout]
+
+    def get(self, remote_file):
+        """Password of a file or of its nearest folder, None if unknown"""
+        now = time.time()
+        for scope in get_scopes(remote_file):
+            entry = self.passwords.get(scope)
+            if entry is None:
+                continue
+            elif entry[1] <= now:
+                del self.passwords[scope]
+                continue
+            return entry[0]
+        return None
+
+    def forget(self, remote_path=None):
+        """Drop the password of a file or folder, all of them by default"""
+        if remote_path is None:
+            self.passwords = {}
+        else:
+            self.passwords.pop(remote_path, None)
@@ -1,35 +1,58 @@
 import os
 import sys
+import json
 import yaml
+import hashlib
 import subprocess
 # vimbox modules
 from vimbox import crypto
 from vimbox import diogenes
+from vimbox import complete
+from vimbox import state
+# Config location is computed in vimbox/__init__.py
+from vimbox import ROOT_FOLDER, CONFIG_FILE
 
-# Locate the vimbox config. If we are inside a virtual environment look for it
-# inside
-if hasattr(sys, 'real_prefix'):
-    ROOT_FOLDER = "%s/.vimbox/" % sys.prefix
-else:
-    ROOT_FOLDER = "%s/.vimbox/" % os.environ['HOME']
-CONFIG_FILE = '%s/config.yml' % ROOT_FOLDER
 # Flag to indicate if it is installed
 DEFAULT_CONFIG = {
     # This will store the dropbox token (no need to add it manually here!)
     'DROPBOX_TOKEN': None,
     # This will be appended to local paths
     'local_root': '%s/DATA' % ROOT_FOLDER,
-    # This will store the local cache
+    # This will store the local cache (kept in the state journal)
     'cache': [],
-    # This will store dict() s of hash: file_path for encripted files
+    # This will store dict() s of hash: file_path for encripted files (kept in
+    # the state journal as a state.PathHashes registry)
     'path_hashes': {},
     # By default remove all synced files
     'remove_local': False,
     # Backend (right now dropbox or fake)
     'backend_name': 'dropbox',
     # Experimental paper token
-    'paper_token': None
+    'paper_token': None,
+    # Seconds remote metadata (file type, content hash, revision) is trusted
+    # without asking the back-end
+    'metadata_ttl': 60,
+    # Maximum number of remote paths in the metadata cache
+    'metadata_cache_size': 1000,
+    # Seconds to wait before sending changes made offline again after a
+    # connection error, doubled on each failure up to outbox_retry_max
+    'outbox_retry_base': 30,
+    'outbox_retry_max': 3600,
+    # Seconds passwords of encrypted files are kept in memory by a client
+    # (see vimbox.keyagent), 0 to always ask
+    'key_agent_timeout': 900,
+    # Compression of encrypted files before encrypting them, None, 'zlib' or
+    # 'zstd' (needs zstandard). Level None is the default of each
+    'compression': 'zlib',
+    'compression_level': None
 }
+# Fields that are stored in the state journal, not in the yaml
+STATE_KEYS = ['cache', 'path_hashes']
+# Batches of state changes waiting to be written, by id of config (see
+# start_batch)
+BATCHES = {}
+# Dropbox content hash is computed over blocks of this size
+CONTENT_HASH_BLOCK_SIZE = 4 * 1024 * 1024
 EDITTOOL = 'vim'
 MERGETOOL = 'vimdiff'
 
@@ -65,18 +88,85 @@ def modify_bashrc(virtualenv):
 
 
 def write_config(file_path, config):
+    """
+    Write user editable settings to the yaml and a snapshot of cache and path
+    hashes to the state journal. Use update_state() for small changes.
+    """
     # Ensure str s in the cache
     config['cache'] = sorted(set(map(str, config['cache'])))
+    settings = dict(
+        (key, value) for key, value in config.items()
+        if key not in STATE_KEYS
+    )
     with open(file_path, 'w') as fid:
-        yaml.dump(config, fid, default_flow_style=False)
+        yaml.dump(settings, fid, default_flow_style=False)
+    state.write_state(
+        state.get_state_file(file_path),
+        config['cache'],
+        config['path_hashes']
+    )
+    # Keep the file read by vimbox complete at shell start-up in sync
+    complete.write_complete_file(config['cache'], file_path)
 
 
 def read_config(file_path):
     with open(file_path, 'r') as fid:
         config = yaml.load(fid)
+    # Cache and path hashes. Configs without journal store them in the yaml
+    state_file = state.get_state_file(file_path)
+    if os.path.isfile(state_file):
+        config['cache'], config['path_hashes'] = state.read_state(state_file)
+    # Indexed in both directions and by folder
+    config['path_hashes'] = state.PathHashes(config.get('path_hashes', {}))
     return config
 
 
+def update_state(file_path, config, changes):
+    """
+    Apply changes (see vimbox.state) to cache and path hashes of the config
+    and append them to its state journal
+    """
+    if not changes:
+        return
+    state.apply_changes(config['cache'], config['path_hashes'], changes)
+    if id(config) in BATCHES:
+        # Will be written by flush_batch()
+        BATCHES[id(config)]['changes'].extend(changes)
+    else:
+        write_state_changes(file_path, config, changes)
+
+
+def write_state_changes(file_path, config, changes):
+    state.append_state(state.get_state_file(file_path), changes)
+    if any(change[0] in ['add-cache', 'remove-cache'] for change in changes):
+        complete.write_complete_file(config['cache'], file_path)
+
+
+def start_batch(file_path, config):
+    """
+    Keep state changes of this config in memory until flush_batch(). Batches
+    can be nested, only the outermost flush writes.
+    """
+    if id(config) in BATCHES:
+        BATCHES[id(config)]['depth'] += 1
+    else:
+        BATCHES[id(config)] = {
+            'file_path': file_path,
+            'changes': [],
+            'depth': 1
+        }
+
+
+def flush_batch(config):
+    """Write state changes held since start_batch() as one transaction"""
+    batch = BATCHES[id(config)]
+    batch['depth'] -= 1
+    if batch['depth'] == 0:
+        del BATCHES[id(config)]
+        if batch['changes']:
+            write_state_changes(batch['file_path'], config, batch['changes'])
+
+
 def edit_config():
     edittool(CONFIG_FILE)
 
@@ -115,6 +205,10 @@ def load_config(config_path=None):
                 ", ".join(outdated_fields)
             )
 
+    # Config from older version, move cache and path hashes out of the yaml
+    if not os.path.isfile(state.get_state_file(config_path)):
+        write_config(config_path, config)
+
     return config
 
 
@@ -130,7 +224,15 @@ def get_cache():
 
 
 def get_complete_arguments():
-    return ['setup', 'cache', 'config', 'ls', 'cp', 'mv', 'rm'] + get_cache()
+    cache = get_cache()
+    # Config from older versions has no completion file. Create it so next
+    # shell start-up can use the fast path in vimbox.cli
+    if (
+        os.path.isfile(CONFIG_FILE) and
+        complete.read_complete_file(CONFIG_FILE) is None
+    ):
+        complete.write_complete_file(cache, CONFIG_FILE)
+    return complete.COMMANDS + cache
 
 
 def register_file(remote_file, config, is_encripted):
@@ -142,7 +244,7 @@ def register_file(remote_file, config, is_encripted):
 
     assert remote_file, "file to register cannot be empty path"
 
-    rewrite_config = False
+    changes = []
 
     # Register folder in cache
     if remote_file[-1] == '/':
@@ -151,8 +253,7 @@ def register_file(remote_file, config, is_encripted):
         remote_folder = "%s/" % os.path.dirname(remote_file)
     # if not is_registered and list(set(remote_folder))[0] != '/':
     if remote_folder not in config['cache']:
-        config['cache'].append(remote_folder)
-        rewrite_config = True
+        changes.append(['add-cache', remote_folder])
         # update cache in system
         print("Added to cache %s" % remote_folder)
 
@@ -160,41 +261,63 @@ def register_file(remote_file, config, is_encripted):
     if is_encripted:
         remote_file_hash = crypto.get_path_hash(remote_file)
         if remote_file_hash not in config['path_hashes']:
-            config['path_hashes'][remote_file_hash] = remote_file
-            rewrite_config = True
+            changes.append(['add-hash', remote_file_hash, remote_file])
             print("Added to hash list %s" % remote_file)
 
-    if rewrite_config:
-        write_config(CONFIG_FILE, config)
+    update_state(CONFIG_FILE, config, changes)
 
 
 def unregister_file(remote_file, config):
 
-    rewrite_config = False
+    changes = []
 
     # Unregister folder from cache
     if remote_file[-1] == '/':
         remote_folder = remote_file
-        rewrite_config = False
         if remote_folder in config['cache']:
-            config['cache'].remove(remote_folder)
-            rewrite_config = True
+            changes.append(['remove-cache', remote_folder])
             print("Removed from cache %s" % remote_folder)
     else:
         # We could check if it is empty in remote and unregister it but it will
         # be too expensive
         pass
 
-    # Unregister file hash
-    for fhash, fname in list(config['path_hashes'].items()):
-        # Remove any matching folder or folder contained in it
-        if remote_file == fname[:len(remote_file)]:
-            print("Removed from hash list %s" % fname)
-            del config['path_hashes'][fhash]
-            rewrite_config = True
+    # Unregister file hash of the file or of any file contained in folder
+    for fhash, fname in config['path_hashes'].under(remote_file):
+        print("Removed from hash list %s" % fname)
+        changes.append(['remove-hash', fhash])
 
-    if rewrite_config:
-        write_config(CONFIG_FILE, config)
+    update_state(CONFIG_FILE, config, changes)
+
+
+def move_registration(remote_source, remote_target, config):
+    """
+    Move cache and hash list entries of a moved file or folder, as a single
+    state change
+    """
+
+    changes = []
+
+    # Register target folder in cache, unregister a moved folder
+    if remote_target[-1] == '/':
+        remote_folder = remote_target
+    else:
+        remote_folder = "%s/" % os.path.dirname(remote_target)
+    if remote_folder not in config['cache']:
+        changes.append(['add-cache', remote_folder])
+        print("Added to cache %s" % remote_folder)
+    if remote_source[-1] == '/' and remote_source in config['cache']:
+        changes.append(['remove-cache', remote_source])
+        print("Removed from cache %s" % remote_source)
+
+    # Rename hash of the file or of any file contained in folder
+    for fhash, fname in config['path_hashes'].under(remote_source):
+        new_name = remote_target + fname[len(remote_source):]
+        changes.append(['remove-hash', fhash])
+        changes.append(['add-hash', crypto.get_path_hash(new_name), new_name])
+        print("Moved hash %s -> %s" % (fname, new_name))
+
+    update_state(CONFIG_FILE, config, changes)
 
 
 def get_local_file(remote_file, config=None):
@@ -224,6 +347,136 @@ def get_local_content(remote_file, config):
     return local_file, local_content
 
 
+class ContentHasher(object):
+    """Dropbox content hash of data given in chunks of any size"""
+
+    def __init__(self):
+        self.block_hashes = []
+        self.block = hashlib.sha256()
+        self.block_size = 0
+
+    def update(self, data):
+        while data:
+            taken = data[:CONTENT_HASH_BLOCK_SIZE - self.block_size]
+            data = data[len(taken):]
+            self.block.update(taken)
+            self.block_size += len(taken)
+            if self.block_size == CONTENT_HASH_BLOCK_SIZE:
+                self.block_hashes.append(self.block.digest())
+                self.block = hashlib.sha256()
+                self.block_size = 0
+
+    def hexdigest(self):
+        block_hashes = list(self.block_hashes)
+        if self.block_size:
+            block_hashes.append(self.block.digest())
+        return hashlib.sha256(b''.join(block_hashes)).hexdigest()
+
+
+def get_content_hash(file_path):
+    """Dropbox content hash: SHA-256 of concatenated SHA-256 of 4MB blocks"""
+    hasher = ContentHasher()
+    with open(file_path, 'rb') as fid:
+        while True:
+            block = fid.read(CONTENT_HASH_BLOCK_SIZE)
+            if not block:
+                break
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def get_content_hash_file(config_file):
+    """Local content hashes of a config e.g. config.yml -> config.hashes"""
+    return '%s.hashes' % os.path.splitext(config_file)[0]
+
+
+class ContentHashIndex(object):
+    """
+    Content hashes of local files. A hash is reused while the (mtime, size)
+    of the file are unchanged, so unchanged files are not read again.
+
+    Also keeps the hash each local file had when it was last in sync with the
+    remote. If it still has it, the local copy was not edited since.
+    """
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        # local file: [mtime, size, content hash]
+        self.hashes = {}
+        # local file: content hash when last in sync
+        self.synced = {}
+        self.dirty = False
+        if os.path.isfile(index_file):
+            try:
+                with open(index_file, 'r') as fid:
+                    data = json.load(fid)
+                self.hashes = data['hashes']
+                self.synced = data['synced']
+            except (ValueError, KeyError):
+                # Corrupted index, start from scratch
+                pass
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_file = '%s.tmp' % self.index_file
+        with open(tmp_file, 'w') as fid:
+            json.dump({'hashes': self.hashes, 'synced': self.synced}, fid)
+        os.rename(tmp_file, self.index_file)
+        self.dirty = False
+
+    def get(self, local_file):
+        """Content hash of a local file, None if it does not exist"""
+        if not os.path.isfile(local_file):
+            if self.hashes.pop(local_file, None) is not None:
+                self.dirty = True
+            return None
+        stat = os.stat(local_file)
+        entry = self.hashes.get(local_file)
+        if entry is not None and entry[:2] == [stat.st_mtime, stat.st_size]:
+            return entry[2]
+        content_hash = get_content_hash(local_file)
+        self.hashes[local_file] = [stat.st_mtime, stat.st_size, content_hash]
+        self.dirty = True
+        return content_hash
+
+    def set(self, local_file, content_hash):
+        """Store a hash computed while writing the file (see ContentHasher)"""
+        stat = os.stat(local_file)
+        self.hashes[local_file] = [stat.st_mtime, stat.st_size, content_hash]
+        self.dirty = True
+
+    def set_synced(self, local_file):
+        """Record that the local file is now in sync with the remote"""
+        content_hash = self.get(local_file)
+        if content_hash is None:
+            if self.synced.pop(local_file, None) is not None:
+                self.dirty = True
+        elif self.synced.get(local_file) != content_hash:
+            self.synced[local_file] = content_hash
+            self.dirty = True
+
+    def move(self, local_source, local_target):
+        """Follow a renamed file, or the files of a renamed folder"""
+        for entries in [self.hashes, self.synced]:
+            for local_file in list(entries):
+                if local_file == local_source or (
+                    local_source[-1] == '/' and
+                    local_file.startswith(local_source)
+                ):
+                    new_file = local_target + local_file[len(local_source):]
+                    entries[new_file] = entries.pop(local_file)
+                    self.dirty = True
+
+    def is_unedited(self, local_file):
+        """True if the local file did not change since it was last in sync"""
+        content_hash = self.get(local_file)
+        return (
+            content_hash is not None and
+            self.synced.get(local_file) == content_hash
+        )
+
+
 def write_file(file_path, content):
     with open(file_path, 'w') as fid_local:
         fid_local.write(content)
@@ -301,7 +554,7 @@ def list_local(remote_file, config):
         if is_folder:
             new_display_folders.append(os.path.basename(file_folder) + '/')
         else:
-            if "%s%s" % (remote_file, file_folder) in path_hashes.values():
+            if path_hashes.has_path("%s%s" % (remote_file, file_folder)):
                 # Display encripted files in red
                 file_folder = red(file_folder)
             new_display_folders.append(os.path.basename(file_folder))
@@ -0,0 +1,124 @@
+"""
+Outbox: remote changes made while offline, waiting to be sent
+
+Kept in an append-only journal next to config.yml, one JSON list per line
+
+    ["add", <id>, "push", "/path/to/file", <rev>]
+    ["add", <id>, "remove", "/path/to/file", <rev>]
+    ["add", <id>, "copy", "/path/to/file", "/path/to/file2"]
+    ["done", <id>]
+    ["retry", <attempts>, <time of next attempt>]
+
+Operations are sent in the order they were added (see
+VimboxClient.flush_outbox). Pushes read the local copy when sent, rev is the
+remote revision the change is based on so that remote changes made meanwhile
+are detected. Flushes that fail for lack of connection are retried with
+exponential backoff. The journal is emptied once everything was sent.
+"""
+import os
+import json
+import time
+import uuid
+import fcntl
+from collections import OrderedDict
+from contextlib import contextmanager
+from vimbox.state import locked
+
+
+def get_outbox_file(config_file):
+    """Outbox of a given config e.g. config.yml -> config.outbox"""
+    return '%s.outbox' % os.path.splitext(config_file)[0]
+
+
+class Outbox(object):
+
+    def __init__(self, outbox_file, retry_base=30, retry_max=3600):
+        self.outbox_file = outbox_file
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+
+    def _replay(self):
+        """Pending operations by id, attempts and time of next attempt"""
+        pending = OrderedDict()
+        attempts = 0
+        next_try = 0
+        if not os.path.isfile(self.outbox_file):
+            return pending, attempts, next_try
+        with open(self.outbox_file, 'r') as fid:
+            for line in fid:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Interrupted write of the last record
+                    continue
+                if record[0] == 'add':
+                    pending[record[1]] = record[2:]
+                elif record[0] == 'done':
+                    pending.pop(record[1], None)
+                elif record[0] == 'retry':
+                    attempts, next_try = record[1:]
+                else:
+                    raise ValueError("Unknown outbox record %s" % record[0])
+        return pending, attempts, next_try
+
+    def _append(self, record):
+        with locked(self.outbox_file):
+            with open(self.outbox_file, 'a+') as fid:
+                # Close a half written last line so this one can be replayed
+                fid.seek(0, os.SEEK_END)
+                if fid.tell():
+                    fid.seek(fid.tell() - 1)
+                    if fid.read(1) != '\n':
+                        fid.write('\n')
+                fid.write('%s\n' % json.dumps(record))
+                fid.flush()
+                os.fsync(fid.fileno())
+
+    def add(self, operation, *args):
+        """Queue an operation, a push already queued for a file is reused"""
+        if operation == 'push':
+            for pending in self._replay()[0].values():
+                if pending[:2] == ['push', args[0]]:
+                    return
+        self._append(['add', uuid.uuid4().hex, operation] + list(args))
+
+    def pending(self):
+        """List of (id, operation, arguments) in the order they were added"""
+        return [
+            (record_id, record[0], record[1:])
+            for record_id, record in self._replay()[0].items()
+        ]
+
+    def done(self, record_id):
+        self._append(['done', record_id])
+
+    def is_due(self):
+        """False while waiting to retry after a connection error"""
+        return time.time() >= self._replay()[2]
+
+    def retry_later(self):
+        """Back off exponentially, return seconds until the next attempt"""
+        attempts = self._replay()[1]
+        delay = min(self.retry_base * 2 ** attempts, self.retry_max)
+        self._append(['retry', attempts + 1, time.time() + delay])
+        return delay
+
+    def clear(self):
+        """Empty the journal if everything was sent"""
+        with locked(self.outbox_file):
+            if os.path.isfile(self.outbox_file) and not self._replay()[0]:
+                os.remove(self.outbox_file)
+
+    @contextmanager
+    def flushing(self):
+        """Yield False if another process is flushing this outbox already"""
+        with open('%s.flush' % self.outbox_file, 'a') as lock_fid:
+            try:
+                fcntl.flock(lock_fid, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_fid, fcntl.LOCK_UN)
@@ -1,13 +1,33 @@
+import io
 import os
 import sys
+import time
 #
 import dropbox
 from dropbox.exceptions import ApiError
-from dropbox.files import WriteMode
-from requests.exceptions import ConnectionError
+from dropbox.files import (
+    WriteMode,
+    FileMetadata,
+    FolderMetadata,
+    CommitInfo,
+    UploadSessionCursor,
+    RelocationPath,
+    DeleteArg
+)
+from requests.exceptions import ConnectionError, Timeout
 #
 from vimbox import local, __version__
 
+# Uploads larger than this are sent in chunks of this size through an upload
+# session. Single uploads are limited to 150 MB by the API
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Downloads to file are written in chunks of this size
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Maximum entries of a copy, move or delete batch allowed by the API
+BATCH_SIZE = 1000
+# Seconds between checks of an asynchronous batch job
+BATCH_POLL_INTERVAL = 0.5
+
 
 def install_backend(config_file, default_config):
 
@@ -19,17 +39,22 @@ def install_backend(config_file, default_config):
 
         # check for updated hashes from < v0.5.0
         if int(__version__.split('.')[1]) >= 5:
-            from vimbox.crypto import get_path_hash
+            from vimbox.crypto import get_path_hashes
             client = StorageBackEnd(config['DROPBOX_TOKEN'])
-            old_hashes = config['path_hashes'].items()
+            old_hashes = list(config['path_hashes'].items())
+            new_dhashes = get_path_hashes([path for _, path in old_hashes])
             new_hashes = []
-            for dhash, path in old_hashes:
-                new_dhash = get_path_hash(path, md5_hash=False)
+            moves = []
+            for (dhash, path), new_dhash in zip(old_hashes, new_dhashes):
                 if dhash != new_dhash:
-                    # Change remote path
-                    client.files_copy(dhash, new_dhash)
-                    client.files_delete(dhash)
+                    moves.append((dhash, new_dhash))
                     new_hashes.append((str(new_dhash), str(path)))
+            # Change remote paths, all in one batch
+            if moves:
+                response = client.files_move_batch(moves)
+                if response['status'] != 'online':
+                    print("Could not update hashes %s" % response['status'])
+                    exit(1)
             config['path_hashes'] = dict(new_hashes)
             local.write_config(config_file, config)
             print("Updated %d hashes" % len(new_hashes))
@@ -73,10 +98,39 @@ def install_backend(config_file, default_config):
             print("Created config in %s" % config_file)
 
 
+def get_metadata(entry):
+    """Back-end independent metadata of a dropbox metadata object"""
+    if isinstance(entry, FileMetadata):
+        return {
+            'type': 'file',
+            'content_hash': entry.content_hash,
+            'rev': entry.rev,
+            'size': entry.size
+        }
+    elif isinstance(entry, FolderMetadata):
+        return {'type': 'dir', 'content_hash': None, 'rev': None, 'size': None}
+    else:
+        # DeletedMetadata
+        return None
+
+
+def is_write_conflict(upload_error):
+    """True if an upload failed because the remote file changed"""
+    # Errors of session start and append have no path
+    if not hasattr(upload_error, 'is_path') or not upload_error.is_path():
+        return False
+    # UploadWriteFailed in newer SDKs, WriteError in older ones
+    write_error = getattr(upload_error.get_path(), 'reason', None)
+    if write_error is None:
+        write_error = upload_error.get_path()
+    return write_error.is_conflict()
+
+
 class StorageBackEnd():
 
     def __init__(self, dropbox_token):
         self.dropbox_client = dropbox.Dropbox(dropbox_token)
+        self.upload_chunk_size = UPLOAD_CHUNK_SIZE
 
     def get_user_account(self):
         """Provide info on users current account"""
@@ -103,21 +157,83 @@ class StorageBackEnd():
 
         return {'status': status, 'content': user, 'alert': out_message}
 
-    def files_upload(self, new_local_content, remote_file_hash):
+    def _upload_session(self, fid, size, remote_file_hash, mode,
+                        progress=None):
+        """Upload from a file object in chunks, memory use is one chunk"""
+        chunk = fid.read(self.upload_chunk_size)
+        session = self.dropbox_client.files_upload_session_start(chunk)
+        cursor = UploadSessionCursor(
+            session_id=session.session_id,
+            offset=len(chunk)
+        )
+        commit = CommitInfo(path=remote_file_hash, mode=mode, autorename=False)
+        while True:
+            if progress:
+                progress(cursor.offset, size)
+            chunk = fid.read(self.upload_chunk_size)
+            if cursor.offset + len(chunk) >= size:
+                result = self.dropbox_client.files_upload_session_finish(
+                    chunk,
+                    cursor,
+                    commit
+                )
+                if progress:
+                    progress(size, size)
+                return result
+            self.dropbox_client.files_upload_session_append_v2(chunk, cursor)
+            cursor.offset += len(chunk)
+
+    def files_upload(self, new_local_content, remote_file_hash, rev=None,
+                     progress=None):
+        """
+        Uploads file to the remote
+
+        rev is the revision the new content is based on. If the remote
+        changed since, nothing is written and status is 'conflict'. Use an
+        empty rev for files that should not exist yet and None to overwrite
+
+        new_local_content can be bytes or a binary file object. Above
+        upload_chunk_size it is sent in chunks, calling progress(sent, size)
+        after each one
+        """
         assert remote_file_hash[-1] != '/', \
             "Dropbox paths can not finish in /"
-        """Overwrites file in the remote"""
+
+        if rev is None:
+            mode = WriteMode('overwrite')
+        elif rev == '':
+            mode = WriteMode('add')
+        else:
+            mode = WriteMode('update', rev)
 
         out_message = ''
+        metadata = None
         try:
 
             # Upload file to the server
-            self.dropbox_client.files_upload(
-                new_local_content,
-                remote_file_hash,
-                mode=WriteMode('overwrite')
-            )
-            status = None
+            if hasattr(new_local_content, 'read'):
+                fid = new_local_content
+                size = os.fstat(fid.fileno()).st_size
+            else:
+                fid = io.BytesIO(new_local_content)
+                size = len(new_local_content)
+            if size > self.upload_chunk_size:
+                result = self._upload_session(
+                    fid,
+                    size,
+                    remote_file_hash,
+                    mode,
+                    progress=progress
+                )
+            else:
+                result = self.dropbox_client.files_upload(
+                    fid.read(),
+                    remote_file_hash,
+                    mode=mode,
+                    autorename=False
+                )
+            metadata = get_metadata(result)
+            status = 'online'
 
         except ConnectionError:
 
@@ -128,10 +244,13 @@ class StorageBackEnd():
 
             # API status
             out_message = exception
-            # File non-existing or unreachable
-            status = 'api-error'
+            if is_write_conflict(exception.error):
+                # Remote changed since rev
+                status = 'conflict'
+            else:
+                status = 'api-error'
 
-        return {'status': status, 'content': None, 'alert': out_message}
+        return {'status': status, 'content': metadata, 'alert': out_message}
 
     def make_directory(self, remote_target):
         assert remote_target[-1] != '/', "Dropbox paths can not finish in /"
@@ -170,6 +289,26 @@ class StorageBackEnd():
                 status = 'api-error'
         return {'status': status, 'content': None, 'alert': out_message}
 
+    def files_move(self, remote_source, remote_target):
+        """Move or rename server side, fails if the target exists"""
+        assert remote_source[-1] != '/', "Dropbox paths can not finish in /"
+        assert remote_target[-1] != '/', "Dropbox paths can not finish in /"
+        out_message = ''
+        try:
+            self.dropbox_client.files_move_v2(
+                remote_source,
+                remote_target,
+                autorename=False
+            )
+            status = 'online'
+        except ConnectionError:
+            # This can be missleading
+            status = 'connection-error'
+        except ApiError as exception:
+            out_message = exception
+            status = 'api-error'
+        return {'status': status, 'content': None, 'alerts': out_message}
+
     def files_delete(self, remote_source):
         assert remote_source[-1] != '/', "Dropbox paths can not finish in /"
         out_message = ''
@@ -187,6 +326,128 @@ class StorageBackEnd():
                 status = 'api-error'
         return {'status': status, 'content': None, 'alert': out_message}
 
+    def _batch_job(self, launch, check):
+        """
+        Entries of a batch result, waiting for it if the server runs it as an
+        asynchronous job. None if the job failed as a whole
+        """
+        if launch.is_async_job_id():
+            job_id = launch.get_async_job_id()
+            while True:
+                launch = check(job_id)
+                if not launch.is_in_progress():
+                    break
+                time.sleep(BATCH_POLL_INTERVAL)
+        if launch.is_complete():
+            return launch.get_complete().entries
+        return None
+
+    def _relocation_batch(self, launch_batch, check_batch, entries):
+        """Copy or move (source, target) pairs in batches of BATCH_SIZE"""
+        statuses = []
+        out_message = ''
+        try:
+
+            for start in range(0, len(entries), BATCH_SIZE):
+                paths = []
+                for remote_source, remote_target in \
+                        entries[start:start + BATCH_SIZE]:
+                    assert remote_source[-1] != '/', \
+                        "Dropbox paths can not finish in /"
+                    assert remote_target[-1] != '/', \
+                        "Dropbox paths can not finish in /"
+                    paths.append(RelocationPath(remote_source, remote_target))
+                results = self._batch_job(
+                    launch_batch(paths, autorename=False),
+                    check_batch
+                )
+                if results is None:
+                    status = 'api-error'
+                    break
+                statuses.extend(
+                    'online' if result.is_success() else 'api-error'
+                    for result in results
+                )
+            else:
+                status = 'online'
+
+        except ConnectionError:
+            # This can be missleading
+            status = 'connection-error'
+        except ApiError as exception:
+            out_message = exception
+            status = 'api-error'
+
+        if status != 'online':
+            statuses = None
+        return {'status': status, 'content': statuses, 'alerts': out_message}
+
+    def files_copy_batch(self, entries):
+        """
+        Copy a list of (source, target) pairs server side with a handful of
+        calls. Content is the status of each pair ('online' or 'api-error')
+        """
+        return self._relocation_batch(
+            self.dropbox_client.files_copy_batch_v2,
+            self.dropbox_client.files_copy_batch_check_v2,
+            entries
+        )
+
+    def files_move_batch(self, entries):
+        """Same as files_copy_batch, but moving"""
+        return self._relocation_batch(
+            self.dropbox_client.files_move_batch_v2,
+            self.dropbox_client.files_move_batch_check_v2,
+            entries
+        )
+
+    def files_delete_batch(self, remote_sources):
+        """
+        Delete a list of paths server side with a handful of calls. Content
+        is the status of each path, paths that do not exist count as deleted
+        """
+        statuses = []
+        out_message = ''
+        try:
+
+            for start in range(0, len(remote_sources), BATCH_SIZE):
+                paths = []
+                for remote_source in remote_sources[start:start + BATCH_SIZE]:
+                    assert remote_source[-1] != '/', \
+                        "Dropbox paths can not finish in /"
+                    paths.append(DeleteArg(remote_source))
+                results = self._batch_job(
+                    self.dropbox_client.files_delete_batch(paths),
+                    self.dropbox_client.files_delete_batch_check
+                )
+                if results is None:
+                    status = 'api-error'
+                    break
+                for result in results:
+                    if result.is_success():
+                        statuses.append('online')
+                    elif (
+                        result.get_failure().is_path_lookup() and
+                        result.get_failure().get_path_lookup().is_not_found()
+                    ):
+                        # Gone already
+                        statuses.append('online')
+                    else:
+                        statuses.append('api-error')
+            else:
+                status = 'online'
+
+        except ConnectionError:
+            # This can be missleading
+            status = 'connection-error'
+        except ApiError as exception:
+            out_message = exception
+            status = 'api-error'
+
+        if status != 'online':
+            statuses = None
+        return {'status': status, 'content': statuses, 'alerts': out_message}
+
     def _get_meta_data(self, remote_source):
 
         try:
@@ -208,34 +469,105 @@ class StorageBackEnd():
 
         return result, status
 
-    def file_type(self, remote_source):
+    def file_metadata(self, remote_source):
         assert remote_source[-1] != '/', "Dropbox paths can not finish in /"
         # Note that with no connection we wont be able to know if the file
         # exists
         alert = ''
         try:
-            result = self.dropbox_client.files_alpha_get_metadata(
-                remote_source
+            metadata = get_metadata(
+                self.dropbox_client.files_alpha_get_metadata(remote_source)
             )
-            if hasattr(result, 'content_hash'):
-                file_type = 'file'
-            else:
-                file_type = 'dir'
             status = 'online'
         except ConnectionError:
             # This can be missleading
-            file_type = None
+            metadata = None
             status = 'connection-error'
-            file_exists = False
         except ApiError as exception:
-            file_type = None
+            metadata = None
             if type(exception.error._value).__name__ == 'LookupError':
                 status = 'online'
             else:
                 alert = exception
                 status = 'api-error'
 
-        return {'status': status, 'content': file_type, 'alert': alert}
+        return {'status': status, 'content': metadata, 'alerts': alert}
+
+    def files_metadata_batch(self, remote_paths):
+        """
+        Metadata of several paths, None for paths that do not exist
+
+        Dropbox has no batch call for metadata. Paths in the same folder, like
+        the plain and hashed names of a file, are looked up in the first page
+        of one listing of that folder. If the folder has more pages, paths not
+        found are looked up one by one, since paging through a large folder
+        for absent paths costs more.
+        """
+        folders = {}
+        for remote_path in remote_paths:
+            assert remote_path[-1] != '/', "Dropbox paths can not finish in /"
+            folder = os.path.dirname(remote_path)
+            if folder == '/':
+                # Root is the empty string for list_folder
+                folder = ''
+            folders.setdefault(folder, set()).add(remote_path.lower())
+        found = {}
+        out_message = ''
+        status = 'online'
+        for folder, missing in folders.items():
+            try:
+
+                result = self.dropbox_client.files_list_folder(folder)
+
+            except ConnectionError:
+
+                # Dropbox unrechable
+                status = 'connection-error'
+                break
+
+            except ApiError as exception:
+
+                # If the folder does not exist, neither do its paths
+                if type(exception.error._value).__name__ != 'LookupError':
+                    out_message = exception
+                    status = 'api-error'
+                    break
+                continue
+
+            for entry in result.entries:
+                if entry.path_lower in missing:
+                    found[entry.path_lower] = get_metadata(entry)
+                    missing.remove(entry.path_lower)
+            if not result.has_more:
+                continue
+            for remote_path in sorted(missing):
+                response = self.file_metadata(remote_path)
+                if response['status'] != 'online':
+                    status = response['status']
+                    out_message = response['alerts']
+                    break
+                found[remote_path] = response['content']
+            if status != 'online':
+                break
+
+        if status == 'online':
+            metadata = [found.get(path.lower()) for path in remote_paths]
+        else:
+            metadata = None
+
+        return {'status': status, 'content': metadata, 'alerts': out_message}
+
+    def file_type(self, remote_source):
+        response = self.file_metadata(remote_source)
+        if response['content'] is None:
+            file_type = None
+        else:
+            file_type = response['content']['type']
+        return {
+            'status': response['status'],
+            'content': file_type,
+            'alert': response['alerts']
+        }
 
     def file_download(self, remote_file):
         assert remote_file[-1] != '/', "Dropbox paths can not finish in /"
@@ -246,6 +578,7 @@ class StorageBackEnd():
             metadata, response = \
                 self.dropbox_client.files_download(remote_file)
             remote_content = response.content
+            metadata = get_metadata(metadata)
             status = 'online'
 
             if sys.version_info[0] > 2:
@@ -256,12 +589,14 @@ class StorageBackEnd():
 
             # Dropbox unrechable
             remote_content = None
+            metadata = None
             status = 'connection-error'
 
         except ApiError as exception:
 
             # File non-existing
             remote_content = None
+            metadata = None
             if type(exception.error._value).__name__ == 'LookupError':
                 status = 'online'
             else:
@@ -271,6 +606,104 @@ class StorageBackEnd():
         return {
             'status': status,
             'content': remote_content,
+            'metadata': metadata,
+            'alerts': out_message
+        }
+
+    def file_download_head(self, remote_file, size):
+        """
+        First size bytes of a file with a ranged download, None if it does
+        not exist
+        """
+        assert remote_file[-1] != '/', "Dropbox paths can not finish in /"
+        out_message = ''
+        try:
+
+            _, response = self.dropbox_client.files_download(
+                remote_file,
+                extra_headers={'Range': 'bytes=0-%d' % (size - 1)}
+            )
+            try:
+                # Servers may ignore the range, read no more than size
+                remote_content = response.raw.read(size)
+            finally:
+                response.close()
+            status = 'online'
+
+        except ConnectionError:
+
+            # Dropbox unrechable
+            remote_content = None
+            status = 'connection-error'
+
+        except ApiError as exception:
+
+            # File non-existing
+            remote_content = None
+            if type(exception.error._value).__name__ == 'LookupError':
+                status = 'online'
+            else:
+                out_message = exception
+                status = 'api-error'
+
+        return {
+            'status': status,
+            'content': remote_content,
+            'alerts': out_message
+        }
+
+    def file_download_to(self, remote_file, local_file):
+        """
+        Stream remote file into local_file chunk by chunk, hashing it on the
+        way. Content is local_file, None if the remote file does not exist
+        """
+        assert remote_file[-1] != '/', "Dropbox paths can not finish in /"
+        out_message = ''
+        content_hash = None
+        try:
+
+            metadata, response = \
+                self.dropbox_client.files_download(remote_file)
+            hasher = local.ContentHasher()
+            try:
+                with open(local_file, 'wb') as fid:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        fid.write(chunk)
+                        hasher.update(chunk)
+            finally:
+                response.close()
+            metadata = get_metadata(metadata)
+            content_hash = hasher.hexdigest()
+            if content_hash != metadata['content_hash']:
+                out_message = "Corrupted download of %s" % remote_file
+                status = 'api-error'
+            else:
+                status = 'online'
+            remote_content = local_file
+
+        except ConnectionError:
+
+            # Dropbox unrechable
+            remote_content = None
+            metadata = None
+            status = 'connection-error'
+
+        except ApiError as exception:
+
+            # File non-existing
+            remote_content = None
+            metadata = None
+            if type(exception.error._value).__name__ == 'LookupError':
+                status = 'online'
+            else:
+                out_message = exception
+                status = 'api-error'
+
+        return {
+            'status': status,
+            'content': remote_content,
+            'content_hash': content_hash,
+            'metadata': metadata,
             'alerts': out_message
         }
 
@@ -283,11 +716,17 @@ class StorageBackEnd():
 
             # Get user info to validate account
             result = self.dropbox_client.files_list_folder(remote_folder)
+            entries = list(result.entries)
+            while result.has_more:
+                result = self.dropbox_client.files_list_folder_continue(
+                    result.cursor
+                )
+                entries.extend(result.entries)
             response = {
-                'entries': [x.name for x in result.entries],
-                'is_files': [
-                    hasattr(x, 'content_hash') for x in result.entries
-                 ]
+                'entries': [x.name for x in entries],
+                'is_files': [hasattr(x, 'content_hash') for x in entries],
+                'metadata': [get_metadata(x) for x in entries],
+                'cursor': result.cursor
             }
             status = 'online'
 
@@ -319,3 +758,94 @@ class StorageBackEnd():
                 status = 'api-error'
 
         return {'status': status, 'content': response, 'alerts': out_message}
+
+    def list_folder_continue(self, cursor):
+        """Entries changed since cursor, metadata is None if deleted"""
+        out_message = ''
+        try:
+
+            result = self.dropbox_client.files_list_folder_continue(cursor)
+            entries = list(result.entries)
+            while result.has_more:
+                result = self.dropbox_client.files_list_folder_continue(
+                    result.cursor
+                )
+                entries.extend(result.entries)
+            response = {
+                'entries': [x.name for x in entries],
+                'paths': [x.path_display for x in entries],
+                'metadata': [get_metadata(x) for x in entries],
+                'cursor': result.cursor
+            }
+            status = 'online'
+
+        except ConnectionError:
+
+            # Dropbox unrechable
+            response = {
+                'entries': None, 'paths': None, 'metadata': None,
+                'cursor': None
+            }
+            status = 'connection-error'
+
+        except ApiError as exception:
+
+            # Includes expired cursors
+            out_message = exception
+            response = {
+                'entries': None, 'paths': None, 'metadata': None,
+                'cursor': None
+            }
+            status = 'api-error'
+
+        return {'status': status, 'content': response, 'alerts': out_message}
+
+    def list_folder_latest_cursor(self, remote_folder):
+        """
+        Cursor to get changes anywhere inside a folder from now on with
+        list_folder_continue
+        """
+        if remote_folder:
+            assert remote_folder[-1] != '/', \
+                "Dropbox paths can not finish in /"
+        out_message = ''
+        try:
+            result = self.dropbox_client.files_list_folder_get_latest_cursor(
+                remote_folder,
+                recursive=True
+            )
+            cursor = result.cursor
+            status = 'online'
+        except ConnectionError:
+            # Dropbox unrechable
+            cursor = None
+            status = 'connection-error'
+        except ApiError as exception:
+            out_message = exception
+            cursor = None
+            status = 'api-error'
+        return {'status': status, 'content': cursor, 'alerts': out_message}
+
+    def list_folder_longpoll(self, cursor, timeout=30):
+        """
+        Wait until something changes after cursor or timeout seconds pass.
+        Content is {'changes': bool, 'backoff': seconds to wait or None}
+        """
+        out_message = ''
+        try:
+            result = self.dropbox_client.files_list_folder_longpoll(
+                cursor,
+                timeout=timeout
+            )
+            response = {'changes': result.changes, 'backoff': result.backoff}
+            status = 'online'
+        except (ConnectionError, Timeout):
+            # Dropbox unrechable
+            response = {'changes': False, 'backoff': None}
+            status = 'connection-error'
+        except ApiError as exception:
+            # Includes expired cursors
+            out_message = exception
+            response = {'changes': False, 'backoff': None}
+            status = 'api-error'
+        return {'status': status, 'content': response, 'alerts': out_message}
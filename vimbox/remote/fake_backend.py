@@ -1,5 +1,8 @@
 import os
 import sys
+import json
+import time
+import base64
 import shutil
 import codecs
 from vimbox import local
@@ -27,6 +30,10 @@ class StorageBackEnd():
         if not os.path.isdir(self.fake_remote_folder):
             os.makedirs(self.fake_remote_folder)
         self.online = online
+        # Seconds between checks of the fake remote in list_folder_longpoll
+        self.poll_interval = 0.1
+        # Uploads and downloads to file are copied in chunks of this size
+        self.upload_chunk_size = 8 * 1024 * 1024
 
     def get_user_account(self):
         """Provide info on users current account"""
@@ -38,13 +45,26 @@ class StorageBackEnd():
             status = 'connection-status'
         return {'status': status, 'content': user, 'alerts': None}
 
-    def _remote_write(self, remote_file, remote_content):
+    def _remote_write(self, remote_file, remote_content, progress=None):
         # Store content
         fake_remote_file = "%s/%s" % (
             self.fake_remote_folder, remote_file
         )
         with open(fake_remote_file, 'wb') as fid:
-            fid.write(remote_content)
+            if hasattr(remote_content, 'read'):
+                # Copy in chunks as the dropbox upload sessions
+                size = os.fstat(remote_content.fileno()).st_size
+                sent = 0
+                while True:
+                    chunk = remote_content.read(self.upload_chunk_size)
+                    if not chunk:
+                        break
+                    fid.write(chunk)
+                    sent += len(chunk)
+                    if progress and size > self.upload_chunk_size:
+                        progress(sent, size)
+            else:
+                fid.write(remote_content)
 
     def _remote_read(self, remote_file):
         # Store content
@@ -65,21 +85,99 @@ class StorageBackEnd():
         fake_rem_target = "%s/%s" % (self.fake_remote_folder, remote_target)
         shutil.copytree(fake_rem_source, fake_rem_target)
 
-    def files_upload(self, new_local_content, remote_file_hash):
-        """Overwrites file in the remote"""
+    def _remote_metadata(self, remote_source):
+        fake_remote_source = "%s/%s" % (
+            self.fake_remote_folder, remote_source
+        )
+        if os.path.isfile(fake_remote_source):
+            content_hash = local.get_content_hash(fake_remote_source)
+            return {
+                'type': 'file',
+                'content_hash': content_hash,
+                # Any string that changes with the content works as revision
+                'rev': content_hash[:16],
+                'size': os.path.getsize(fake_remote_source)
+            }
+        elif os.path.isdir(fake_remote_source):
+            return {
+                'type': 'dir', 'content_hash': None, 'rev': None, 'size': None
+            }
+        else:
+            return None
+
+    def _remote_listing(self, remote_folder, recursive=False):
+        """Entries relative to remote_folder and their metadata"""
+        fake_remote_source = "%s/%s" % (
+            self.fake_remote_folder, remote_folder
+        )
+        entries = sorted(os.listdir(fake_remote_source))
+        if recursive:
+            for entry in list(entries):
+                if os.path.isdir("%s/%s" % (fake_remote_source, entry)):
+                    sub_entries, _ = self._remote_listing(
+                        "%s/%s" % (remote_folder, entry),
+                        recursive=True
+                    )
+                    entries.extend(
+                        "%s/%s" % (entry, sub_entry)
+                        for sub_entry in sub_entries
+                    )
+            entries = sorted(entries)
+        metadata = [
+            self._remote_metadata("%s/%s" % (remote_folder, entry))
+            for entry in entries
+        ]
+        return entries, metadata
+
+    def _get_cursor(self, remote_folder, entries, metadata, recursive=False):
+        # The cursor carries the listing it was created from
+        cursor = json.dumps({
+            'folder': remote_folder,
+            'listing': dict(zip(entries, metadata)),
+            'recursive': recursive
+        })
+        return base64.b64encode(cursor.encode('utf-8')).decode('utf-8')
+
+    def files_upload(self, new_local_content, remote_file_hash, rev=None,
+                     progress=None):
+        """
+        Uploads file to the remote
+
+        rev is the revision the new content is based on. If the remote
+        changed since, nothing is written and status is 'conflict'. Use an
+        empty rev for files that should not exist yet and None to overwrite
+
+        new_local_content can be bytes or a binary file object
+        """
+        metadata = None
         if self.online:
-            # Make folder if it does not exist
-            dirname = "%s/%s" % (
-                self.fake_remote_folder,
-                os.path.dirname(remote_file_hash)
-            )
-            if not os.path.isdir(dirname):
-                os.makedirs(dirname)
-            self._remote_write(remote_file_hash, new_local_content)
-            status = None
+            old_metadata = self._remote_metadata(remote_file_hash)
+            if rev is None:
+                conflict = False
+            elif rev == '':
+                conflict = old_metadata is not None
+            else:
+                conflict = old_metadata is None or old_metadata['rev'] != rev
+            if conflict:
+                status = 'conflict'
+            else:
+                # Make folder if it does not exist
+                dirname = "%s/%s" % (
+                    self.fake_remote_folder,
+                    os.path.dirname(remote_file_hash)
+                )
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                self._remote_write(
+                    remote_file_hash,
+                    new_local_content,
+                    progress=progress
+                )
+                metadata = self._remote_metadata(remote_file_hash)
+                status = 'online'
         else:
-            status = 'connection-status'
-        return {'status': status, 'content': None, 'alerts': None}
+            status = 'connection-error'
+        return {'status': status, 'content': metadata, 'alerts': None}
 
     def make_directory(self, remote_target):
         if self.online:
@@ -105,6 +203,27 @@ class StorageBackEnd():
             status = 'connection-error'
         return {'status': status, 'content': None, 'alerts': None}
 
+    def files_move(self, remote_source, remote_target):
+        """Move or rename, fails if the target exists"""
+        if not self.online:
+            return {
+                'status': 'connection-error',
+                'content': None,
+                'alerts': None
+            }
+        fake_rem_source = "%s/%s" % (self.fake_remote_folder, remote_source)
+        fake_rem_target = "%s/%s" % (self.fake_remote_folder, remote_target)
+        if os.path.exists(fake_rem_target) or \
+                not os.path.exists(fake_rem_source):
+            status = 'api-error'
+        else:
+            # Missing folders are created as in dropbox
+            if not os.path.isdir(os.path.dirname(fake_rem_target)):
+                os.makedirs(os.path.dirname(fake_rem_target))
+            os.rename(fake_rem_source, fake_rem_target)
+            status = 'online'
+        return {'status': status, 'content': None, 'alerts': None}
+
     def files_delete(self, remote_source):
         if self.online:
             fake_remote_source = "%s/%s" % (
@@ -126,6 +245,72 @@ class StorageBackEnd():
             status = 'connection-status'
         return {'status': status, 'content': None, 'alerts': None}
 
+    def files_copy_batch(self, entries):
+        """
+        Copy a list of (source, target) pairs. Content is the status of each
+        pair ('online' or 'api-error')
+        """
+        if not self.online:
+            return {
+                'status': 'connection-error',
+                'content': None,
+                'alerts': None
+            }
+        statuses = [
+            self.files_copy(remote_source, remote_target)['status']
+            for remote_source, remote_target in entries
+        ]
+        return {'status': 'online', 'content': statuses, 'alerts': None}
+
+    def files_move_batch(self, entries):
+        """Same as files_copy_batch, but moving"""
+        if not self.online:
+            return {
+                'status': 'connection-error',
+                'content': None,
+                'alerts': None
+            }
+        statuses = [
+            self.files_move(remote_source, remote_target)['status']
+            for remote_source, remote_target in entries
+        ]
+        return {'status': 'online', 'content': statuses, 'alerts': None}
+
+    def files_delete_batch(self, remote_sources):
+        """
+        Delete a list of paths. Content is the status of each path, paths
+        that do not exist count as deleted as in the dropbox back-end
+        """
+        if not self.online:
+            return {
+                'status': 'connection-error',
+                'content': None,
+                'alerts': None
+            }
+        for remote_source in remote_sources:
+            self.files_delete(remote_source)
+        statuses = ['online'] * len(remote_sources)
+        return {'status': 'online', 'content': statuses, 'alerts': None}
+
+    def file_metadata(self, remote_source):
+        if self.online:
+            metadata = self._remote_metadata(remote_source)
+            status = 'online'
+        else:
+            metadata = None
+            status = 'connection-error'
+        return {'status': status, 'content': metadata, 'alerts': None}
+
+    def files_metadata_batch(self, remote_paths):
+        """Metadata of several paths, None for paths that do not exist"""
+        if self.online:
+            metadata = [self._remote_metadata(path) for path in remote_paths]
+            status = 'online'
+        else:
+            metadata = None
+            status = 'connection-error'
+        return {'status': status, 'content': metadata, 'alerts': None}
+
     def file_type(self, remote_source):
         """ Returns true if remote_file is a file """
         if self.online:
@@ -153,25 +338,91 @@ class StorageBackEnd():
             status = 'online'
             if os.path.isfile(fake_remote_source):
                 remote_content = self._remote_read(remote_source)
+                metadata = self._remote_metadata(remote_source)
+                if sys.version_info[0] > 2:
+                    # Python3, decode plain text as the dropbox back-end
+                    try:
+                        remote_content = remote_content.decode("utf-8")
+                    except UnicodeDecodeError:
+                        # Encrypted content
+                        pass
             else:
                 remote_content = None
+                metadata = None
         else:
             remote_content = None
+            metadata = None
+            status = 'connection-error'
+        return {
+            'status': status,
+            'content': remote_content,
+            'metadata': metadata,
+            'alerts': None
+        }
+
+    def file_download_head(self, remote_source, size):
+        """First size bytes of a file, None if it does not exist"""
+        remote_content = None
+        if self.online:
+            fake_remote_source = "%s/%s" % (
+                self.fake_remote_folder, remote_source
+            )
+            status = 'online'
+            if os.path.isfile(fake_remote_source):
+                with open(fake_remote_source, 'rb') as fid:
+                    remote_content = fid.read(size)
+        else:
             status = 'connection-error'
         return {'status': status, 'content': remote_content, 'alerts': None}
 
+    def file_download_to(self, remote_source, local_file):
+        """
+        Stream remote file into local_file chunk by chunk, hashing it on the
+        way. Content is local_file, None if the remote file does not exist
+        """
+        remote_content = None
+        content_hash = None
+        metadata = None
+        if self.online:
+            fake_remote_source = "%s/%s" % (
+                self.fake_remote_folder, remote_source
+            )
+            status = 'online'
+            if os.path.isfile(fake_remote_source):
+                hasher = local.ContentHasher()
+                with open(fake_remote_source, 'rb') as source:
+                    with open(local_file, 'wb') as target:
+                        while True:
+                            chunk = source.read(self.upload_chunk_size)
+                            if not chunk:
+                                break
+                            target.write(chunk)
+                            hasher.update(chunk)
+                remote_content = local_file
+                content_hash = hasher.hexdigest()
+                metadata = self._remote_metadata(remote_source)
+        else:
+            status = 'connection-error'
+        return {
+            'status': status,
+            'content': remote_content,
+            'content_hash': content_hash,
+            'metadata': metadata,
+            'alerts': None
+        }
+
     def list_folders(self, remote_folder):
         fake_remote_source = "%s/%s" % (
             self.fake_remote_folder, remote_folder
         )
         alerts = ''
+        metadata = None
+        cursor = None
         if self.online:
             try:
-                entries = os.listdir(fake_remote_source)
-                is_files = [
-                    os.path.isfile("%s/%s" % (fake_remote_source, entry))
-                    for entry in entries
-                ]
+                entries, metadata = self._remote_listing(remote_folder)
+                is_files = [x['type'] == 'file' for x in metadata]
+                cursor = self._get_cursor(remote_folder, entries, metadata)
                 status = 'online'
             except OSError:
                 if os.path.isfile(fake_remote_source):
@@ -191,5 +442,102 @@ class StorageBackEnd():
             entries = False
             is_files = None
 
-        response = {'entries': entries, 'is_files': is_files}
+        response = {
+            'entries': entries,
+            'is_files': is_files,
+            'metadata': metadata,
+            'cursor': cursor
+        }
         return {'status': status, 'content': response, 'alerts': alerts}
+
+    def list_folder_continue(self, cursor):
+        """Entries changed since cursor, metadata is None if deleted"""
+        if not self.online:
+            response = {
+                'entries': None, 'paths': None, 'metadata': None,
+                'cursor': None
+            }
+            return {
+                'status': 'connection-error',
+                'content': response,
+                'alerts': None
+            }
+        old = json.loads(base64.b64decode(cursor.encode('utf-8')).decode(
+            'utf-8'
+        ))
+        recursive = old.get('recursive', False)
+        try:
+            entries, metadata = self._remote_listing(
+                old['folder'],
+                recursive=recursive
+            )
+        except OSError:
+            # Folder was removed
+            entries, metadata = [], []
+        listing = dict(zip(entries, metadata))
+        changed = sorted(
+            entry for entry in set(listing) | set(old['listing'])
+            if listing.get(entry) != old['listing'].get(entry)
+        )
+        response = {
+            'entries': [os.path.basename(entry) for entry in changed],
+            'paths': [
+                "%s/%s" % (old['folder'], entry) for entry in changed
+            ],
+            'metadata': [listing.get(entry) for entry in changed],
+            'cursor': self._get_cursor(
+                old['folder'], entries, metadata, recursive=recursive
+            )
+        }
+        return {'status': 'online', 'content': response, 'alerts': None}
+
+    def list_folder_latest_cursor(self, remote_folder):
+        """
+        Cursor to get changes anywhere inside a folder from now on with
+        list_folder_continue
+        """
+        if not self.online:
+            return {
+                'status': 'connection-error',
+                'content': None,
+                'alerts': None
+            }
+        try:
+            entries, metadata = self._remote_listing(
+                remote_folder,
+                recursive=True
+            )
+        except OSError:
+            # Folder does not exist
+            return {'status': 'api-error', 'content': None, 'alerts': None}
+        cursor = self._get_cursor(
+            remote_folder, entries, metadata, recursive=True
+        )
+        return {'status': 'online', 'content': cursor, 'alerts': None}
+
+    def list_folder_longpoll(self, cursor, timeout=30):
+        """
+        Wait until something changes after cursor or timeout seconds pass.
+        Content is {'changes': bool, 'backoff': seconds to wait or None}
+
+        There is no server to notify us, the fake remote folder is checked
+        every poll_interval seconds instead
+        """
+        if not self.online:
+            return {
+                'status': 'connection-error',
+                'content': {'changes': False, 'backoff': None},
+                'alerts': None
+            }
+        end = time.time() + timeout
+        while True:
+            response = self.list_folder_continue(cursor)
+            changes = bool(response['content']['entries'])
+            if changes or time.time() >= end:
+                break
+            time.sleep(self.poll_interval)
+        return {
+            'status': 'online',
+            'content': {'changes': changes, 'backoff': None},
+            'alerts': None
+        }
@@ -0,0 +1,205 @@
+"""
+Local cache of remote metadata (type, content_hash, rev, size)
+
+Keyed by back-end path (no trailing slash, folders included). Entries are
+trusted for metadata_ttl seconds and evicted least recently used first when
+there are more than metadata_cache_size.
+
+Listing a folder stores its list_folder cursor. While the folder is fresh its
+listing is complete, so a path missing from it is known not to exist. Once
+stale, one list_folder_continue call on the cursor revalidates all entries of
+the folder at once.
+
+Change feeds (see VimboxClient.changes) keep a recursive cursor per folder
+that does not expire with the ttl.
+"""
+import os
+import json
+import time
+from collections import OrderedDict
+
+
+def get_metadata_file(config_file):
+    """Metadata cache of a given config e.g. config.yml -> config.metadata"""
+    return '%s.metadata' % os.path.splitext(config_file)[0]
+
+
+def get_parent(remote_path):
+    """Parent folder of a back-end path, root is the empty string"""
+    parent = os.path.dirname(remote_path)
+    if parent == '/':
+        parent = ''
+    return parent
+
+
+class MetadataCache(object):
+
+    def __init__(self, cache_file, ttl=60, max_size=1000):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.max_size = max_size
+        # path: {'metadata': ..., 'time': ...} in least recently used order
+        self.entries = OrderedDict()
+        # folder: {'cursor': ..., 'time': ...}
+        self.cursors = {}
+        # folder: recursive cursor of its change feed
+        self.feeds = {}
+        self.dirty = False
+        # Modification time of the cache file when last loaded or saved
+        self.mtime = None
+        if os.path.isfile(cache_file):
+            self.load()
+
+    def load(self):
+        self.mtime = os.path.getmtime(self.cache_file)
+        try:
+            with open(self.cache_file, 'r') as fid:
+                data = json.load(fid)
+        except ValueError:
+            # Corrupted cache, start from scratch
+            return
+        self.entries = OrderedDict()
+        for path, metadata, stamp in data['entries']:
+            self.entries[path] = {'metadata': metadata, 'time': stamp}
+        self.cursors = data['cursors']
+        self.feeds = data.get('feeds', {})
+
+    def save(self):
+        if not self.dirty:
+            return
+        data = {
+            'entries': [
+                [path, entry['metadata'], entry['time']]
+                for path, entry in self.entries.items()
+            ],
+            'cursors': self.cursors,
+            'feeds': self.feeds
+        }
+        tmp_file = '%s.tmp' % self.cache_file
+        with open(tmp_file, 'w') as fid:
+            json.dump(data, fid)
+        os.rename(tmp_file, self.cache_file)
+        self.mtime = os.path.getmtime(self.cache_file)
+        self.dirty = False
+
+    def reload(self):
+        """Load again if saved by other process meanwhile e.g. vimbox.daemon"""
+        if (
+            not self.dirty and
+            os.path.isfile(self.cache_file) and
+            os.path.getmtime(self.cache_file) != self.mtime
+        ):
+            self.load()
+
+    def _is_fresh(self, stamp, now):
+        return now - stamp <= self.ttl
+
+    def get(self, remote_path):
+        """
+        Return (known, metadata). If known is False the back-end has to be
+        asked. Known with metadata None means the path does not exist.
+        """
+        now = time.time()
+        folder = self.cursors.get(get_parent(remote_path))
+        folder_fresh = folder is not None and \
+            self._is_fresh(folder['time'], now)
+        entry = self.entries.get(remote_path)
+        if entry is not None and (
+            folder_fresh or self._is_fresh(entry['time'], now)
+        ):
+            # Most recently used goes last
+            del self.entries[remote_path]
+            self.entries[remote_path] = entry
+            return True, entry['metadata']
+        elif entry is None and folder_fresh:
+            return True, None
+        return False, None
+
+    def get_last(self, remote_path):
+        """Last metadata seen for a path however old, None if unknown"""
+        entry = self.entries.get(remote_path)
+        if entry is None:
+            return None
+        return entry['metadata']
+
+    def get_cursor(self, remote_folder):
+        """Cursor of a stale folder listing, None if fresh or unknown"""
+        folder = self.cursors.get(remote_folder)
+        if folder is None or self._is_fresh(folder['time'], time.time()):
+            return None
+        return folder['cursor']
+
+    def get_feed_cursor(self, remote_folder):
+        """Cursor of the change feed of a folder, None if there is none"""
+        return self.feeds.get(remote_folder)
+
+    def set_feed_cursor(self, remote_folder, cursor):
+        if cursor is None:
+            self.feeds.pop(remote_folder, None)
+        else:
+            self.feeds[remote_folder] = cursor
+        self.dirty = True
+
+    def put(self, remote_path, metadata):
+        if metadata is None:
+            self._drop(remote_path)
+            return
+        if remote_path in self.entries:
+            del self.entries[remote_path]
+        self.entries[remote_path] = {'metadata': metadata, 'time': time.time()}
+        while len(self.entries) > self.max_size:
+            path, _ = self.entries.popitem(last=False)
+            # Listing of its folder is no more complete
+            self.cursors.pop(get_parent(path), None)
+        self.dirty = True
+
+    def _drop(self, remote_path):
+        """Remove path and anything inside it"""
+        prefix = remote_path + '/'
+        for path in list(self.entries):
+            if path == remote_path or path.startswith(prefix):
+                del self.entries[path]
+        for folder in list(self.cursors):
+            if folder == remote_path or folder.startswith(prefix):
+                del self.cursors[folder]
+        self.dirty = True
+
+    def put_folder(self, remote_folder, entries, metadata, cursor):
+        """Store a full folder listing and its cursor"""
+        paths = ["%s/%s" % (remote_folder, entry) for entry in entries]
+        # Entries no more in remote
+        listed = set(paths)
+        for path in list(self.entries):
+            if get_parent(path) == remote_folder and path not in listed:
+                self._drop(path)
+        for path, path_metadata in zip(paths, metadata):
+            self.put(path, path_metadata)
+        # Only complete listings can tell a file does not exist
+        if cursor and all(path in self.entries for path in paths):
+            self.cursors[remote_folder] = {
+                'cursor': cursor,
+                'time': time.time()
+            }
+            self.dirty = True
+
+    def update_folder(self, remote_folder, entries, metadata, cursor):
+        """Apply changes returned by list_folder_continue"""
+        for entry, path_metadata in zip(entries, metadata):
+            self.put("%s/%s" % (remote_folder, entry), path_metadata)
+        if remote_folder in self.cursors:
+            self.cursors[remote_folder] = {
+                'cursor': cursor,
+                'time': time.time()
+            }
+            self.dirty = True
+
+    def invalidate(self, remote_path):
+        """
+        Forget path, anything inside it, and that the listing of its folder
+        is complete. Call after changing the path in the remote.
+        """
+        self._drop(remote_path)
+        parent = self.cursors.get(get_parent(remote_path))
+        if parent is not None:
+            # Keep cursor for cheap revalidation
+            parent['time'] = 0
@@ -6,16 +6,25 @@ Handles back-end errors in a unified way
 import os
 import sys
 import re
+import json
+import time
 import shutil
 import getpass
+import tempfile
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 #
 from vimbox import (
     local,
     crypto,
     diogenes,
     VimboxClientError,
-    VimboxOfflineError
+    VimboxOfflineError,
+    VimboxTerminalNeeded
 )
+from vimbox.outbox import Outbox, get_outbox_file
+from vimbox.keyagent import KeyAgent, get_scopes
+from vimbox.remote.metadata import MetadataCache, get_metadata_file, get_parent
 
 
 # Bash font styles
@@ -24,11 +33,39 @@ yellow = diogenes.style(font_color='yellow')
 green = diogenes.style(font_color='light green')
 blue = diogenes.style(font_color='light blue')
 
+# Encrypted file of each folder with the names of the encrypted files in it,
+# so that other machines can register them. Stored hashed as those files
+MANIFEST_NAME = '.vimbox_manifest'
+
+
+def get_manifest_path(remote_folder):
+    """Remote (hashed) name of the manifest of a folder/"""
+    return crypto.get_path_hash("%s%s" % (remote_folder, MANIFEST_NAME))
+
 
 def get_path_components(path):
     return tuple(filter(None, path.split('/')))
 
 
+def get_common_folder(remote_folders):
+    """Deepest folder containing all given folders, root if none given"""
+    common = None
+    for remote_folder in remote_folders:
+        components = get_path_components(remote_folder)
+        if common is None:
+            common = components
+        else:
+            for index, (a, b) in enumerate(zip(common, components)):
+                if a != b:
+                    common = common[:index]
+                    break
+            else:
+                common = common[:len(components)]
+    if not common:
+        return '/'
+    return '/%s/' % '/'.join(common)
+
+
 def automerge(reference_content, modified_content, automerge_rules):
 
     # Ensure allowed automerge rules
@@ -183,6 +220,26 @@ class VimboxClient():
         self.config_path = config_path
         self.config = local.load_config(config_path)
         self.verbose = verbose
+        # Remote metadata, saved at the end of each batch()
+        self.metadata = MetadataCache(
+            get_metadata_file(config_path),
+            ttl=self.config['metadata_ttl'],
+            max_size=self.config['metadata_cache_size']
+        )
+        # Content hashes of the local mirror, also saved with batch()
+        self.content_hashes = local.ContentHashIndex(
+            local.get_content_hash_file(config_path)
+        )
+        # Changes made while offline (see flush_outbox)
+        self.outbox = Outbox(
+            get_outbox_file(config_path),
+            retry_base=self.config['outbox_retry_base'],
+            retry_max=self.config['outbox_retry_max']
+        )
+        # Passwords of encrypted files, asked once per folder and session
+        self.keys = KeyAgent(timeout=self.config['key_agent_timeout'])
+        # False where nobody can answer prompts e.g. vimboxd
+        self.interactive = True
 
         # Get reference to remote client
         if self.config['backend_name'] == 'dropbox':
@@ -213,94 +270,317 @@ class VimboxClient():
                 "Unknown backend %s" % self.config['backend_name']
             )
 
+    def reload_config(self):
+        """Re-read config e.g. in long lived clients (see vimbox.daemon)"""
+        self.config = local.load_config(self.config_path)
+        self.metadata.reload()
+
+    @contextmanager
+    def batch(self):
+        """
+        Hold cache and path hash changes and write them once at the end
+
+        Changes are also written if the batch is interrupted by an exception,
+        including KeyboardInterrupt
+
+        with client.batch():
+            client.copy('/folder/', '/folder2/')
+            client.remove('/folder/', recursive=True)
+        """
+        local.start_batch(self.config_path, self.config)
+        try:
+            yield self
+        finally:
+            local.flush_batch(self.config)
+            self.metadata.save()
+            self.content_hashes.save()
+
     # REMOTE METHODS
 
-    def _push(self, new_local_content, remote_file, password=None):
+    def _push(self, new_local_content, remote_file, password=None, rev=None,
+              local_file=None):
         """
         Push updates to remote
 
-        NOTE: This overwrites remote content. It can lead to loss of data.
+        rev is the remote revision the content is based on ('' for new files).
+        Returns None on success, 'conflict' if the remote changed since rev,
+        'connection-error' or 'api-error'
+
+        If local_file is given, it must hold new_local_content. It is then
+        streamed from disk (encrypted into a temporary file first if
+        needed), so large files are not copied in memory.
+
+        NOTE: Without rev this overwrites remote content. It can lead to loss
+        of data.
         """
 
+        # Registered encrypted files are never pushed in plain
+        if (
+            password is None and
+            self.config['path_hashes'].has_path(remote_file)
+        ):
+            password = self.keys.get(remote_file)
+            if password is None:
+                raise VimboxClientError(
+                    "No password to push encrypted %s" % remote_file
+                )
+
         # If encrypted get encrypted remote-name
         if password is not None:
-            # Validate pasword
-            validated_password = crypto.validate_password(password)
-            # Hash filename
             remote_file_hash = crypto.get_path_hash(remote_file)
-            # Encript content
-            new_local_content = crypto.encrypt_content(
+        else:
+            remote_file_hash = remote_file
+
+        if local_file is not None:
+            upload = open(local_file, 'rb')
+            if password is not None:
+                # Encrypt to disk, chunk by chunk
+                plain = upload
+                upload = tempfile.TemporaryFile()
+                try:
+                    crypto.encrypt_file(
+                        plain,
+                        upload,
+                        crypto.validate_password(password),
+                        compression=self.config['compression'],
+                        level=self.config['compression_level']
+                    )
+                finally:
+                    plain.close()
+                upload.seek(0)
+        elif password is not None:
+            upload = crypto.encrypt_content(
                 new_local_content,
-                validated_password
+                crypto.validate_password(password),
+                compression=self.config['compression'],
+                level=self.config['compression_level']
             )
+        elif sys.version_info[0] > 2:
+            # Encoding for Python3
+            upload = str.encode(new_local_content)
         else:
-            remote_file_hash = remote_file
-            if sys.version_info[0] > 2:
-                # Encoding for Python3
-                new_local_content = str.encode(new_local_content)
-        # Overwrite remote
-        self.client.files_upload(new_local_content, remote_file_hash)
+            upload = new_local_content
+
+        # Update remote, unless it changed since rev
+        try:
+            response = self.client.files_upload(
+                upload,
+                remote_file_hash,
+                rev=rev,
+                progress=self._upload_progress(remote_file)
+            )
+        finally:
+            if local_file is not None:
+                upload.close()
+        if response['status'] == 'online':
+            # Metadata of the new version comes with the upload
+            self.metadata.put(remote_file_hash, response['content'])
+            if password is not None and self.keys.get(remote_file) is None:
+                self.keys.add(get_scopes(remote_file)[1], password)
+            return None
+        elif response['status'] in ['conflict', 'api-error']:
+            self.metadata.invalidate(remote_file_hash)
+            return response['status']
+        else:
+            return 'connection-error'
+
+    def _upload_progress(self, remote_file):
+        """Callback for back-ends to report progress of large uploads"""
+        if self.verbose < 1:
+            return None
+        start = time.time()
+
+        def progress(sent, size):
+            elapsed = max(time.time() - start, 1e-6)
+            sys.stdout.write("\r%-12s %s %3d%% %.1f MB/s" % (
+                blue("uploading"),
+                remote_file,
+                100 * sent // max(size, 1),
+                sent / 1024. / 1024. / elapsed
+            ))
+            if sent >= size:
+                sys.stdout.write("\n")
+            sys.stdout.flush()
 
-    def _tentative_fetch(self, remote_file, password):
+        return progress
 
-        # Initial assumption about encryption
-        if password:
-            is_encrypted = True
-            remote_file_hash = crypto.get_path_hash(remote_file)
-            response = self.client.file_download(remote_file_hash)
-        else:
-            is_encrypted = False
-            response = self.client.file_download(remote_file)
+    def _download(self, remote_path):
 
+        response = self.client.file_download(remote_path)
         if response['status'] == 'api-error':
             # Unexpected error
             raise VimboxClientError("api-error:\n%s" % response['alerts'])
-
         elif response['status'] == 'connection-error':
             # Offline
             raise VimboxOfflineError("Connection error")
+        elif response['content'] is None:
+            # Metadata cache was wrong about this path
+            self.metadata.invalidate(remote_path)
+        elif response.get('metadata'):
+            self.metadata.put(remote_path, response['metadata'])
+        return response
 
+    def _stream_download(self, remote_file):
+        """
+        Download a plain file into a temporary file next to its local copy.
+        Touches no client state, so it can run in threads (see sync_folder)
+        """
+        local_file = self.get_local_file(remote_file)
+        local_folder = os.path.dirname(local_file)
+        if not os.path.isdir(local_folder):
+            try:
+                os.makedirs(local_folder)
+            except OSError:
+                # Created by other thread meanwhile
+                if not os.path.isdir(local_folder):
+                    raise
+        fid, tmp_file = tempfile.mkstemp(
+            dir=local_folder,
+            prefix='.%s.' % os.path.basename(local_file),
+            suffix='.download'
+        )
+        os.close(fid)
+        response = self.client.file_download_to(remote_file, tmp_file)
+        if response['status'] != 'online' or response['content'] is None:
+            os.remove(tmp_file)
+            response['content'] = None
+        return response
+
+    def _apply_download(self, remote_file, response):
+        """
+        Move a file from _stream_download in place of its local copy if there
+        is none or it was not edited since last sync, response gets
+        'local_match'. Otherwise its content is read to merge it.
+        """
+        if response['status'] == 'connection-error':
+            raise VimboxOfflineError("Connection error")
+        elif response['status'] != 'online':
+            raise VimboxClientError("api-error:\n%s" % response['alerts'])
         elif response['content'] is None:
+            # Metadata cache was wrong about this path
+            self.metadata.invalidate(remote_file)
+            return response
+        self.metadata.put(remote_file, response['metadata'])
 
-            # No file found, but need to check for hashed / unhashed name
-            # collision
-            if password:
-                # We asked for an encrypted file, try unencrypted
-                response = self.client.file_download(remote_file)
+        tmp_file = response['content']
+        local_file = self.get_local_file(remote_file)
+        if (
+            not os.path.isfile(local_file) or
+            self.content_hashes.is_unedited(local_file)
+        ):
+            if os.path.isfile(local_file):
+                shutil.copymode(local_file, tmp_file)
             else:
-                # We asked for an unencrypted file try encrypted
-                remote_file_hash = crypto.get_path_hash(remote_file)
-                response = self.client.file_download(remote_file_hash)
-
-            # Second check
-            if response['status'] == 'api-error':
-                # Unexpected error
-                # This one is weird, since we tried once and it was ok
-                raise VimboxClientError("api-error:\n%s" % response['alerts'])
-
-            elif response['status'] == 'connection-error':
-                # Suddenly, Offline
-                raise VimboxOfflineError("Connection error")
+                # mkstemp files are only readable by the user
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(tmp_file, 0o666 & ~umask)
+            # Atomic, the local copy is either the old or the new one
+            os.rename(tmp_file, local_file)
+            self.content_hashes.set(local_file, response['content_hash'])
+            self.content_hashes.set_synced(local_file)
+            return dict(response, content=None, local_match=True)
+
+        # Edited, merge needs the content
+        content = local.read_file(tmp_file)
+        os.remove(tmp_file)
+        return dict(response, content=content)
 
-            elif response['content'] is None:
-                # File really does not exist
-                pass
+    def _tentative_fetch(self, remote_file, password):
 
-            elif password:
+        remote_file_hash = crypto.get_path_hash(remote_file)
 
-                # Provided a password but the file exists unencrypted in remote
-                VimboxClientError(
-                    "Tried to fetch encrypted version of %s but it exists "
-                    "unencrypted in remote" % remote_file
-                )
+        # Registered path hashes and cached metadata tell which name to
+        # download. Otherwise assume encryption if we were given a password
+        is_encrypted, metadata = self.resolve_encryption(
+            remote_file,
+            lookup=False
+        )
+        if is_encrypted is not None and metadata is None:
+            # Known not to exist under either name
+            response = {
+                'status': 'online',
+                'content': None,
+                'metadata': None,
+                'alerts': None
+            }
+            return response, bool(password)
+        elif is_encrypted is None:
+            is_encrypted = bool(password)
+
+        if is_encrypted:
+            response = self._download(remote_file_hash)
+        else:
+            response = self._download(remote_file)
 
+        if response['content'] is None:
+
+            # No file found, but need to check for hashed / unhashed name
+            # collision. Skip if cached metadata says the other name does not
+            # exist either
+            if is_encrypted:
+                other_path = remote_file
             else:
+                other_path = remote_file_hash
+            if self.metadata.get(other_path) != (True, None):
+                response = self._download(other_path)
+                if response['content'] is not None:
+                    is_encrypted = not is_encrypted
+
+            if response['content'] is None:
+                # File really does not exist
+                is_encrypted = bool(password)
 
-                # Tried to fetch as unecrypted but it is encrypted
-                is_encrypted = True
+        if response['content'] is not None and password and not is_encrypted:
+            # Provided a password but the file exists unencrypted in remote
+            raise VimboxClientError(
+                "Tried to fetch encrypted version of %s but it exists "
+                "unencrypted in remote" % remote_file
+            )
 
         return response, is_encrypted
 
+    def _local_match(self, remote_file, password):
+        """
+        Response with the local content if the local copy of a plain file
+        matches the remote one (same content hash), None otherwise
+
+        Encrypted files are always downloaded. The local copy is plain text
+        and it would skip checking the password.
+        """
+
+        if password or self.config['path_hashes'].has_path(remote_file):
+            return None
+        local_file = self.get_local_file(remote_file)
+        local_hash = self.content_hashes.get(local_file)
+        if local_hash is None:
+            return None
+
+        # Ask the back-end only if the metadata cache is stale
+        known, metadata = self.metadata.get(remote_file)
+        if not known:
+            response = self.client.file_metadata(remote_file)
+            if response['status'] == 'connection-error':
+                raise VimboxOfflineError("Connection error")
+            elif response['status'] != 'online':
+                return None
+            self.metadata.put(remote_file, response['content'])
+            metadata = response['content']
+        if (
+            metadata is None or
+            metadata['type'] != 'file' or
+            metadata['content_hash'] != local_hash
+        ):
+            return None
+
+        return {
+            'status': 'online',
+            'content': local.read_file(local_file),
+            'metadata': metadata,
+            'alerts': None,
+            'local_match': True
+        }
+
     def fetch(self, remote_file, password=None):
         """
         Get local and remote content and coresponding file paths
@@ -310,22 +590,190 @@ class VimboxClient():
         assert remote_file[0] == '/', "Dropbox remote paths start with /"
         assert remote_file[-1] != '/', "Can only fetch files"
 
+        # Nothing to download if the local copy matches the remote
+        response = self._local_match(remote_file, password)
+        if response is not None:
+            return response, password
+
+        # Known encrypted files with no password at hand: confirm the one
+        # asked for on their first bytes before downloading them. Otherwise
+        # it is checked on the downloaded bytes, saving a round trip
+        is_encrypted, metadata = self.resolve_encryption(
+            remote_file,
+            lookup=False
+        )
+        unlocked = False
+        if (
+            is_encrypted and
+            metadata is not None and
+            not password and
+            not self.keys.get(remote_file)
+        ):
+            response = self.client.file_download_head(
+                crypto.get_path_hash(remote_file),
+                crypto.QUICK_CHECK_SIZE
+            )
+            if response['status'] == 'connection-error':
+                raise VimboxOfflineError("Connection error")
+            elif response['content'] is not None:
+                password = self._unlock(
+                    remote_file,
+                    password,
+                    response['content']
+                )
+                unlocked = True
+
         # Fetch file without assumptions about encryption
         response, is_encrypted = self._tentative_fetch(remote_file, password)
 
         # Decryption
         if response['content'] and is_encrypted:
-            if not password:
-                password = getpass.getpass('Input file password: ')
-            validated_password = crypto.validate_password(password)
+            if not unlocked:
+                password = self._unlock(
+                    remote_file,
+                    password,
+                    response['content'][:crypto.QUICK_CHECK_SIZE]
+                )
             response['content'], sucess = crypto.decript_content(
-                response['content'], validated_password
+                response['content'], crypto.validate_password(password)
             )
             if not sucess:
                 raise VimboxClientError("Decrypting %s filed" % remote_file)
 
         return response, password
 
+    def _unlock(self, remote_file, password, head):
+        """
+        Password of an encrypted file, checked on its first bytes only (see
+        crypto.check_password). Tries the password given, else the one kept
+        for its folder, else asks for it
+        """
+        scope = get_scopes(remote_file)[1]
+        if not password:
+            kept_password = self.keys.get(remote_file)
+            if kept_password and crypto.check_password(
+                head,
+                crypto.validate_password(kept_password)
+            ):
+                return kept_password
+            elif kept_password:
+                # This file has a password of its own
+                scope = remote_file
+            if not self.interactive:
+                raise VimboxTerminalNeeded(
+                    "Password needed for %s" % remote_file
+                )
+            password = getpass.getpass('Input file password: ')
+        if not crypto.check_password(head, crypto.validate_password(password)):
+            raise VimboxClientError("Wrong password for %s" % remote_file)
+        self.keys.add(scope, password)
+        return password
+
+    def _update_manifest(self, remote_file, add=True):
+        """
+        Add or remove an encrypted file in the manifest of its folder. The
+        manifest is encrypted with the password kept for the folder, without
+        one it is left as is
+        """
+        remote_folder = get_scopes(remote_file)[1]
+        password = self.keys.get(remote_folder)
+        if password is None:
+            return
+        password = crypto.validate_password(password)
+        manifest_path = get_manifest_path(remote_folder)
+
+        # Current names, none if there is no manifest yet
+        response = self.client.file_download(manifest_path)
+        if response['status'] != 'online':
+            # Names are registered again next time the file is pushed
+            return
+        names = {}
+        rev = ''
+        if response['content'] is not None:
+            text, sucess = crypto.decript_content(
+                response['content'], password
+            )
+            if not sucess:
+                if self.verbose > 0:
+                    print(
+                        "Manifest of %s has another password, not updated" %
+                        remote_folder
+                    )
+                return
+            names = json.loads(text)
+            rev = response['metadata']['rev']
+
+        hashed_name = os.path.basename(crypto.get_path_hash(remote_file))
+        name = os.path.basename(remote_file)
+        if add and names.get(hashed_name) != name:
+            names[hashed_name] = name
+        elif not add and hashed_name in names:
+            del names[hashed_name]
+        else:
+            return
+
+        # Leave no manifest in folders without encrypted files
+        if names:
+            response = self.client.files_upload(
+                crypto.encrypt_content(
+                    json.dumps(names, sort_keys=True),
+                    password,
+                    compression=self.config['compression'],
+                    level=self.config['compression_level']
+                ),
+                manifest_path,
+                rev=rev
+            )
+        else:
+            response = self.client.files_delete(manifest_path)
+        self.metadata.invalidate(manifest_path)
+        if response['status'] == 'conflict' and self.verbose > 0:
+            print("Manifest of %s changed meanwhile, not updated" %
+                  remote_folder)
+
+    def _restore_names(self, remote_folder, entries):
+        """
+        Register the hashed entries of a folder listing whose name is not
+        known here, e.g. encrypted on another machine, from the manifest of
+        the folder. One download, asks for its password if not kept
+        """
+        manifest_name = os.path.basename(get_manifest_path(remote_folder))
+        unknown = [
+            entry for entry in entries
+            if entry != manifest_name and
+            crypto.is_hashed_name(entry) and
+            "%s%s" % (remote_folder, entry) not in self.config['path_hashes']
+        ]
+        if not unknown or manifest_name not in entries:
+            return
+
+        response = self._download(get_manifest_path(remote_folder))
+        if response['content'] is None:
+            return
+        password = self._unlock(
+            "%s%s" % (remote_folder, MANIFEST_NAME),
+            None,
+            response['content'][:crypto.QUICK_CHECK_SIZE]
+        )
+        text, sucess = crypto.decript_content(
+            response['content'], crypto.validate_password(password)
+        )
+        if not sucess:
+            raise VimboxClientError(
+                "Decrypting manifest of %s failed" % remote_folder
+            )
+        names = json.loads(text)
+
+        changes = []
+        for entry in unknown:
+            if entry in names:
+                changes.append([
+                    'add-hash',
+                    "%s%s" % (remote_folder, entry),
+                    "%s%s" % (remote_folder, names[entry])
+                ])
+        local.update_state(self.config_path, self.config, changes)
+
     def merge(self, remote_file, remote_content, automerge_rules,
               amerge_ref_is_local):
 
@@ -339,7 +787,11 @@ class VimboxClient():
             else:
                 merged_content = local_content
 
-        elif local_content and local_content != remote_content:
+        elif (
+            local_content and
+            local_content != remote_content and
+            not self.content_hashes.is_unedited(local_file)
+        ):
 
             # If automerge selected try one or more strategies
             merge_strategy = None
@@ -375,7 +827,8 @@ class VimboxClient():
 
         else:
 
-            # No local content, or local matches remote
+            # No local content, local matches remote or local was not edited
+            # since last sync
             merged_content = remote_content
             local.local_edit(local_file, merged_content, no_edit=True)
 
@@ -386,12 +839,17 @@ class VimboxClient():
         }
 
     def pull(self, remote_file, force_creation, password=None,
-             automerge_rules=None, amerge_ref_is_local=False):
+             automerge_rules=None, amerge_ref_is_local=False, response=None):
+        """
+        Fetch remote content and merge it with local content
+
+        response    Remote content fetched already (see sync_folder)
+        """
 
         if force_creation:
 
             # Check created files/folders with same name in cache and remote
-            if remote_file in self.config['path_hashes'].values():
+            if self.config['path_hashes'].has_path(remote_file):
                 raise VimboxClientError(
                     '\n%s exists in remote and is encrypted.\n' % remote_file
                 )
@@ -404,13 +862,23 @@ class VimboxClient():
             elif file_type == 'dir':
                 message = '\n%s exists in remote as a folder.\n' % remote_file
                 raise VimboxClientError(message)
-            content = {'local': None, 'remote': None, 'merged': None}
+            # Upload must fail if someone creates it meanwhile
+            content = {
+                'local': None,
+                'remote': None,
+                'merged': None,
+                'rev': ''
+            }
 
         else:
 
             # Fetch remote content for this file. If there is connction error,
             # use offline mode
-            response, password = self.fetch(remote_file, password=password)
+            if response is None:
+                response, password = self.fetch(
+                    remote_file,
+                    password=password
+                )
 
             # Force use of -f or -e to create new folders
             if (
@@ -424,7 +892,14 @@ class VimboxClient():
                 )
 
             # Merge
-            if response['status'] == 'online':
+            if response.get('local_match', False):
+                # Local copy matches remote, nothing to merge
+                content = {
+                    'local': response['content'],
+                    'remote': response['content'],
+                    'merged': response['content']
+                }
+            elif response['status'] == 'online':
                 content = self.merge(
                     remote_file,
                     response['content'],
@@ -434,6 +909,12 @@ class VimboxClient():
             else:
                 raise VimboxOfflineError("Connection error")
 
+            # Revision the upload will be based on
+            if response.get('metadata'):
+                content['rev'] = response['metadata']['rev']
+            else:
+                content['rev'] = None
+
         return content, 'online', password
 
     def cat(self, remote_file):
@@ -447,9 +928,10 @@ class VimboxClient():
 
         # Try first remote
         if remote_folder and remote_folder[-1] == '/':
-             response = self.client.list_folders(remote_folder[:-1])
+            listed_folder = remote_folder[:-1]
         else:
-             response = self.client.list_folders(remote_folder)
+            listed_folder = remote_folder
+        response = self.client.list_folders(listed_folder)
         entries = response['content']['entries']
         is_files = response['content']['is_files']
         status = response['status']
@@ -467,6 +949,16 @@ class VimboxClient():
             status = response['status']
             message = response['alerts']
             is_encrypted = status == 'online'
+            listed_folder = enc_remote_folder
+
+        # Keep metadata of the listing and its cursor
+        if status == 'online' and entries:
+            self.metadata.put_folder(
+                listed_folder,
+                entries,
+                response['content']['metadata'],
+                response['content']['cursor']
+            )
 
         display_string = ""
         if status == 'api-error':
@@ -484,9 +976,18 @@ class VimboxClient():
 
         elif status == 'online':
 
+            # Names of files encrypted elsewhere, from the folder manifest
+            manifest_name = os.path.basename(
+                get_manifest_path(remote_folder or '/')
+            )
+            if not is_encrypted and (remote_folder or '/')[-1] == '/':
+                self._restore_names(remote_folder or '/', entries)
+
             # Differentiate file and folders
             display_folders = []
             for entry, is_file in zip(entries, is_files):
+                if is_file and entry == manifest_name:
+                    continue
                 # Add slash to files on root
                 if remote_folder == '':
                     entry = '/' + entry
@@ -502,35 +1003,36 @@ class VimboxClient():
             if remote_folder:
 
                 # Remove folder paths no more in remote
+                changes = []
                 for path in self.config['cache']:
                     if path[:len(remote_folder)] == remote_folder:
                         cache_folder = \
                             path[len(remote_folder):].split('/')[0] + '/'
+                        # '/' is the listed folder itself, keep it
                         if (
                             cache_folder not in display_folders and
-                            cache_folder != ''
+                            cache_folder != '/'
                         ):
-                            self.config['cache'].remove(path)
+                            changes.append(['remove-cache', path])
 
                 # Add missing folders
                 if remote_folder not in self.config['cache']:
-                    self.config['cache'].append(remote_folder)
+                    changes.append(['add-cache', remote_folder])
                 for folder in display_folders:
                     if folder[-1] == '/':
                         new_path = "%s%s" % (remote_folder, folder)
                         if new_path not in self.config['cache']:
-                            self.config['cache'].append(new_path)
+                            changes.append(['add-cache', new_path])
 
                 # Write cache
-                self.config['cache'] = sorted(self.config['cache'])
-                local.write_config(self.config_path, self.config)
+                local.update_state(self.config_path, self.config, changes)
 
             # Replace encrypted files
             entry_types = []
             new_display_folders = []
             for entry in display_folders:
                 key = "%s%s" % (remote_folder, entry)
-                if key in self.config['path_hashes'].keys():
+                if key in self.config['path_hashes']:
                     entry_types.append('encrypted')
                     new_display_folders.append(
                         os.path.basename(self.config['path_hashes'][key])
@@ -561,8 +1063,11 @@ class VimboxClient():
 
             # Add file to cache
             if remote_folder not in self.config['cache']:
-                self.config['cache'].append(remote_folder)
-                local.write_config(self.config_path, self.config)
+                local.update_state(
+                    self.config_path,
+                    self.config,
+                    [['add-cache', remote_folder]]
+                )
 
         elif os.path.isdir(local.get_local_file(remote_folder)):
 
@@ -587,11 +1092,14 @@ class VimboxClient():
 
         if file_type is None:
             response = self.client.make_directory(remote_target[:-1])
+            self.metadata.invalidate(remote_target[:-1])
             if response['status'] == 'online':
                 # Local file
                 os.mkdir(local.get_local_file(remote_target))
                 # Cache
                 self.register_file(remote_target, False)
+            elif response['status'] != 'api-error':
+                raise VimboxOfflineError("Connection error")
         elif file_type == 'dir':
             raise VimboxClientError("%s already exists" % remote_target)
         elif is_encripted:
@@ -650,39 +1158,35 @@ class VimboxClient():
             remote_target2 = remote_target[:-1]
         else:
             remote_target2 = remote_target
-        response = self.client.files_copy(remote_source2, remote_target2)
 
-        # If there is an error, try encrypted names
-        is_encrypted = False
-        if response['status'] == 'api-error':
+        # Registered path hashes and cached metadata tell if the source is
+        # encrypted. Folders never are.
+        if remote_source[-1] == '/':
+            is_encrypted = False
+        else:
+            is_encrypted, _ = self.resolve_encryption(
+                remote_source2,
+                lookup=False
+            )
+
+        if not is_encrypted:
+            response = self.client.files_copy(remote_source2, remote_target2)
+            self.metadata.invalidate(remote_target2)
+
+        # If encrypted, or unknown and there is an error, use encrypted names
+        if is_encrypted or (
+            is_encrypted is None and response['status'] == 'api-error'
+        ):
             remote_source_hash = crypto.get_path_hash(remote_source2)
             remote_target_hash = crypto.get_path_hash(remote_target2)
             response = self.client.files_copy(
                 remote_source_hash, remote_target_hash
             )
+            self.metadata.invalidate(remote_target_hash)
             is_encrypted = True
 
         if response['status'] == 'online':
-
-            # Local move if we had a copy
-            local_source = self.get_local_file(remote_source)
-            local_target = self.get_local_file(remote_target)
-            if os.path.isfile(local_source):
-                # Make missing local folder
-                local_target_folder = os.path.dirname(local_target)
-                if not os.path.isdir(local_target_folder):
-                    os.makedirs(local_target_folder)
-                shutil.move(local_source, local_target)
-            elif os.path.isdir(local_source):
-                shutil.copytree(local_source, local_target)
-            # update cache and hash list
-            if remote_source[-1] != '/':
-                self.register_file(remote_target, is_encrypted)
-            else:
-                # If we are copying a folder we need to look for hashes inside
-                # that folder and change their names
-                self.register_file(remote_target, is_encrypted)
-                self.copy_hash(remote_source, remote_target)
+            self._copy_local(remote_source, remote_target, is_encrypted)
             if self.verbose > 0:
                 items = (yellow("copied"), remote_source, remote_target)
                 print("%-12s %s %s" % items)
@@ -691,6 +1195,29 @@ class VimboxClient():
         else:
             raise VimboxClientError("api-error: %s" % response['alerts'])
 
+    def _copy_local(self, remote_source, remote_target, is_encrypted):
+        """Local side of a remote copy: local copy, cache and hash list"""
+
+        # Local move if we had a copy
+        local_source = self.get_local_file(remote_source)
+        local_target = self.get_local_file(remote_target)
+        if os.path.isfile(local_source):
+            # Make missing local folder
+            local_target_folder = os.path.dirname(local_target)
+            if not os.path.isdir(local_target_folder):
+                os.makedirs(local_target_folder)
+            shutil.move(local_source, local_target)
+        elif os.path.isdir(local_source):
+            shutil.copytree(local_source, local_target)
+        # update cache and hash list
+        if remote_source[-1] != '/':
+            self.register_file(remote_target, is_encrypted)
+        else:
+            # If we are copying a folder we need to look for hashes inside
+            # that folder and change their names
+            self.register_file(remote_target, is_encrypted)
+            self.copy_hash(remote_source, remote_target)
+
     def copy_hash(self, source_folder, target_folder):
         """
         When copying folders, we need to fined encrypted files inside and
@@ -701,26 +1228,21 @@ class VimboxClient():
         assert target_folder[-1] == '/', "Expected folders not files"
 
         # Find encrypted and resgitered files in the original folder
-        encrypted_sources = []
-        for file_hash, file_name in list(self.config['path_hashes'].items()):
-            if file_name[:len(source_folder)] == source_folder:
-                encrypted_sources.append(file_hash)
+        encrypted_sources = self.config['path_hashes'].under(source_folder)
 
         # Create the new paths and add them to the hash list
-        updated_hashes = False
-        for file_hash in encrypted_sources:
+        changes = []
+        for file_hash, file_name in encrypted_sources:
 
             # We were given a target file and not a file name
             new_folder_hash = target_folder + file_hash[len(source_folder):]
-            new_path = target_folder + \
-                self.config['path_hashes'][file_hash][len(source_folder):]
-            self.config['path_hashes'].update({new_folder_hash: new_path})
+            new_path = target_folder + file_name[len(source_folder):]
+            changes.append(['add-hash', new_folder_hash, new_path])
             if self.verbose > 0:
-                items = (self.config['path_hashes'][file_hash], new_path)
-                print("Copied hash %s -> %s" % items)
-            updated_hashes = True
+                print("Copied hash %s -> %s" % (file_name, new_path))
+        local.update_state(self.config_path, self.config, changes)
 
-        return updated_hashes
+        return bool(changes)
 
     def is_removable(self, remote_file, recursive=False):
         """Check if file/folder is removable"""
@@ -739,7 +1261,7 @@ class VimboxClient():
                 reason = "Need to use recursive flag -R to remove folders"
         elif (
             file_type == 'file' and
-            remote_file not in self.config['path_hashes'].values() and
+            not self.config['path_hashes'].has_path(remote_file) and
             is_encrypted
         ):
             is_rem = False
@@ -785,10 +1307,10 @@ class VimboxClient():
             # TODO: This is input sanity check should go in the client
             # dependent part
             response = self.client.files_delete(remote_file[:-1])
-            # update cache
-            # local.update_cache()
+            self.metadata.invalidate(remote_file[:-1])
         else:
             response = self.client.files_delete(remote_file)
+            self.metadata.invalidate(remote_file)
 
         if response['status'] == 'api-error':
 
@@ -802,36 +1324,476 @@ class VimboxClient():
             if self.verbose > 0:
                 print("%s did not exist in remote!" % original_name)
 
-        elif response['status'] != 'connection-error':
+        elif response['status'] == 'online':
             if self.verbose > 0:
                 print("%-12s %s" % (yellow("removed"), original_name))
+            self._remove_local(original_name)
+        else:
+            if self.verbose > 0:
+                print(
+                    "%-12s did not remove!  %s" %
+                    (red("offline"), original_name)
+                )
+            raise VimboxOfflineError("Connection error")
 
-            # Remove local copy
-            local_file = self.get_local_file(remote_file)
-            if os.path.isfile(local_file):
-                os.remove(local_file)
-            elif os.path.isdir(local_file):
-                shutil.rmtree(local_file)
-            self.unregister_file(original_name)
-        elif self.verbose > 0:
-            print(
-                "%-12s did not remove!  %s" % (red("offline"), original_name)
+    def _remove_local(self, remote_file):
+        """Local side of a remote removal: local copy, cache and hash list"""
+        local_file = self.get_local_file(remote_file)
+        if os.path.isfile(local_file):
+            os.remove(local_file)
+        elif os.path.isdir(local_file):
+            shutil.rmtree(local_file)
+        self.unregister_file(remote_file)
+
+    def _prefetch_types(self, remote_paths):
+        """
+        Look up the plain and hashed names of several paths with a single
+        metadata request, so that file_type needs no further calls
+        """
+        # Root has no name to hash
+        remote_paths = [path.rstrip('/') for path in remote_paths]
+        remote_paths = [path for path in remote_paths if path]
+        unknown = []
+        for path in remote_paths + crypto.get_path_hashes(remote_paths):
+            if path not in unknown and not self.metadata.get(path)[0]:
+                unknown.append(path)
+        if unknown:
+            response = self.client.files_metadata_batch(unknown)
+            if response['status'] != 'online':
+                raise VimboxOfflineError("Connection error")
+            for path, metadata in zip(unknown, response['content']):
+                self.metadata.put(path, metadata)
+
+    def _backend_pair(self, remote_source, remote_target):
+        """
+        Back-end paths of source and target of a copy/move and if the source
+        is encrypted. Needs types known (see _prefetch_types)
+        """
+        source_type, is_encrypted, _ = self.file_type(remote_source)
+        if source_type is None:
+            raise VimboxClientError(
+                "%s does not exist in remote" % remote_source
+            )
+        if is_encrypted:
+            return (
+                crypto.get_path_hash(remote_source),
+                crypto.get_path_hash(remote_target),
+                True
             )
+        return remote_source.rstrip('/'), remote_target.rstrip('/'), False
+
+    def _relocate_batch(self, remote_sources, remote_target, move):
+        """
+        Copy or move several files and folders into folder remote_target
+        with a single back-end batch
+        """
+
+        if remote_target[-1] != '/':
+            raise VimboxClientError(
+                "Target of several files must be a folder, end it in /"
+            )
+        self._prefetch_types(list(remote_sources) + [remote_target])
+        if self.file_type(remote_target)[0] == 'file':
+            raise VimboxClientError('Target file %s exists' % remote_target)
+
+        entries = []
+        for remote_source in remote_sources:
+            if move:
+                is_rem, reason, _ = \
+                    self.is_removable(remote_source, recursive=True)
+                if not is_rem:
+                    raise VimboxClientError(
+                        "Can not move (remove) %s due to: %s" %
+                        (remote_source, reason)
+                    )
+            target = "%s%s" % (
+                remote_target,
+                os.path.basename(remote_source.rstrip('/'))
+            )
+            if remote_source[-1] == '/':
+                target += '/'
+            entries.append(
+                (remote_source, target) +
+                self._backend_pair(remote_source, target)
+            )
+
+        pairs = [(source, target) for _, _, source, target, _ in entries]
+        if move:
+            response = self.client.files_move_batch(pairs)
+        else:
+            response = self.client.files_copy_batch(pairs)
+        for source, target in pairs:
+            if move:
+                self.metadata.invalidate(source)
+            self.metadata.invalidate(target)
+        if response['status'] == 'connection-error':
+            raise VimboxOfflineError("Connection error")
+        elif response['status'] != 'online':
+            raise VimboxClientError("api-error: %s" % response['alerts'])
+
+        failed = []
+        for entry, status in zip(entries, response['content']):
+            remote_source, target, _, _, is_encrypted = entry
+            if status != 'online':
+                failed.append(remote_source)
+                continue
+            if move:
+                self._move_local(remote_source, target)
+            else:
+                self._copy_local(remote_source, target, is_encrypted)
+            if self.verbose > 0:
+                action = yellow("moved" if move else "copied")
+                print("%-12s %s %s" % (action, remote_source, target))
+        if failed:
+            raise VimboxClientError("Could not %s %s" % (
+                "move" if move else "copy",
+                " ".join(failed)
+            ))
+
+    def copy_batch(self, remote_sources, remote_target):
+        """Copy several files and folders into a folder in one batch"""
+        self._relocate_batch(remote_sources, remote_target, move=False)
+
+    def move_batch(self, remote_sources, remote_target):
+        """Move several files and folders into a folder in one batch"""
+        self._relocate_batch(remote_sources, remote_target, move=True)
+
+    def remove_batch(self, remote_files, recursive=False):
+        """
+        Remove several files and folders with a single back-end batch, same
+        checks as remove
+        """
+
+        if '/' in remote_files:
+            raise VimboxClientError(
+                "\nRemoving root is disallowed, just in case you have fat"
+                " fingers\n"
+            )
+        self._prefetch_types(remote_files)
+        backend_paths = []
+        for remote_file in remote_files:
+            is_rem, reason, is_encrypted = \
+                self.is_removable(remote_file, recursive=recursive)
+            if not is_rem:
+                raise VimboxClientError(
+                    "\nCan not remove %s due to: %s\n" % (remote_file, reason)
+                )
+            if is_encrypted:
+                backend_paths.append(crypto.get_path_hash(remote_file))
+            else:
+                backend_paths.append(remote_file.rstrip('/'))
+
+        response = self.client.files_delete_batch(backend_paths)
+        for backend_path in backend_paths:
+            self.metadata.invalidate(backend_path)
+        if response['status'] == 'connection-error':
+            raise VimboxOfflineError("Connection error")
+        elif response['status'] != 'online':
+            raise VimboxClientError("api-error: %s" % response['alerts'])
+
+        failed = []
+        for remote_file, status in zip(remote_files, response['content']):
+            if status != 'online':
+                failed.append(remote_file)
+                continue
+            self._remove_local(remote_file)
+            if self.verbose > 0:
+                print("%-12s %s" % (yellow("removed"), remote_file))
+        if failed:
+            raise VimboxClientError("Could not remove %s" % " ".join(failed))
 
     def move(self, remote_source, remote_target):
-        """Copy and remove"""
-        is_rem, reason, is_encrypted = self.is_removable(remote_source)
-        recursive = False
-        # FIXME: Capturing a string is brittle
-        if reason == 'Need to use recursive flag -R to remove folders':
-            is_rem = True
-            recursive = True
+        """
+        Move server side with a single call, then rename the local copy and
+        move its cache and hash list entries
+
+        mv /path/to/file /path/to/another/file   (file does not exist)
+        mv /path/to/file /path/to/folder/
+        mv /path/to/folder/ /path/to/folder2/
+        mv /path/to/folder/ /path/to/folder2/    (folder2 does not exist)
+        """
+
+        # Types of source and target with a single request
+        self._prefetch_types([remote_source, remote_target])
+        is_rem, reason, _ = self.is_removable(remote_source, recursive=True)
         if not is_rem:
             raise VimboxClientError(
                 "Can not move (remove) due to: %s" % reason
             )
-        self.copy(remote_source, remote_target)
-        self.remove(remote_source, recursive=recursive)
+        target_type, _, _ = self.file_type(remote_target)
+        if target_type == 'file':
+            raise VimboxClientError('Target file %s exists' % remote_target)
+        elif target_type == 'dir':
+            # mv /path/to/file /path/to/folder/file
+            # mv /path/to/folder/ /path/to/folder2/folder/
+            remote_target = remote_target + os.path.basename(
+                remote_source.rstrip('/')
+            )
+            if remote_source[-1] == '/':
+                remote_target += '/'
+        elif remote_source[-1] == '/' and remote_target[-1] != '/':
+            remote_target += '/'
+
+        source, target, _ = self._backend_pair(remote_source, remote_target)
+        response = self.client.files_move(source, target)
+        self.metadata.invalidate(source)
+        self.metadata.invalidate(target)
+
+        if response['status'] == 'online':
+            self._move_local(remote_source, remote_target)
+            if self.verbose > 0:
+                items = (yellow("moved"), remote_source, remote_target)
+                print("%-12s %s %s" % items)
+        elif response['status'] == 'connection-error':
+            raise VimboxOfflineError("Connection error")
+        else:
+            raise VimboxClientError("api-error: %s" % response['alerts'])
+
+    def _move_local(self, remote_source, remote_target):
+        """Local side of a remote move: rename local copy, cache, hash list"""
+        local_source = self.get_local_file(remote_source)
+        local_target = self.get_local_file(remote_target)
+        if os.path.exists(local_source):
+            # Stale local copy of the target
+            if os.path.isdir(local_target):
+                shutil.rmtree(local_target)
+            local_target_folder = os.path.dirname(local_target.rstrip('/'))
+            if not os.path.isdir(local_target_folder):
+                os.makedirs(local_target_folder)
+            os.rename(local_source.rstrip('/'), local_target.rstrip('/'))
+        self.content_hashes.move(local_source, local_target)
+        # Folder manifests move with their folder, files change manifest
+        is_encrypted = self.config['path_hashes'].has_path(remote_source)
+        local.move_registration(remote_source, remote_target, self.config)
+        if is_encrypted:
+            self._update_manifest(remote_source, add=False)
+            self._update_manifest(remote_target)
+
+    # OFFLINE METHODS
+
+    def _backend_path(self, remote_path):
+        """Hashed name for registered encrypted files, no trailing slash"""
+        if remote_path[-1] == '/':
+            return remote_path[:-1]
+        elif self.config['path_hashes'].has_path(remote_path):
+            return crypto.get_path_hash(remote_path)
+        return remote_path
+
+    def _last_rev(self, backend_path):
+        """Last revision seen in the remote, '' if it was not there"""
+        metadata = self.metadata.get_last(backend_path)
+        if metadata is None:
+            return ''
+        return metadata['rev']
+
+    def defer_push(self, remote_file, rev=None):
+        """
+        Send the local copy of a plain file when back online. rev is the
+        remote revision it is based on, defaults to the last one seen.
+        Encrypted files are not queued
+        """
+        if self.config['path_hashes'].has_path(remote_file):
+            # Needs a password to be sent, it is not kept on disk
+            if self.verbose > 0:
+                print("%-12s %s, open it when back online" % (
+                    red("not queued"), remote_file
+                ))
+            return
+        if rev is None:
+            rev = self._last_rev(remote_file)
+        self.outbox.add('push', remote_file, rev)
+        if self.verbose > 0:
+            print("%-12s %s" % (red("queued"), remote_file))
+
+    def defer_remove(self, remote_file, recursive=False):
+        """Remove local copy now and the remote when back online"""
+
+        local_file = self.get_local_file(remote_file)
+        if remote_file == '/':
+            raise VimboxClientError(
+                "\nRemoving root is disallowed, just in case you have fat"
+                " fingers\n"
+            )
+        elif os.path.isdir(local_file) and not recursive:
+            raise VimboxClientError(
+                "\nCan not remove due to: Need to use recursive flag -R to "
+                "remove folders\n"
+            )
+        elif not os.path.exists(local_file):
+            # Offline we only know about local copies
+            raise VimboxOfflineError("Connection error")
+
+        backend_path = self._backend_path(remote_file)
+        if remote_file[-1] == '/':
+            # Folders have no revision
+            rev = None
+        else:
+            rev = self._last_rev(backend_path) or None
+        if os.path.isfile(local_file):
+            os.remove(local_file)
+        else:
+            shutil.rmtree(local_file)
+        self.unregister_file(remote_file)
+        self.outbox.add('remove', backend_path, rev)
+        if self.verbose > 0:
+            print("%-12s %s" % (red("queued"), remote_file))
+
+    def defer_copy(self, remote_source, remote_target):
+        """Copy local copy now and the remote when back online"""
+
+        local_source = self.get_local_file(remote_source)
+        if not os.path.exists(local_source):
+            # Offline we only know about local copies
+            raise VimboxOfflineError("Connection error")
+        if remote_target[-1] == '/' and (
+            remote_source[-1] != '/' or
+            os.path.isdir(self.get_local_file(remote_target))
+        ):
+            # Copy into folder
+            remote_target = "%s%s" % (
+                remote_target,
+                os.path.basename(remote_source.rstrip('/'))
+            )
+            if remote_source[-1] == '/':
+                remote_target += '/'
+        local_target = self.get_local_file(remote_target)
+        if os.path.exists(local_target):
+            raise VimboxClientError('Target %s exists' % remote_target)
+
+        is_encrypted = self.config['path_hashes'].has_path(remote_source)
+        if os.path.isfile(local_source):
+            local_target_folder = os.path.dirname(local_target)
+            if not os.path.isdir(local_target_folder):
+                os.makedirs(local_target_folder)
+            shutil.copy(local_source, local_target)
+            self.register_file(remote_target, is_encrypted)
+        else:
+            shutil.copytree(local_source, local_target)
+            self.register_file(remote_target, False)
+            self.copy_hash(remote_source, remote_target)
+        self.outbox.add(
+            'copy',
+            self._backend_path(remote_source),
+            self._backend_path(remote_target)
+        )
+        if self.verbose > 0:
+            items = (red("queued"), remote_source, remote_target)
+            print("%-12s %s %s" % items)
+
+    def defer_move(self, remote_source, remote_target):
+        """Copy and remove when back online"""
+        recursive = remote_source[-1] == '/'
+        self.defer_copy(remote_source, remote_target)
+        self.defer_remove(remote_source, recursive=recursive)
+
+    def flush_outbox(self, force=False):
+        """
+        Send changes made while offline in the order they were made (see
+        vimbox.outbox). Returns True if nothing is left to send.
+
+        After a connection error nothing is tried until the backoff expires,
+        unless force is True. Changes whose remote changed since are dropped
+        and reported, local copies are kept so that they can be merged by
+        opening them.
+        """
+        if not self.outbox.pending():
+            return True
+        with self.outbox.flushing() as acquired:
+            if not acquired:
+                # Other process is at it
+                return False
+            records = self.outbox.pending()
+            if not force and not self.outbox.is_due():
+                return False
+            with self.batch():
+                for record_id, operation, args in records:
+                    try:
+                        status = self._send_deferred(operation, args)
+                    except VimboxClientError as exception:
+                        # Kept, and the rest after it, to retry later
+                        delay = self.outbox.retry_later()
+                        if self.verbose > 0:
+                            print("%-12s %s, retry in %d s" % (
+                                red("failed"), exception, delay
+                            ))
+                        return False
+                    if status == 'connection-error':
+                        delay = self.outbox.retry_later()
+                        if self.verbose > 0:
+                            print("%-12s %d changes, retry in %d s" % (
+                                red("offline"),
+                                len(self.outbox.pending()),
+                                delay
+                            ))
+                        return False
+                    self.outbox.done(record_id)
+            self.outbox.clear()
+            return True
+
+    def _send_deferred(self, operation, args):
+        """Send one outbox operation, return back-end status"""
+
+        if operation == 'push':
+            remote_file, rev = args
+            local_file = self.get_local_file(remote_file)
+            if not os.path.isfile(local_file):
+                # Removed meanwhile, nothing to send
+                return 'online'
+            status = self._push(
+                None,
+                remote_file,
+                rev=rev,
+                local_file=local_file
+            ) or 'online'
+            if status == 'online':
+                self.content_hashes.set_synced(local_file)
+                self.register_file(remote_file, False)
+                if self.config['remove_local']:
+                    os.remove(local_file)
+            name = remote_file
+
+        elif operation == 'remove':
+            backend_path, rev = args
+            if rev:
+                response = self.client.file_metadata(backend_path)
+                status = response['status']
+                if status == 'online' and response['content'] is None:
+                    # Gone already
+                    return status
+                elif (
+                    status == 'online' and
+                    response['content']['rev'] != rev
+                ):
+                    status = 'conflict'
+            else:
+                status = 'online'
+            if status == 'online':
+                status = self.client.files_delete(backend_path)['status']
+                self.metadata.invalidate(backend_path)
+            name = backend_path
+
+        elif operation == 'copy':
+            source, target = args
+            status = self.client.files_copy(source, target)['status']
+            self.metadata.invalidate(target)
+            name = "%s %s" % (source, target)
+
+        else:
+            raise VimboxClientError("Unknown outbox operation %s" % operation)
+
+        if status not in ['online', 'conflict', 'api-error']:
+            # Back-ends differ on how they name it
+            status = 'connection-error'
+        if self.verbose > 0:
+            if status == 'online':
+                print("%-12s %s" % (yellow("sent"), name))
+            elif status == 'conflict':
+                print("%-12s %s changed in remote, open it to merge" % (
+                    red("conflict"), name
+                ))
+            elif status != 'connection-error':
+                print("%-12s %s" % (red(status), name))
+        return status
 
     def edit(self, remote_file, remove_local=None, force_creation=False,
              register_folder=True, password=None, initial_text=None,
@@ -887,7 +1849,7 @@ class VimboxClient():
 
     def sync(self, remote_file, remove_local=None, force_creation=False,
              register_folder=True, password=None, automerge_rules=None,
-             amerge_ref_is_local=False, edits=None):
+             amerge_ref_is_local=False, edits=None, response=None):
         """
         Syncronize remote and local content with optional edit
 
@@ -900,6 +1862,7 @@ class VimboxClient():
         automerge_rules     Allowed way to automerge
         amerge_ref_is_local If valid automerge use local as reference (default
                             is remote)
+        response            Remote content fetched already (see sync_folder)
         """
 
         # Sanity checks
@@ -915,7 +1878,8 @@ class VimboxClient():
             force_creation,
             password=password,
             automerge_rules=automerge_rules,
-            amerge_ref_is_local=amerge_ref_is_local
+            amerge_ref_is_local=amerge_ref_is_local,
+            response=response
         )
 
         # Apply edit if needed
@@ -946,49 +1910,392 @@ class VimboxClient():
                 " does\n"
             )
 
-        # Pull again if recovered offline status
-        if fetch_status == 'connection-error':
-            content2, fetch_status, password = self.pull(
+        # Uploads are conditioned on the revision we fetched. If the remote
+        # changed meanwhile, merge the new remote with our edits and retry
+        while self.update_rules(remote_file, content, password, fetch_status,
+                                register_folder, remove_local) == 'conflict':
+            if self.verbose > 0:
+                print("%-12s %s" % (red("conflict"), remote_file))
+            content, fetch_status, password = self.pull(
                 remote_file,
-                force_creation,
+                False,
                 password=password,
                 automerge_rules=automerge_rules,
                 amerge_ref_is_local=amerge_ref_is_local
             )
-            if fetch_status != 'connection-error':
-                content = content2
-                content['edited'] = content['remote']
-
-        self.update_rules(remote_file, content, password, fetch_status,
-                          register_folder, remove_local)
+            content['edited'] = content['merged']
 
         return content['local'] == content['remote']
 
+    def sync_folder(self, remote_folder, num_threads=8):
+        """
+        Syncronize all plain files of a remote folder
+
+        One listing gives the content hash of every file. Local copies that
+        match are not downloaded, the rest are streamed to disk by
+        num_threads threads. Only local copies edited since their last sync
+        are read into memory, to merge them. Merges and uploads happen one
+        file at a time in this thread, so at most one mergetool is open.
+        Encrypted files registered here are then synced one by one, their
+        password is asked once for the folder and kept (see _unlock). Other
+        encrypted files are skipped, their names are unknown.
+        """
+
+        if remote_folder[-1] != '/':
+            raise VimboxClientError("Folder paths must end in /")
+        start = time.time()
+
+        # List folder
+        response = self.client.list_folders(remote_folder[:-1])
+        if response['status'] == 'api-error':
+            raise VimboxClientError("api-error")
+        elif response['status'] != 'online':
+            raise VimboxOfflineError("Connection error")
+        elif not response['content']['entries']:
+            raise VimboxClientError(
+                "%s is not a folder in remote" % remote_folder
+            )
+        self.metadata.put_folder(
+            remote_folder[:-1],
+            response['content']['entries'],
+            response['content']['metadata'],
+            response['content']['cursor']
+        )
+
+        # Files that differ from their local copy need a download
+        in_sync = []
+        changed = []
+        sizes = {}
+        encrypted_files = []
+        encrypted = 0
+        for entry, metadata in zip(
+            response['content']['entries'],
+            response['content']['metadata']
+        ):
+            remote_file = "%s%s" % (remote_folder, entry)
+            if metadata is None or metadata['type'] != 'file':
+                continue
+            elif remote_file == get_manifest_path(remote_folder):
+                # Not a file of the user
+                continue
+            elif remote_file in self.config['path_hashes']:
+                encrypted_files.append(self.config['path_hashes'][remote_file])
+                sizes[encrypted_files[-1]] = metadata['size']
+                continue
+            elif crypto.is_hashed_name(remote_file):
+                encrypted += 1
+                continue
+            sizes[remote_file] = metadata['size']
+            local_file = self.get_local_file(remote_file)
+            if self.content_hashes.get(local_file) == metadata['content_hash']:
+                in_sync.append(remote_file)
+            else:
+                changed.append(remote_file)
+
+        for remote_file in in_sync:
+            self.content_hashes.set_synced(self.get_local_file(remote_file))
+            if self.verbose > 0:
+                print("%-12s %s" % (green("in-sync"), remote_file))
+
+        def download(remote_file):
+            return remote_file, self._stream_download(remote_file)
+
+        # Downloads go straight to the local copy unless it was edited, then
+        # merge and upload as they arrive
+        failed = []
+        pool = ThreadPool(num_threads)
+        try:
+            for remote_file, response in pool.imap_unordered(
+                download, changed
+            ):
+                try:
+                    response = self._apply_download(remote_file, response)
+                    if response.get('local_match'):
+                        if self.verbose > 0:
+                            print("%-12s %s" % (yellow("pulled"), remote_file))
+                    else:
+                        self.sync(remote_file, response=response)
+                except VimboxClientError as exception:
+                    failed.append(remote_file)
+                    if self.verbose > 0:
+                        print("%-12s %s %s" % (
+                            red("failed"), remote_file, str(exception)
+                        ))
+        finally:
+            pool.close()
+            pool.join()
+
+        # Local copies of encrypted files are plain text, they can not be
+        # compared with the remote and are always downloaded
+        for remote_file in encrypted_files:
+            try:
+                self.sync(remote_file)
+                if self.verbose > 0:
+                    print("%-12s %s" % (yellow("pulled"), remote_file))
+            except VimboxClientError as exception:
+                failed.append(remote_file)
+                if self.verbose > 0:
+                    print("%-12s %s %s" % (
+                        red("failed"), remote_file, str(exception)
+                    ))
+        changed.extend(encrypted_files)
+        self.register_file(remote_folder, False)
+
+        # Summary
+        elapsed = time.time() - start
+        num_files = len(in_sync) + len(changed)
+        downloaded = sum(sizes[remote_file] for remote_file in changed)
+        if self.verbose > 0:
+            print(
+                "\n%d files (%d in-sync, %d downloaded, %d failed, %d "
+                "encrypted skipped) in %.2f s" % (
+                    num_files, len(in_sync), len(changed), len(failed),
+                    encrypted, elapsed
+                )
+            )
+            print("%.1f files/s, %.1f KB/s downloaded\n" % (
+                num_files / max(elapsed, 1e-6),
+                downloaded / 1024. / max(elapsed, 1e-6)
+            ))
+
+        return not failed
+
+    def changes(self, remote_folder, merge=False):
+        """
+        Paths added, modified and deleted anywhere inside a remote folder
+        since the last call, as {'added': [], 'modified': [], 'deleted': []}
+
+        A recursive cursor per folder is kept with the metadata cache, so a
+        call costs one list_folder_continue and downloads of changed files
+        only. The first call just sets the cursor. The metadata cache, the
+        folder cache and local copies not edited since their last sync are
+        updated. Edited local copies are merged as in sync if merge is True,
+        otherwise they are only reported. Encrypted files are pulled as in
+        sync_folder, those not registered here are only reported.
+        """
+
+        if remote_folder[-1] != '/':
+            raise VimboxClientError("Folder paths must end in /")
+        backend_folder = remote_folder[:-1]
+        changes = {'added': [], 'modified': [], 'deleted': []}
+
+        cursor = self.metadata.get_feed_cursor(backend_folder)
+        if cursor is None:
+            self._start_feed(backend_folder)
+            return changes
+
+        response = self.client.list_folder_continue(cursor)
+        if response['status'] == 'connection-error':
+            raise VimboxOfflineError("Connection error")
+        elif response['status'] != 'online':
+            # Cursors expire, changes in between can only be found by listing
+            self._start_feed(backend_folder)
+            raise VimboxClientError(
+                "Lost track of changes in %s, use vimbox sync on its "
+                "folders to update them" % remote_folder
+            )
+
+        for path, metadata in zip(
+            response['content']['paths'],
+            response['content']['metadata']
+        ):
+            self.metadata.put(path, metadata)
+            if path == get_manifest_path(get_scopes(path)[1]):
+                # Not a file of the user
+                continue
+            is_encrypted = crypto.is_hashed_name(path)
+            is_registered = path in self.config['path_hashes']
+            if is_registered:
+                remote_path = self.config['path_hashes'][path]
+            else:
+                remote_path = path
+            local_file = self.get_local_file(remote_path)
+
+            if metadata is None:
+                # Deleted file or folder, keep local edits
+                if os.path.isdir(local_file):
+                    remote_path = "%s/" % remote_path
+                # Its manifest was updated where it was deleted
+                self.unregister_file(remote_path, update_manifest=False)
+                self._remove_unedited(local_file)
+                changes['deleted'].append(remote_path)
+                status = red("deleted")
+
+            elif metadata['type'] == 'dir':
+                remote_path = "%s/" % remote_path
+                if os.path.isdir(local_file):
+                    continue
+                self.register_file(remote_path, False)
+                changes['added'].append(remote_path)
+                status = yellow("added")
+
+            else:
+                if os.path.isfile(local_file):
+                    changes['modified'].append(remote_path)
+                    status = yellow("modified")
+                else:
+                    changes['added'].append(remote_path)
+                    status = yellow("added")
+                # Mirror files of mirrored folders
+                if (
+                    (is_encrypted and not is_registered) or
+                    not os.path.isdir(os.path.dirname(local_file)) or
+                    self.content_hashes.get(local_file) ==
+                    metadata['content_hash']
+                ):
+                    pass
+                elif (
+                    merge or
+                    not os.path.isfile(local_file) or
+                    self.content_hashes.is_unedited(local_file)
+                ):
+                    if is_encrypted:
+                        # Password of the folder asked once (see _unlock)
+                        self.sync(remote_path)
+                        status = yellow("pulled")
+                    else:
+                        download = self._apply_download(
+                            remote_path,
+                            self._stream_download(remote_path)
+                        )
+                        if download.get('local_match'):
+                            status = yellow("pulled")
+                        elif download['content'] is not None:
+                            # Edited since last sync
+                            self.sync(remote_path, response=download)
+                            status = yellow("merged")
+
+            if self.verbose > 0:
+                print("%-12s %s" % (status, remote_path))
+
+        self.metadata.set_feed_cursor(
+            backend_folder,
+            response['content']['cursor']
+        )
+        return changes
+
+    def watch(self, remote_folder=None, timeout=30, rounds=None):
+        """
+        Pull changes of a remote folder as soon as they happen
+
+        Defaults to the deepest folder containing all cached folders. Waits on
+        list_folder_longpoll, which costs no CPU while idle, then applies
+        changes(merge=True). Stops after rounds long polls, if given.
+        """
+
+        if remote_folder is None:
+            remote_folder = get_common_folder(self.config['cache'])
+        elif remote_folder[-1] != '/':
+            raise VimboxClientError("Folder paths must end in /")
+        backend_folder = remote_folder[:-1]
+        if self.verbose > 0:
+            print("%-12s %s" % (blue("watching"), remote_folder))
+
+        # Catch up with changes since the last call
+        with self.batch():
+            self.changes(remote_folder, merge=True)
+
+        polls = 0
+        while rounds is None or polls < rounds:
+            polls += 1
+            response = self.client.list_folder_longpoll(
+                self.metadata.get_feed_cursor(backend_folder),
+                timeout=timeout
+            )
+            if response['status'] == 'connection-error':
+                # Try again later
+                if self.verbose > 0:
+                    print("%-12s %s" % (red("offline"), remote_folder))
+                time.sleep(timeout)
+                continue
+            elif response['status'] != 'online':
+                raise VimboxClientError(
+                    "api-error:\n%s" % response['alerts']
+                )
+            if response['content']['changes']:
+                try:
+                    with self.batch():
+                        self.changes(remote_folder, merge=True)
+                except VimboxOfflineError:
+                    if self.verbose > 0:
+                        print("%-12s %s" % (red("offline"), remote_folder))
+            if response['content']['backoff']:
+                # Asked by the back-end to wait before polling again
+                time.sleep(response['content']['backoff'])
+
+    def _start_feed(self, backend_folder):
+        """Start the change feed of a folder from its current state"""
+        response = self.client.list_folder_latest_cursor(backend_folder)
+        if response['status'] == 'connection-error':
+            raise VimboxOfflineError("Connection error")
+        elif response['status'] != 'online':
+            raise VimboxClientError(
+                "%s/ is not a folder in remote" % backend_folder
+            )
+        self.metadata.set_feed_cursor(backend_folder, response['content'])
+
+    def _remove_unedited(self, local_path):
+        """Remove a local file or folder, except files edited since synced"""
+        if os.path.isfile(local_path):
+            if self.content_hashes.is_unedited(local_path):
+                os.remove(local_path)
+                self.content_hashes.set_synced(local_path)
+        elif os.path.isdir(local_path):
+            for name in os.listdir(local_path):
+                self._remove_unedited(os.path.join(local_path, name))
+            if not os.listdir(local_path):
+                os.rmdir(local_path)
+
     def update_rules(self, remote_file, content, password, status,
                      register_folder, remove_local):
+        """
+        Update remote and local after sync. Returns 'conflict' without
+        touching anything if the remote changed since content['rev']
+        """
 
         # Update remote
         if content['edited'] != content['remote']:
 
+            # Uploads stream from the local copy, so it must hold what we
+            # push
+            local_file = self.get_local_file(remote_file)
+            if content['edited'] is not None:
+                if content['local'] != content['edited']:
+                    local.local_edit(
+                        local_file,
+                        content['edited'],
+                        no_edit=True
+                    )
+                upload_file = local_file
+            else:
+                upload_file = None
+
             # Try to push into remote
             if status != 'connection-error':
                 error = self._push(
                     content['edited'],
                     remote_file,
-                    password=password
+                    password=password,
+                    rev=content.get('rev'),
+                    local_file=upload_file
                 )
             else:
                 error = 'connection-error'
 
             # Inform the user
-            if error is None:
+            if error == 'conflict':
+                # Someone else changed the remote, caller has to merge
+                return error
+            elif error is None:
                 # We pushed sucessfully
                 if self.verbose > 0:
                     print("%-12s %s" % (yellow("pushed"), remote_file))
             elif error == 'connection-error':
-                # Offline
+                # Offline, plain files are sent when back online
                 if self.verbose > 0:
                     print("%-12s %s" % (red("offline"), remote_file))
+                if password is None:
+                    self.defer_push(remote_file, rev=content.get('rev'))
             elif error == 'api-error':
                 # This is not a normal state. Probably bug on our side or API
                 # change/bug on the backend.
@@ -1008,7 +2315,9 @@ class VimboxClient():
             # Remove local copy if solicited, otherwise update it with new
             # content
             local_file = self.get_local_file(remote_file)
-            if remove_local and os.path.isfile(local_file):
+            # Queued pushes read the local copy, keep it
+            queued = error == 'connection-error' and password is None
+            if remove_local and os.path.isfile(local_file) and not queued:
                 if (
                     content['merged'] != content['remote'] and
                     error is not None
@@ -1027,14 +2336,25 @@ class VimboxClient():
                 if self.verbose > 0:
                     print("%-12s %s" % (red("cleaned"), local_file))
 
-            elif content['local'] != content['merged']:
-                # If local content was changed we need to update
-                local.local_edit(local_file, content['merged'], no_edit=True)
+            else:
+                if (
+                    content['local'] != content['edited'] and
+                    upload_file is None
+                ):
+                    # Local copy must hold what we pushed
+                    local.local_edit(
+                        local_file,
+                        content['edited'],
+                        no_edit=True
+                    )
+                if error is None:
+                    self.content_hashes.set_synced(local_file)
 
         elif content['merged'] != content['local'] and not remove_local:
             # We overwrote local with remote
             local_file = self.get_local_file(remote_file)
             local.local_edit(local_file, content['merged'], no_edit=True)
+            self.content_hashes.set_synced(local_file)
             if self.verbose > 0:
                 print("%-12s %s" % (yellow("pulled"), remote_file))
             if register_folder:
@@ -1051,47 +2371,141 @@ class VimboxClient():
             # No changes needed on either side
             if self.verbose > 0:
                 print("%-12s %s" % (green("in-sync"), remote_file))
+            local_file = self.get_local_file(remote_file)
             if remove_local and os.path.isfile(local_file):
                 os.remove(local_file)
                 if self.verbose > 0:
                     print("%-12s %s" % (red("cleaned"), local_file))
+            else:
+                self.content_hashes.set_synced(local_file)
             if register_folder:
                 self.register_file(remote_file, password is not None)
 
     def file_type(self, remote_file):
 
-        assert not crypto.is_encrypted_path(remote_file), \
-            "file_type receives unencrypted paths"
-
-        # Try finding plain file first
         if remote_file[-1] == '/':
-            response = self.client.file_type(remote_file[:-1])
+            remote_path = remote_file[:-1]
         else:
-            response = self.client.file_type(remote_file)
-        is_encrypted = False
-        if response['content'] is None and response['status'] == 'online':
-            # Then encrypted file
-            if remote_file[-1] == '/':
-                remote_file_hash = crypto.get_path_hash(remote_file[:-1])
-            else:
-                remote_file_hash = crypto.get_path_hash(remote_file)
-            response = self.client.file_type(remote_file_hash)
-            is_encrypted = True
-
-        if response['content'] is None:
+            remote_path = remote_file
+        if (
+            crypto.is_hashed_name(remote_path) and
+            not self.config['path_hashes'].has_path(remote_path)
+        ):
+            # Given by its hashed name (or one alike), not hashed again
+            response = self.get_metadata(remote_path)
+            if response['status'] == 'connection-error':
+                raise VimboxOfflineError("Connection error")
+            elif response['status'] != 'online':
+                raise VimboxClientError("api-error: %s" % response['alerts'])
             is_encrypted = False
+            metadata = response['content']
+        else:
+            is_encrypted, metadata = self.resolve_encryption(remote_path)
 
-        if response['status'] != 'online':
-            raise VimboxOfflineError("Connection error")
+        if metadata is None:
+            file_type = None
+        else:
+            file_type = metadata['type']
 
-        if response['content'] == 'dir':
+        if file_type == 'dir':
             assert remote_file[-1] == '/', \
                 VimboxClientError("Folder paths must end in /")
-        elif response['content'] == 'file':
+        elif file_type == 'file':
             assert remote_file[-1] != '/', \
                 VimboxClientError("File paths can not end in /")
 
-        return response['content'], is_encrypted, response['status']
+        return file_type, is_encrypted, 'online'
+
+    def resolve_encryption(self, remote_path, lookup=True):
+        """
+        Find if a back-end path is stored under its plain or its hashed name
+
+        Registered path hashes and the metadata cache are tried first. Names
+        still unknown are looked up with a single metadata request. Returns
+        (is_encrypted, metadata) with metadata None if neither name exists.
+        With lookup=False returns (None, None) instead of asking the back-end.
+        """
+
+        # Try the hashed name first for files we registered as encrypted
+        remote_path_hash = crypto.get_path_hash(remote_path)
+        if self.config['path_hashes'].has_path(remote_path):
+            candidates = [(True, remote_path_hash), (False, remote_path)]
+        else:
+            candidates = [(False, remote_path), (True, remote_path_hash)]
+
+        def resolve(known):
+            for is_encrypted, path in candidates:
+                is_known, metadata = known[path]
+                if not is_known:
+                    return None
+                elif metadata is not None:
+                    return is_encrypted, metadata
+            return False, None
+
+        known = dict(
+            (path, self.metadata.get(path)) for _, path in candidates
+        )
+        resolution = resolve(known)
+
+        if resolution is None and lookup:
+            # If the folder was listed before, revalidate it first
+            if self._revalidate_folder(get_parent(remote_path)):
+                known = dict(
+                    (path, self.metadata.get(path)) for _, path in candidates
+                )
+                resolution = resolve(known)
+
+        if resolution is None and lookup:
+            unknown = [path for _, path in candidates if not known[path][0]]
+            response = self.client.files_metadata_batch(unknown)
+            if response['status'] != 'online':
+                raise VimboxOfflineError("Connection error")
+            for path, metadata in zip(unknown, response['content']):
+                self.metadata.put(path, metadata)
+                known[path] = (True, metadata)
+            resolution = resolve(known)
+
+        if resolution is None:
+            return None, None
+        return resolution
+
+    def _revalidate_folder(self, remote_folder):
+        """
+        Update a stale folder listing with a single call on its cursor.
+        Returns True if something was revalidated
+        """
+        cursor = self.metadata.get_cursor(remote_folder)
+        if not cursor:
+            return False
+        response = self.client.list_folder_continue(cursor)
+        if response['status'] != 'online':
+            return False
+        self.metadata.update_folder(
+            remote_folder,
+            response['content']['entries'],
+            response['content']['metadata'],
+            response['content']['cursor']
+        )
+        return True
+
+    def get_metadata(self, remote_path):
+        """
+        Metadata (type, content_hash, rev, size) of a back-end path, from the
+        metadata cache if possible
+        """
+
+        known, metadata = self.metadata.get(remote_path)
+        if not known and self._revalidate_folder(get_parent(remote_path)):
+            # The folder was listed before, all its entries were revalidated
+            known, metadata = self.metadata.get(remote_path)
+
+        if known:
+            return {'status': 'online', 'content': metadata, 'alerts': None}
+
+        response = self.client.file_metadata(remote_path)
+        if response['status'] == 'online':
+            self.metadata.put(remote_path, response['content'])
+        return response
 
     # LOCAL METHODS
 
@@ -1099,10 +2513,22 @@ class VimboxClient():
         return local.get_local_file(remote_file, self.config)
 
     def register_file(self, remote_file, is_encrypted):
-        return local.register_file(remote_file, self.config, is_encrypted)
-
-    def unregister_file(self, remote_file):
-        return local.unregister_file(remote_file, self.config)
+        """Register locally, new encrypted files also in folder manifest"""
+        is_new = (
+            is_encrypted and
+            remote_file[-1] != '/' and
+            not self.config['path_hashes'].has_path(remote_file)
+        )
+        local.register_file(remote_file, self.config, is_encrypted)
+        if is_new:
+            self._update_manifest(remote_file)
+
+    def unregister_file(self, remote_file, update_manifest=True):
+        """Unregister locally, encrypted files also from folder manifest"""
+        is_encrypted = self.config['path_hashes'].has_path(remote_file)
+        local.unregister_file(remote_file, self.config)
+        if is_encrypted and update_manifest:
+            self._update_manifest(remote_file, add=False)
 
     def get_local_content(self, remote_file):
         return local.get_local_content(remote_file, self.config)
@@ -0,0 +1,252 @@
+"""
+Local state: cache of remote folders and path hashes of encrypted files
+
+This is kept out of config.yml in an append-only journal next to it. Each
+line of the journal is a transaction: a JSON list of changes
+
+    ["add-cache", "/path/to/folder/"]
+    ["remove-cache", "/path/to/folder/"]
+    ["add-hash", "/path/to/.<sha256>", "/path/to/file"]
+    ["remove-hash", "/path/to/.<sha256>"]
+
+so a mutation only writes its own delta. A half written last line (e.g.
+killed process) is ignored on replay. The journal is compacted into a single
+snapshot transaction when it grows too much over the live state.
+"""
+import os
+import json
+import fcntl
+from contextlib import contextmanager
+
+# Compact journal when it has this many records more than live entries
+COMPACT_SLACK = 1000
+
+
+def get_state_file(config_file):
+    """State journal of a given config e.g. config.yml -> config.journal"""
+    return '%s.journal' % os.path.splitext(config_file)[0]
+
+
+@contextmanager
+def locked(state_file):
+    """Serialize writers across processes (compaction replaces the file)"""
+    with open('%s.lock' % state_file, 'a') as lock_fid:
+        fcntl.flock(lock_fid, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_fid, fcntl.LOCK_UN)
+
+
+def apply_changes(cache, path_hashes, changes):
+    """Apply journal changes to a cache list and path hash dict in place"""
+    for change in changes:
+        if change[0] == 'add-cache':
+            if change[1] not in cache:
+                cache.append(change[1])
+        elif change[0] == 'remove-cache':
+            if change[1] in cache:
+                cache.remove(change[1])
+        elif change[0] == 'add-hash':
+            path_hashes[change[1]] = change[2]
+        elif change[0] == 'remove-hash':
+            if change[1] in path_hashes:
+                del path_hashes[change[1]]
+        else:
+            raise ValueError("Unknown state change %s" % change[0])
+
+
+def _replay(state_file):
+
+    # Use a set for the cache while replaying, lists are slow on membership
+    cache = set()
+    path_hashes = {}
+    num_records = 0
+    with open(state_file, 'r') as fid:
+        for line in fid:
+            try:
+                changes = json.loads(line)
+            except ValueError:
+                # Interrupted write of the last transaction
+                continue
+            for change in changes:
+                if change[0] == 'add-cache':
+                    cache.add(change[1])
+                elif change[0] == 'remove-cache':
+                    cache.discard(change[1])
+                elif change[0] == 'add-hash':
+                    path_hashes[change[1]] = change[2]
+                elif change[0] == 'remove-hash':
+                    path_hashes.pop(change[1], None)
+                else:
+                    raise ValueError("Unknown state change %s" % change[0])
+            num_records += len(changes)
+
+    return sorted(cache), path_hashes, num_records
+
+
+def _write_line(fid, changes):
+    fid.write('%s\n' % json.dumps(changes))
+    fid.flush()
+    os.fsync(fid.fileno())
+
+
+def _write_snapshot(state_file, cache, path_hashes):
+    changes = [['add-cache', folder] for folder in sorted(set(cache))]
+    changes.extend([
+        ['add-hash', path_hash, path]
+        for path_hash, path in sorted(path_hashes.items())
+    ])
+    tmp_file = '%s.tmp' % state_file
+    with open(tmp_file, 'w') as fid:
+        _write_line(fid, changes)
+    os.rename(tmp_file, state_file)
+
+
+def read_state(state_file):
+    """Return cache and path hashes, compact the journal if needed"""
+
+    cache, path_hashes, num_records = _replay(state_file)
+
+    if num_records > len(cache) + len(path_hashes) + COMPACT_SLACK:
+        with locked(state_file):
+            # Replay again, other process may have written meanwhile
+            cache, path_hashes, _ = _replay(state_file)
+            _write_snapshot(state_file, cache, path_hashes)
+
+    return cache, path_hashes
+
+
+def write_state(state_file, cache, path_hashes):
+    """Overwrite the journal with a snapshot of the given state"""
+    with locked(state_file):
+        _write_snapshot(state_file, cache, path_hashes)
+
+
+def append_state(state_file, changes):
+    """Append changes to the journal as a single transaction"""
+    if not changes:
+        return
+    with locked(state_file):
+        with open(state_file, 'a+') as fid:
+            # Close a half written last line so this one can be replayed
+            fid.seek(0, os.SEEK_END)
+            if fid.tell():
+                fid.seek(fid.tell() - 1)
+                if fid.read(1) != '\n':
+                    fid.write('\n')
+            _write_line(fid, changes)
+
+
+class PathHashes(object):
+    """
+    Registry of hashed names of encrypted files
+
+    Behaves like the dict of hash: path it replaces but also keeps the reverse
+    path: hash map and a trie over path components, so that lookups by path
+    and folder operations do not scan the whole registry.
+    """
+
+    def __init__(self, path_hashes=None):
+        self._paths = {}
+        self._hashes = {}
+        # Nested dicts of path components, node[None] holds the file path
+        self._trie = {}
+        if path_hashes:
+            for path_hash, path in path_hashes.items():
+                self[path_hash] = path
+
+    def _components(self, path):
+        return [component for component in path.split('/') if component]
+
+    def _trie_add(self, path):
+        node = self._trie
+        for component in self._components(path):
+            node = node.setdefault(component, {})
+        node[None] = path
+
+    def _trie_remove(self, path):
+        # Walk down keeping the parents to prune empty branches on the way up
+        components = self._components(path)
+        nodes = [self._trie]
+        for component in components:
+            if component not in nodes[-1]:
+                return
+            nodes.append(nodes[-1][component])
+        nodes[-1].pop(None, None)
+        for index in range(len(components) - 1, -1, -1):
+            if nodes[index + 1]:
+                break
+            del nodes[index][components[index]]
+
+    def __setitem__(self, path_hash, path):
+        if path_hash in self._paths:
+            del self[path_hash]
+        if path in self._hashes:
+            del self[self._hashes[path]]
+        self._paths[path_hash] = path
+        self._hashes[path] = path_hash
+        self._trie_add(path)
+
+    def __delitem__(self, path_hash):
+        path = self._paths.pop(path_hash)
+        del self._hashes[path]
+        self._trie_remove(path)
+
+    def __getitem__(self, path_hash):
+        return self._paths[path_hash]
+
+    def __contains__(self, path_hash):
+        return path_hash in self._paths
+
+    def __iter__(self):
+        return iter(self._paths)
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __eq__(self, other):
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def get(self, path_hash, default=None):
+        return self._paths.get(path_hash, default)
+
+    def keys(self):
+        return list(self._paths.keys())
+
+    def values(self):
+        return list(self._paths.values())
+
+    def items(self):
+        return list(self._paths.items())
+
+    def has_path(self, path):
+        """True if path is a registered encrypted file"""
+        return path in self._hashes
+
+    def get_hash(self, path, default=None):
+        return self._hashes.get(path, default)
+
+    def under(self, path):
+        """
+        Return (hash, path) of the registered file path or of all registered
+        files inside of folder path. Costs the size of the subtree.
+        """
+        node = self._trie
+        for component in self._components(path):
+            if component not in node:
+                return []
+            node = node[component]
+        items = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for component, child in node.items():
+                if component is None:
+                    items.append((self._hashes[child], child))
+                else:
+                    stack.append(child)
+        return items